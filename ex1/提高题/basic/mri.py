@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# MRI选项快速解码：直接从IP首部字节中读出交换机ID列表，按流统计路径出现次数并标记路径变化
+import argparse
+import os
+import socket
+import struct
+import sys
+from collections import Counter
+
+# pcap读取与utils/pcap_analyze.py共用同一个mmap流式读取器
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                 '../../../utils/'))
+from pcap_analyze import readFrames
+
+MRI_OPTION = 31          # 与receive.py中IPOption_MRI的option一致
+ETH_LEN = 14
+IP_PROTOS = {socket.IPPROTO_TCP: 'tcp', socket.IPPROTO_UDP: 'udp'}
+
+unpack_from = struct.unpack_from
+
+
+def decode_mri(buf, ip=ETH_LEN, length=None):
+    """
+    Reads the switch IDs of the MRI option in the IP header at offset ip,
+    without copying the packet.
+
+    The switches push their ID in front of the list, so the IDs are
+    returned reversed, in path order (first hop first).
+    :param length: bytes of the frame in buf, all of buf by default; options
+                   past it (a frame cut by the snaplen) are not read
+    :return: tuple of switch IDs, or None if the packet has no MRI option
+    """
+    if length is None:
+        length = len(buf)
+    if ip + 20 > length:
+        return None
+    end = min(ip + ((buf[ip] & 0x0f) << 2), length)
+    i = ip + 20
+    while i < end:
+        kind = buf[i]
+        if kind == 0:           # End of Option List
+            break
+        if kind == 1:           # No-Operation
+            i += 1
+            continue
+        if i + 2 > end:
+            return None
+        option_len = buf[i + 1]
+        if option_len < 2 or i + option_len > end:
+            return None
+        if kind & 0x1f == MRI_OPTION:
+            if option_len < 4:
+                return None
+            count, = unpack_from('!H', buf, i + 2)
+            if 4 + 4 * count > option_len:
+                return None
+            return unpack_from('!%dI' % count, buf, i + 4)[::-1]
+        i += option_len
+    return None
+
+
+def flow_key(buf, ip=ETH_LEN, length=None):
+    # (src, dst, proto, sport, dport)，非TCP/UDP或端口未被捕获时端口为0
+    proto = buf[ip + 9]
+    src, dst = unpack_from('!4s4s', buf, ip + 12)
+    sport = dport = 0
+    l4 = ip + ((buf[ip] & 0x0f) << 2)
+    if proto in IP_PROTOS and l4 + 4 <= (len(buf) if length is None else length):
+        sport, dport = unpack_from('!HH', buf, l4)
+    return src, dst, proto, sport, dport
+
+
+def format_flow(key):
+    src, dst, proto, sport, dport = key
+    return "%s:%d -> %s:%d/%s" % (socket.inet_ntoa(src), sport, socket.inet_ntoa(dst), dport,
+                                  IP_PROTOS.get(proto, proto))
+
+
+def format_path(path):
+    return "-".join("s%d" % swid for swid in path)
+
+
+class PathStats(object):
+    """Path frequencies per flow, plus every change of a flow's path."""
+
+    def __init__(self, max_changes=1000):
+        self.paths = {}         # flow -> Counter(path)
+        self.last = {}          # flow -> last path seen
+        self.changes = {}       # flow -> number of path changes
+        self.events = []        # (time, flow, old path, new path), the first max_changes
+        self.max_changes = max_changes
+        self.packets = 0
+
+    def add(self, flow, path, t=None):
+        """:return: the previous path if the flow just changed path, else None"""
+        self.packets += 1
+        counts = self.paths.get(flow)
+        if counts is None:
+            counts = self.paths[flow] = Counter()
+        counts[path] += 1
+        old = self.last.get(flow)
+        self.last[flow] = path
+        if old is None or old == path:
+            return None
+        self.changes[flow] = self.changes.get(flow, 0) + 1
+        if len(self.events) < self.max_changes:
+            self.events.append((t, flow, old, path))
+        return old
+
+    def print_summary(self, top=10):
+        flows = sorted(self.paths, key=lambda f: -sum(self.paths[f].values()))
+        print("%d MRI packet(s), %d flow(s), %d path change(s)" % (
+            self.packets, len(flows), sum(self.changes.values())))
+        for flow in flows[:top]:
+            counts = self.paths[flow]
+            total = sum(counts.values())
+            flag = "  PATH CHANGED x%d" % self.changes[flow] if flow in self.changes else ""
+            print("  %s: %d packets%s" % (format_flow(flow), total, flag))
+            for path, n in counts.most_common():
+                print("    %-24s %8d  %5.1f%%" % (format_path(path), n, 100.0 * n / total))
+        sys.stdout.flush()
+
+
+def analyze_pcap(path, stats, verbose=False):
+    for t, frame in readFrames(path):
+        if len(frame) < ETH_LEN + 20 or unpack_from('!H', frame, 12)[0] != 0x0800:
+            continue
+        swids = decode_mri(frame)
+        if swids is None:
+            continue
+        key = flow_key(frame)
+        old = stats.add(key, swids, t)
+        if old is not None and verbose:
+            print("%.6f %s: path %s -> %s" % (t, format_flow(key), format_path(old),
+                                              format_path(swids)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Path statistics from the MRI option of captured packets')
+    parser.add_argument('pcaps', nargs='+', help='pcap files, e.g. pcaps/s1-eth1_in.pcap')
+    parser.add_argument('--top', type=int, default=10, help='flows listed in the summary')
+    parser.add_argument('-v', '--verbose', action='store_true', help='print every path change')
+    args = parser.parse_args()
+    stats = PathStats()
+    for path in args.pcaps:
+        analyze_pcap(path, stats, args.verbose)
+    stats.print_summary(args.top)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
+import argparse
+import ctypes
+import socket
 import sys
 import struct
 import os
+import time
 
 from scapy.all import sniff, sendp, hexdump, get_if_list, get_if_hwaddr
 from scapy.all import Packet, IPOption
@@ -9,6 +13,8 @@ from scapy.all import ShortField, IntField, LongField, BitField, FieldListField,
 from scapy.all import IP, TCP, UDP, Raw
 from scapy.layers.inet import _IPOption_HDR
 
+from mri import PathStats, decode_mri, flow_key, format_flow, format_path
+
 def get_if():
     ifs=get_if_list()
     iface=None
@@ -41,7 +47,162 @@ def handle_pkt(pkt):
         sys.stdout.flush()
 
 
+ETH_P_ALL = 0x0003
+ETH_P_IP = 0x0800
+SO_ATTACH_FILTER = 26
+PACKET_OUTGOING = 4
+SNAPLEN = 128   # 以太网+IP（含最长40字节选项）+TCP端口，够用即可，字节数取IP总长度
+
+def bpf_tcp_dport(port, snaplen=SNAPLEN):
+    # 经典BPF，等价于 tcpdump -dd "ip and tcp dst port <port>"（按IHL跳过IP选项，忽略分片）
+    insns = [
+        (0x28, 0, 0, 12),               # ldh [12]
+        (0x15, 0, 8, ETH_P_IP),         # jeq #0x800 else drop
+        (0x30, 0, 0, 23),               # ldb [23]
+        (0x15, 0, 6, socket.IPPROTO_TCP),
+        (0x28, 0, 0, 20),               # ldh [20]
+        (0x45, 4, 0, 0x1fff),           # jset #0x1fff: 非首片则丢弃
+        (0xb1, 0, 0, 14),               # ldxb 4*([14]&0xf)
+        (0x48, 0, 0, 16),               # ldh [x + 16]
+        (0x15, 0, 1, port),             # jeq #port else drop
+        (0x06, 0, 0, snaplen),          # ret #snaplen
+        (0x06, 0, 0, 0),                # ret #0
+    ]
+    return b''.join(struct.pack('HBBI', *insn) for insn in insns)
+
+def bpf_ip_options(snaplen=SNAPLEN):
+    # 只要带IP选项（IHL > 5）的IPv4包，MRI选项就在其中
+    insns = [
+        (0x28, 0, 0, 12),               # ldh [12]
+        (0x15, 0, 4, ETH_P_IP),         # jeq #0x800 else drop
+        (0x30, 0, 0, 14),               # ldb [14]
+        (0x54, 0, 0, 0x0f),             # and #0xf
+        (0x25, 0, 1, 5),                # jgt #5 else drop
+        (0x06, 0, 0, snaplen),          # ret #snaplen
+        (0x06, 0, 0, 0),                # ret #0
+    ]
+    return b''.join(struct.pack('HBBI', *insn) for insn in insns)
+
+def open_capture(iface, code):
+    # 先以协议0创建（收不到任何包），挂上过滤器后再绑定，避免收进过滤前的包
+    s = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, 0)
+    prog = ctypes.create_string_buffer(code)
+    fprog = struct.pack('HL', len(code) // 8, ctypes.addressof(prog))
+    s.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 * 1024 * 1024)
+    s.bind((iface, ETH_P_ALL))
+    return s, prog
+
+class FlowStats(object):
+    def __init__(self):
+        self.flows = {}     # (src, dst, sport, dport) -> [packets, bytes, interval packets, interval bytes]
+        self.packets = 0
+        self.bytes = 0
+
+    def add(self, key, length):
+        flow = self.flows.get(key)
+        if flow is None:
+            flow = self.flows[key] = [0, 0, 0, 0]
+        flow[0] += 1
+        flow[1] += length
+        flow[2] += 1
+        flow[3] += length
+        self.packets += 1
+        self.bytes += length
+
+    def print_summary(self, seconds, top):
+        flows = sorted(self.flows.items(), key=lambda item: -item[1][3])
+        interval_packets = sum(flow[2] for _, flow in flows)
+        interval_bytes = sum(flow[3] for _, flow in flows)
+        print("[%s] %d flow(s), %.0f pps, %.2f Mbit/s; total %d packets, %d bytes" % (
+            time.strftime("%H:%M:%S"), len(flows), interval_packets / seconds,
+            interval_bytes * 8 / seconds / 1e6, self.packets, self.bytes))
+        for (src, dst, sport, dport), flow in flows[:top]:
+            if not flow[2]:
+                break
+            print("  %s:%d -> %s:%d  %.0f pps  %.3f Mbit/s  (total %d packets)" % (
+                socket.inet_ntoa(src), sport, socket.inet_ntoa(dst), dport,
+                flow[2] / seconds, flow[3] * 8 / seconds / 1e6, flow[0]))
+        sys.stdout.flush()
+        for flow in self.flows.values():
+            flow[2] = flow[3] = 0
+
+def capture_mri(sock, args):
+    # MRI模式：直接从IP首部字节解码交换机ID，按流统计路径，路径变化时立即打印
+    stats = PathStats()
+    buf = bytearray(SNAPLEN)
+    last = time.time()
+    try:
+        while True:
+            try:
+                n, addr = sock.recvfrom_into(buf)
+            except socket.timeout:
+                n = 0
+            if n and addr[2] != PACKET_OUTGOING:
+                # buf中n字节之后是之前更长报文的残留，不能当作本报文的选项解析
+                path = decode_mri(buf, length=n)
+                if path is not None:
+                    key = flow_key(buf, length=n)
+                    old = stats.add(key, path, time.time())
+                    if old is not None:
+                        print("path change %s: %s -> %s" % (
+                            format_flow(key), format_path(old), format_path(path)))
+            now = time.time()
+            if now - last >= args.interval:
+                stats.print_summary(args.top)
+                last = now
+    except KeyboardInterrupt:
+        pass
+
+def capture(args):
+    iface = args.iface or [i for i in os.listdir('/sys/class/net/') if 'eth' in i][0]
+    if args.mri:
+        sock, prog = open_capture(iface, bpf_ip_options())
+        sock.settimeout(args.interval)
+        print("capturing MRI packets on %s, summary every %gs" % (iface, args.interval))
+        sys.stdout.flush()
+        capture_mri(sock, args)
+        return
+    sock, prog = open_capture(iface, bpf_tcp_dport(args.port))
+    sock.settimeout(args.interval)
+    print("capturing tcp dport %d on %s, summary every %gs" % (args.port, iface, args.interval))
+    sys.stdout.flush()
+    buf = bytearray(SNAPLEN)
+    mv = memoryview(buf)
+    unpack_from = struct.unpack_from
+    stats = FlowStats()
+    last = time.time()
+    try:
+        while True:
+            try:
+                n, addr = sock.recvfrom_into(buf)
+            except socket.timeout:
+                n = 0
+            if n and addr[2] != PACKET_OUTGOING:
+                # 只解析固定偏移的字段：IP总长度、源/目的地址，再按IHL找到TCP端口
+                ihl = (buf[14] & 0x0f) << 2
+                length, = unpack_from('!H', buf, 16)
+                sport, dport = unpack_from('!HH', buf, 14 + ihl)
+                stats.add((bytes(mv[26:30]), bytes(mv[30:34]), sport, dport), length)
+            now = time.time()
+            if now - last >= args.interval:
+                stats.print_summary(now - last, args.top)
+                last = now
+    except KeyboardInterrupt:
+        pass
+
 def main():
+    if '--capture' in sys.argv[1:]:
+        parser = argparse.ArgumentParser(description='Capture with a BPF filter and print per-flow statistics')
+        parser.add_argument('--capture', action='store_true', help='capture mode')
+        parser.add_argument('--iface', help='interface to capture on (default: the first eth one)')
+        parser.add_argument('--port', type=int, default=1234, help='TCP destination port to capture')
+        parser.add_argument('--interval', type=float, default=1.0, help='seconds between summaries')
+        parser.add_argument('--top', type=int, default=10, help='flows listed per summary')
+        parser.add_argument('--mri', action='store_true',
+                            help='decode the MRI option and report the paths of each flow')
+        capture(parser.parse_args())
+        return
     ifaces = [i for i in os.listdir('/sys/class/net/') if 'eth' in i]
     iface = ifaces[0]
     print(("sniffing on %s" % iface))
@@ -4,11 +4,19 @@ import sys
 import socket
 import random
 import struct
+import time
 
-from scapy.all import sendp, send, get_if_list, get_if_hwaddr
+from scapy.all import sendp, send, get_if_list, get_if_hwaddr, get_if_addr
 from scapy.all import Packet
 from scapy.all import Ether, IP, UDP, TCP
 
+ETH_LEN = 14
+IP_LEN = 20
+TCP_LEN = 20
+HEADERS_LEN = ETH_LEN + IP_LEN + TCP_LEN
+SOL_PACKET = 263
+PACKET_QDISC_BYPASS = 20
+
 def get_if():
     ifs=get_if_list()
     iface=None # "h1-eth0"
@@ -21,10 +29,165 @@ def get_if():
         exit(1)
     return iface
 
+def csum_add(total, data):
+    # 16位反码求和（未取反），奇数长度时末尾补0
+    if len(data) % 2:
+        data = bytes(data) + b'\x00'
+    total += sum(struct.unpack('!%dH' % (len(data) // 2), data))
+    return total
+
+def csum_fold(total):
+    while total >> 16:
+        total = (total & 0xffff) + (total >> 16)
+    return ~total & 0xffff
+
+class FlowTemplate(object):
+    """
+    One prebuilt Ether/IPv4/TCP frame of a flow, sized for the largest
+    payload. Sending a packet only patches the IP total length and the two
+    checksums in place; everything else is summed once when the flow is built.
+    """
+
+    def __init__(self, src_mac, src_ip, dst_ip, sport, dport, tos, payload, payload_sums):
+        self.buf = bytearray(HEADERS_LEN + len(payload))
+        self.view = memoryview(self.buf)
+        self.payload_sums = payload_sums
+        struct.pack_into('!6s6sH', self.buf, 0, b'\xff' * 6, src_mac, 0x0800)
+        # 总长度和校验和留0，发送时再填
+        struct.pack_into('!BBHHHBBH4s4s', self.buf, ETH_LEN, 0x45, tos, 0,
+                         random.randint(0, 0xffff), 0, 64, socket.IPPROTO_TCP, 0,
+                         socket.inet_aton(src_ip), socket.inet_aton(dst_ip))
+        struct.pack_into('!HHIIBBHHH', self.buf, ETH_LEN + IP_LEN, sport, dport,
+                         0, 0, TCP_LEN << 2, 0x02, 8192, 0, 0)
+        self.buf[HEADERS_LEN:] = payload
+        self.ip_sum = csum_add(0, self.buf[ETH_LEN:ETH_LEN + IP_LEN])
+        # 伪首部（不含TCP长度）加TCP首部
+        self.tcp_sum = csum_add(csum_add(0, self.buf[ETH_LEN + 12:ETH_LEN + IP_LEN]) +
+                                socket.IPPROTO_TCP,
+                                self.buf[ETH_LEN + IP_LEN:HEADERS_LEN])
+
+    def frame(self, payload_len):
+        tcp_len = TCP_LEN + payload_len
+        struct.pack_into('!H', self.buf, ETH_LEN + 2, IP_LEN + tcp_len)
+        struct.pack_into('!H', self.buf, ETH_LEN + 10, csum_fold(self.ip_sum + IP_LEN + tcp_len))
+        struct.pack_into('!H', self.buf, ETH_LEN + IP_LEN + 16,
+                         csum_fold(self.tcp_sum + tcp_len + self.payload_sums[payload_len]))
+        return self.view[:HEADERS_LEN + payload_len]
+
+def build_flows(args, iface):
+    src_mac = bytes.fromhex(get_if_hwaddr(iface).replace(':', ''))
+    dsts = [socket.gethostbyname(d) for d in args.destination.split(',')]
+    max_size = max(args.sizes)
+    payload = (args.message.encode() * (max_size // max(len(args.message), 1) + 1))[:max_size]
+    # payload_sums[n]: 前n字节负载的反码和，任意负载长度的TCP校验和都只需一次加法
+    payload_sums = [0] * (max_size + 1)
+    total = 0
+    for n in range(1, max_size + 1):
+        if n % 2:
+            payload_sums[n] = total + (payload[n - 1] << 8)
+        else:
+            total += (payload[n - 2] << 8) | payload[n - 1]
+            payload_sums[n] = total
+    flows = []
+    for i in range(args.flows):
+        sport = 49152 + (args.sport_base + i) % 16384
+        flows.append(FlowTemplate(src_mac, args.src, dsts[i % len(dsts)], sport, args.dport,
+                                  args.tos, payload, payload_sums))
+    return flows
+
+def open_socket(iface):
+    s = socket.socket(socket.AF_PACKET, socket.SOCK_RAW)
+    s.bind((iface, 0))
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4 * 1024 * 1024)
+    try:
+        # 绕过qdisc直接交给网卡驱动（Linux 3.14+）
+        s.setsockopt(SOL_PACKET, PACKET_QDISC_BYPASS, 1)
+    except OSError:
+        pass
+    return s
+
+def generate(args):
+    iface = args.iface or get_if()
+    if args.src is None:
+        args.src = get_if_addr(iface)
+    flows = build_flows(args, iface)
+    sock = open_socket(iface)
+    print("generating on %s: %d flow(s) to %s, %s pps, payload %s bytes, burst %d" % (
+        iface, len(flows), args.destination, args.rate or 'max',
+        ','.join(str(n) for n in args.sizes), args.burst))
+    sizes = args.sizes
+    n_flows, n_sizes = len(flows), len(sizes)
+    gap = args.burst / float(args.rate) if args.rate else 0.0
+    on, off = args.onoff or (None, None)
+    sent = dropped = sent_bytes = 0
+    k = 0
+    start = now = time.time()
+    next_burst = start
+    end = start + args.duration if args.duration else None
+    try:
+        while end is None or now < end:
+            if on is not None and (now - start) % (on + off) >= on:
+                # 开关模式的关闭阶段
+                time.sleep(on + off - (now - start) % (on + off))
+                now = next_burst = time.time()
+                continue
+            for _ in range(args.burst):
+                frame = flows[k % n_flows].frame(sizes[k % n_sizes])
+                k += 1
+                try:
+                    sock.send(frame)
+                    sent += 1
+                    sent_bytes += len(frame)
+                except OSError:
+                    # ENOBUFS：发送队列已满，计为丢弃
+                    dropped += 1
+            if args.count and sent >= args.count:
+                break
+            now = time.time()
+            if gap:
+                next_burst += gap
+                if next_burst > now:
+                    time.sleep(next_burst - now)
+                    now = time.time()
+                elif now - next_burst > 1.0:
+                    # 落后太多时不再追赶，避免突发
+                    next_burst = now
+    except KeyboardInterrupt:
+        pass
+    elapsed = max(time.time() - start, 1e-9)
+    print("sent %d packets (%d dropped) in %.2fs: %.0f pps, %.2f Mbit/s" % (
+        sent, dropped, elapsed, sent / elapsed, sent_bytes * 8 / elapsed / 1e6))
+
+def parse_gen_args(argv):
+    parser = argparse.ArgumentParser(description='Traffic generator: prebuilt frames sent over a raw socket')
+    parser.add_argument('--gen', action='store_true', help='generator mode')
+    parser.add_argument('destination', help='destination host(s), comma separated; flows are spread over them')
+    parser.add_argument('message', nargs='?', default='P4 is cool', help='payload pattern')
+    parser.add_argument('--iface', help='interface to send on (default: the eth0 one)')
+    parser.add_argument('--src', help='source IP (default: the address of the interface)')
+    parser.add_argument('--rate', type=float, default=0, help='target packets per second (0: as fast as possible)')
+    parser.add_argument('--flows', type=int, default=1, help='number of flows (distinct source ports)')
+    parser.add_argument('--sport-base', type=int, default=0, help='offset of the first source port from 49152')
+    parser.add_argument('--dport', type=int, default=1234)
+    parser.add_argument('--sizes', type=lambda s: [int(n) for n in s.split(',')], default=[64],
+                        help='payload sizes in bytes, comma separated, used in turn')
+    parser.add_argument('--tos', type=int, default=0, help='IP TOS byte (DSCP << 2 | ECN)')
+    parser.add_argument('--duration', type=float, default=10, help='seconds to run (0: until Ctrl-C)')
+    parser.add_argument('--count', type=int, default=0, help='stop after this many packets')
+    parser.add_argument('--burst', type=int, default=32, help='packets sent back to back per batch')
+    parser.add_argument('--onoff', type=lambda s: tuple(float(n) for n in s.split(',')),
+                        help='ON,OFF seconds: send for ON seconds, pause for OFF seconds')
+    return parser.parse_args(argv)
+
 def main():
 
+    if '--gen' in sys.argv[1:]:
+        generate(parse_gen_args(sys.argv[1:]))
+        return
+
     if len(sys.argv)<3:
         print('pass 2 arguments: <destination> "<message>"')
+        print('or generate traffic: --gen <destination> [--rate PPS] [--flows N] [--duration S] ... (see --gen -h)')
         exit(1)
 
     addr = socket.gethostbyname(sys.argv[1])
@@ -4,7 +4,6 @@ import argparse
 import os
 import sys
 import grpc
-from time import sleep
 
 
 # Import P4Runtime lib from parent utils dir
@@ -13,96 +12,27 @@ sys.path.append(
     os.path.join(os.path.dirname(os.path.abspath(__file__)),
                  '../../utils/'))
 import p4runtime_lib.bmv2
-import p4runtime_lib.helper
 from p4runtime_lib.switch import ShutdownAllSwitchConnections
-
-SWITCH_TO_HOST_PORT = 1
-
-# 定义写隧道规则
-def writeTunnelRules(p4info_helper, ingress_sw, egress_sw, tunnel_id,
-                     dst_eth_addr, dst_ip_addr,switch_port): # 增加参数switch_port
-    """
-    Installs three rules:
-    1) An tunnel ingress rule on the ingress switch in the ipv4_lpm table that
-       encapsulates traffic into a tunnel with the specified ID
-       入路由中的ipv4_lpm表的入隧道规则，将流量封装进指定ID的隧道中
-    2) A transit rule on the ingress switch that forwards traffic based on
-       the specified ID
-       入路由中的运输规则，基于指定的隧道ID转发流量
-    3) An tunnel egress rule on the egress switch that decapsulates traffic
-       with the specified ID and sends it to the host
-       在出路由中的规则，使用特定的ID对流量解封装，并且发送流量到主机
-    :param p4info_helper: the P4Info helper
-    :param ingress_sw: the ingress switch connection
-    :param egress_sw: the egress switch connection
-    :param tunnel_id: the specified tunnel ID
-    :param dst_eth_addr: the destination IP to match in the ingress rule
-    :param dst_ip_addr: the destination Ethernet address to write in the
-                        egress rule
-    """
-    # 1) Tunnel Ingress Rule 隧道入口规则
-    table_entry = p4info_helper.buildTableEntry(    # 使用p4info_helper解析器将规则转化为P4Runtime能够识别的形式
-        table_name="MyIngress.ipv4_lpm",            # 定义表名
-        match_fields={                              # 设置匹配域
-            "hdr.ipv4.dstAddr": (dst_ip_addr, 32)   # 包头对应的hdr.ipv4.dstAddr字段与参数中的dst_ip_addr匹配，则执行这一条表项的对应动作
-                                                    # 后面的32是掩码，表示前32bit都是网络号
-        },
-        action_name="MyIngress.myTunnel_ingress",   # 设置匹配成功对应的动作名
-        action_params={                             # 动作参数
-            "dst_id": tunnel_id,                    # 为传入的tunnel_id
-        })
-    ingress_sw.WriteTableEntry(table_entry)         # 调用WriteTableEntry，将生成的匹配动作表项加入交换机
-    print("Installed ingress tunnel rule on %s" % ingress_sw.name)
-
-    # 2) Tunnel Transit Rule 交换机入口的转发规则
-    # The rule will need to be added to the myTunnel_exact table and match on
-    # the tunnel ID (hdr.myTunnel.dst_id). Traffic will need to be forwarded
-    # using the myTunnel_forward action on the port connected to the next switch.
-    #
-    # For our simple topology, switch 1 and switch 2 are connected using a
-    # link attached to port 2 on both switches. We have defined a variable at
-    # the top of the file, SWITCH_TO_SWITCH_PORT, that you can use as the output
-    # port for this action.
-    #
-    # We will only need a transit rule on the ingress switch because we are
-    # using a simple topology. In general, you'll need on transit rule for
-    # each switch in the path (except the last switch, which has the egress rule),
-    # and you will need to select the port dynamically for each switch based on
-    # your topology.
-
-    # TODO build the transit rule
-    # TODO install the transit rule on the ingress switch
-    table_entry = p4info_helper.buildTableEntry(
-        table_name="MyIngress.myTunnel_exact",      # 定义表名
-        match_fields={                              # 设置匹配域
-            "hdr.myTunnel.dst_id": tunnel_id
-        },
-        action_name="MyIngress.myTunnel_forward",   # 设置匹配成功对应的动作名
-        action_params={                             # 动作参数
-            "port": switch_port                     # 为传入的switch_port
-        })
-    ingress_sw.WriteTableEntry(table_entry)         # 调用WriteTableEntry，将生成的匹配动作表项加入交换机
-    print("Installed transit tunnel rule on %s" % ingress_sw.name)
-
-    # 3) Tunnel Egress Rule 交换机出口的隧道出口规则
-    # For our simple topology, the host will always be located on the
-    # SWITCH_TO_HOST_PORT (port 1).
-    # In general, you will need to keep track of which port the host is
-    # connected to.
-    print("TODO Install transit tunnel rule")
-
-    table_entry = p4info_helper.buildTableEntry(
-        table_name="MyIngress.myTunnel_exact",      # 定义表名
-        match_fields={                              # 设置匹配域
-            "hdr.myTunnel.dst_id": tunnel_id
-        },
-        action_name="MyIngress.myTunnel_egress",    # 设置匹配成功对应的动作名
-        action_params={                             # 动作参数
-            "dstAddr": dst_eth_addr,
-            "port": SWITCH_TO_HOST_PORT
-        })
-    egress_sw.WriteTableEntry(table_entry)
-    print("Installed egress tunnel rule on %s" % egress_sw.name)
+from p4runtime_ext.batch import BatchWriter
+from p4runtime_ext.bringup import BringUpError, bring_up
+from p4runtime_ext.bundle import RuleBundle, bundleKey
+from p4runtime_ext.capacity import CapacityError, checkPending, tableSizes
+from p4runtime_ext.counters import CounterCollector, printTunnelLoss
+from p4runtime_ext.dump import LOG_MODES, LOG_OFF, MessageDump
+from p4runtime_ext.helper import IndexedP4InfoHelper
+from p4runtime_ext.reconcile import installer
+from p4runtime_ext.rules import writeRules
+from p4runtime_ext.runtime import ControllerRuntime
+from p4runtime_ext.timeseries import TimeSeriesStore, printTunnelTrends
+from p4runtime_ext.topology import Topology
+from p4runtime_ext.tunnels import TunnelManager
+
+WRITE_BATCH_SIZE = 256   # 每个WriteRequest最多携带的update数
+
+INGRESS_TUNNEL_COUNTER = "MyIngress.ingressTunnelCounter"
+EGRESS_TUNNEL_COUNTER = "MyIngress.egressTunnelCounter"
+POLL_INTERVAL = 2      # 隧道计数器轮询周期（秒）
+TREND_INTERVAL = 60    # 打印速率趋势的周期（秒）
 
 
 def readTableRules(p4info_helper, sw):  # 将交换机中所有流表所有条目读出打印。
@@ -132,24 +62,6 @@ def readTableRules(p4info_helper, sw):  # 将交换机中所有流表所有条
             print()
 
 
-def printCounter(p4info_helper, sw, counter_name, index):   # 从交换机中读具体的索引（即隧道ID号）对应的计数器
-    """
-    Reads the specified counter at the specified index from the switch. In our
-    program, the index is the tunnel ID. If the index is 0, it will return all
-    values from the counter.
-    :param p4info_helper: the P4Info helper
-    :param sw:  the switch connection
-    :param counter_name: the name of the counter from the P4 program
-    :param index: the counter index (in our case, the tunnel ID)
-    """
-    for response in sw.ReadCounters(p4info_helper.get_counters_id(counter_name), index):
-        for entity in response.entities:
-            counter = entity.counter_entry
-            print("%s %s %d: %d packets (%d bytes)" % (
-                sw.name, counter_name, index,
-                counter.data.packet_count, counter.data.byte_count
-            ))
-
 def printGrpcError(e):
     print("gRPC Error:", e.details(), end=' ')
     status_code = e.code()
@@ -158,9 +70,11 @@ def printGrpcError(e):
     print("[%s:%d]" % (traceback.tb_frame.f_code.co_filename, traceback.tb_lineno))
 
 
-def main(p4info_file_path, bmv2_file_path):
+def main(p4info_file_path, bmv2_file_path, topo_file_path, log_mode, log_sample, bundle_path):
     # Instantiate a P4Runtime helper from the p4info file
-    p4info_helper = p4runtime_lib.helper.P4InfoHelper(p4info_file_path)
+    p4info_helper = IndexedP4InfoHelper(p4info_file_path)
+    # P4Runtime消息转存默认关闭；binary为后台线程缓冲写入的二进制记录，text为原来的逐条文本日志
+    dump = MessageDump(log_mode, log_sample)
 
     try:
         # Create a switch connection object for s1 and s2;
@@ -170,58 +84,47 @@ def main(p4info_file_path, bmv2_file_path):
             name='s1',
             address='127.0.0.1:50051',
             device_id=0,
-            proto_dump_file='logs/s1-p4runtime-requests.txt')
+            proto_dump_file=dump.text_file('s1'))
         s2 = p4runtime_lib.bmv2.Bmv2SwitchConnection(
             name='s2',
             address='127.0.0.1:50052',
             device_id=1,
-            proto_dump_file='logs/s2-p4runtime-requests.txt')
+            proto_dump_file=dump.text_file('s2'))
         s3 = p4runtime_lib.bmv2.Bmv2SwitchConnection(
             name='s3',
             address='127.0.0.1:50053',
             device_id=2,
-            proto_dump_file='logs/s3-p4runtime-requests.txt')
-        # Send master arbitration update message to establish this controller as
-        # master (required by P4Runtime before performing any other write operation)
-        s1.MasterArbitrationUpdate()
-        s2.MasterArbitrationUpdate()
-        s3.MasterArbitrationUpdate()
-
-        # Install the P4 program on the switches
-        s1.SetForwardingPipelineConfig(p4info=p4info_helper.p4info,
-                                       bmv2_json_file_path=bmv2_file_path)
-        print("Installed P4 Program using SetForwardingPipelineConfig on s1")
-        s2.SetForwardingPipelineConfig(p4info=p4info_helper.p4info,
-                                       bmv2_json_file_path=bmv2_file_path)
-        print("Installed P4 Program using SetForwardingPipelineConfig on s2")
-        s3.SetForwardingPipelineConfig(p4info=p4info_helper.p4info,
-                                       bmv2_json_file_path=bmv2_file_path)
-        print("Installed P4 Program using SetForwardingPipelineConfig on s3")
-
-        # 新增：调用函数时传入端口号switch_port
-        # Write the rules that tunnel traffic from h1 to h2
-        writeTunnelRules(p4info_helper, ingress_sw=s1, egress_sw=s2, tunnel_id=100,
-                         dst_eth_addr="08:00:00:00:02:22", dst_ip_addr="10.0.2.2",switch_port=2)
-
-        # Write the rules that tunnel traffic from h2 to h1
-        writeTunnelRules(p4info_helper, ingress_sw=s2, egress_sw=s1, tunnel_id=101,
-                         dst_eth_addr="08:00:00:00:01:11", dst_ip_addr="10.0.1.1",switch_port=2)
-
-        # Write the rules that tunnel traffic from h1 to h3
-        writeTunnelRules(p4info_helper, ingress_sw=s1, egress_sw=s3, tunnel_id=200,
-                         dst_eth_addr="08:00:00:00:03:33", dst_ip_addr="10.0.3.3",switch_port=3)
-
-        # Write the rules that tunnel traffic from h3 to h1
-        writeTunnelRules(p4info_helper, ingress_sw=s3, egress_sw=s1, tunnel_id=201,
-                         dst_eth_addr="08:00:00:00:01:11", dst_ip_addr="10.0.1.1",switch_port=2)
-
-        # Write the rules that tunnel traffic from h2 to h3
-        writeTunnelRules(p4info_helper, ingress_sw=s2, egress_sw=s3, tunnel_id=300,
-                         dst_eth_addr="08:00:00:00:03:33", dst_ip_addr="10.0.3.3",switch_port=3)
-
-        # Write the rules that tunnel traffic from h3 to h2
-        writeTunnelRules(p4info_helper, ingress_sw=s3, egress_sw=s2, tunnel_id=301,
-                         dst_eth_addr="08:00:00:00:02:22", dst_ip_addr="10.0.2.2",switch_port=3)
+            proto_dump_file=dump.text_file('s3'))
+        for sw in (s1, s2, s3):
+            dump.attach(sw)
+        # 规则先放入批量写缓冲区，等流水线下发后按交换机合并成多条update的WriteRequest下发
+        writer = BatchWriter(batch_size=WRITE_BATCH_SIZE, autoflush=False)
+
+        # 隧道由管理器统一分配ID并按拓扑计算路径：每个有主机的交换机到其他交换机上的每台主机各一条隧道，
+        # 路径上每台交换机一条转发规则，出口交换机一条解封装规则
+        topo = Topology.load(topo_file_path)
+        tunnels = TunnelManager(p4info_helper, topo, {"s1": s1, "s2": s2, "s3": s3}, writer)
+        tunnels.mesh()
+        sizes = tableSizes(p4info_helper, bmv2_file_path)
+        # p4info、BMv2 JSON、拓扑文件、本控制器和规则编译代码都没变时，直接使用上次编码好的规则包，不再逐条编码
+        key = bundleKey(p4info_file_path, (bmv2_file_path, topo_file_path,
+                                           os.path.abspath(__file__)))
+        bundle = RuleBundle.load(bundle_path, key) if bundle_path else None
+        if bundle is None:
+            rules = tunnels.rules()
+            for sw in (s1, s2, s3):
+                writeRules(p4info_helper, writer.wrap(sw), rules[sw.name])
+
+            # 下发前按BMv2 JSON中的表大小检查待写的表项能否装下，装不下就一条都不写
+            checkPending(writer, [s1, s2, s3], sizes)
+            if bundle_path:
+                RuleBundle.fromWriter(key, writer, [s1, s2, s3], WRITE_BATCH_SIZE).save(bundle_path)
+
+        # 各交换机并行完成仲裁(MasterArbitrationUpdate)、下发P4程序，
+        # 再把上面的规则与交换机上已有的表项比对，只写入需要增删改的条目
+        bring_up([s1, s2, s3], p4info_helper, bmv2_file_path,
+                 install_rules=bundle.installer(writer, sizes) if bundle
+                 else installer(writer, sizes=sizes))
 
         # TODO Uncomment the following two lines to read table entries from s1 and s2
         readTableRules(p4info_helper, s1)
@@ -229,36 +132,40 @@ def main(p4info_file_path, bmv2_file_path):
         readTableRules(p4info_helper, s3)
 
         # Print the tunnel counters every 2 seconds
-        # 修改输出
-        while True:
-            sleep(2)
-            print('\n----- Reading tunnel counters -----')
-            print('----- s1 -> s2 -----')
-            printCounter(p4info_helper, s1, "MyIngress.ingressTunnelCounter", 100)
-            printCounter(p4info_helper, s2, "MyIngress.egressTunnelCounter", 100)
-            print('----- s2 -> s2 -----')
-            printCounter(p4info_helper, s2, "MyIngress.ingressTunnelCounter", 101)
-            printCounter(p4info_helper, s1, "MyIngress.egressTunnelCounter", 101)
-            print('----- s1 -> s1 -----')
-            printCounter(p4info_helper, s1, "MyIngress.ingressTunnelCounter", 200)
-            printCounter(p4info_helper, s3, "MyIngress.egressTunnelCounter", 200)
-            print('----- s3 -> s1 -----')
-            printCounter(p4info_helper, s3, "MyIngress.ingressTunnelCounter", 201)
-            printCounter(p4info_helper, s1, "MyIngress.egressTunnelCounter", 201)
-            print('----- s2 -> s3 -----')
-            printCounter(p4info_helper, s2, "MyIngress.ingressTunnelCounter", 300)
-            printCounter(p4info_helper, s3, "MyIngress.egressTunnelCounter", 300)
-            print('----- s3 -> s2 -----')
-            printCounter(p4info_helper, s3, "MyIngress.ingressTunnelCounter", 301)
-            printCounter(p4info_helper, s2, "MyIngress.egressTunnelCounter", 301)
-            print('---------- Finished ---------')
+        # 每个交换机每个计数器只发一次通配读请求，再按隧道ID统一计算各隧道的收发与丢包
+        # 各隧道入口/出口计数器的历史存入固定大小的环形缓冲区，定期打印速率趋势
+        # (隧道ID, 入口交换机, 出口交换机)，与管理器分配的隧道一一对应
+        tunnel_ids = tunnels.counters()
+        store = TimeSeriesStore(max_series=2 * len(tunnel_ids))
+        for tunnel_id, ingress, egress in tunnel_ids:
+            store.track(ingress, INGRESS_TUNNEL_COUNTER, [tunnel_id])
+            store.track(egress, EGRESS_TUNNEL_COUNTER, [tunnel_id])
+        collector = CounterCollector(p4info_helper, [s1, s2, s3],
+                                     [INGRESS_TUNNEL_COUNTER, EGRESS_TUNNEL_COUNTER], store)
+
+        def pollTunnels():
+            collector.poll()
+            printTunnelLoss(collector.tunnel_loss(tunnel_ids, INGRESS_TUNNEL_COUNTER,
+                                                  EGRESS_TUNNEL_COUNTER), tunnel_ids)
+
+        # 由事件循环统一调度：接管各交换机的StreamChannel，并周期性地轮询计数器、打印趋势
+        # 阻塞任务只用一个线程执行，轮询与打印趋势不会同时读写时间序列
+        runtime = ControllerRuntime([s1, s2, s3], max_workers=1)
+        runtime.every(POLL_INTERVAL, pollTunnels)
+        runtime.every(TREND_INTERVAL, printTunnelTrends, store, tunnel_ids, INGRESS_TUNNEL_COUNTER)
+        runtime.run()
 
     except KeyboardInterrupt:
         print(" Shutting down.")
     except grpc.RpcError as e:
         printGrpcError(e)
+    except BringUpError as e:
+        print(e)
+    except CapacityError as e:
+        print(e)
 
     ShutdownAllSwitchConnections()
+    dump.close()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='P4Runtime Controller')
@@ -268,6 +175,21 @@ if __name__ == '__main__':
     parser.add_argument('--bmv2-json', help='BMv2 JSON file from p4c',
                         type=str, action="store", required=False,
                         default='./build/advanced_tunnel.json')
+    parser.add_argument('--topo', help='Topology file the tunnel paths are computed from',
+                        type=str, action="store", required=False,
+                        default='./topology.json')
+    parser.add_argument('--log', help='P4Runtime message log: off, binary (buffered, '
+                        'render with utils/p4runtime_ext/dump.py) or text',
+                        type=str, action="store", required=False,
+                        choices=LOG_MODES, default=LOG_OFF)
+    parser.add_argument('--log-sample', help='Fraction of messages kept in the binary log',
+                        type=float, action="store", required=False, default=1.0)
+    parser.add_argument('--bundle', help='Rule bundle: the encoded rules are saved here and '
+                        'streamed back as they are while the inputs stay the same',
+                        type=str, action="store", required=False,
+                        default='./build/advanced_tunnel.rules.bundle')
+    parser.add_argument('--no-bundle', help='Build and encode the rules on every run',
+                        action="store_true", required=False)
     args = parser.parse_args()
 
     if not os.path.exists(args.p4info):
@@ -278,4 +200,9 @@ if __name__ == '__main__':
         parser.print_help()
         print("\nBMv2 JSON file not found: %s\nHave you run 'make'?" % args.bmv2_json)
         parser.exit(1)
-    main(args.p4info, args.bmv2_json)
+    if not os.path.exists(args.topo):
+        parser.print_help()
+        print("\nTopology file not found: %s" % args.topo)
+        parser.exit(1)
+    main(args.p4info, args.bmv2_json, args.topo, args.log, args.log_sample,
+         None if args.no_bundle else args.bundle)
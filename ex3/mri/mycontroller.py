@@ -11,27 +11,22 @@ sys.path.append(
     os.path.join(os.path.dirname(os.path.abspath(__file__)),
                  '../../utils/'))
 import p4runtime_lib.bmv2
-import p4runtime_lib.helper
 from p4runtime_lib.switch import ShutdownAllSwitchConnections
+from p4runtime_ext.batch import BatchWriter
+from p4runtime_ext.bringup import BringUpError, bring_up
+from p4runtime_ext.bundle import RuleBundle, bundleKey
+from p4runtime_ext.capacity import CapacityError, checkPending, tableSizes
+from p4runtime_ext.compiler import compileIpv4Lpm
+from p4runtime_ext.dump import LOG_MODES, LOG_OFF, MessageDump
+from p4runtime_ext.helper import IndexedP4InfoHelper
+from p4runtime_ext.reconcile import installer
+from p4runtime_ext.rules import writeRules
+from p4runtime_ext.topology import Topology, switchNumber
 
-
-# 定义规则
-def forwardRules(p4info_helper, ingress_sw, dst_eth_addr,
-                 dst_ip_addr,dst_port):
-    table_entry = p4info_helper.buildTableEntry(    # 使用p4info_helper解析器将规则转化为P4Runtime能够识别的形式
-        table_name="MyIngress.ipv4_lpm",            # 定义表名
-        match_fields={                              # 设置匹配域
-            "hdr.ipv4.dstAddr": dst_ip_addr         # 包头对应的hdr.ipv4.dstAddr字段与参数中的dst_ip_addr匹配，则执行这一条表项的对应动作
-        },
-        action_name="MyIngress.ipv4_forward",       # 设置匹配成功对应的动作名
-        action_params={                             # 动作参数
-            "dstAddr": dst_eth_addr,
-            "port": dst_port
-        })
-    ingress_sw.WriteTableEntry(table_entry)         # 调用WriteTableEntry，将生成的匹配动作表项加入交换机
-    print("Installed Forward rule on %s" % ingress_sw.name)
+WRITE_BATCH_SIZE = 256   # 每个WriteRequest最多携带的update数
 
 
+# 定义规则
 def swtraceRules(p4info_helper, ingress_sw, swid):
     table_entry = p4info_helper.buildTableEntry(
         table_name="MyEgress.swtrace",           # 定义表名
@@ -51,9 +46,11 @@ def printGrpcError(e):
     print("[%s:%d]" % (traceback.tb_frame.f_code.co_filename, traceback.tb_lineno))
 
 
-def main(p4info_file_path, bmv2_file_path):
+def main(p4info_file_path, bmv2_file_path, topo_file_path, log_mode, log_sample, bundle_path):
     # Instantiate a P4Runtime helper from the p4info file初始化 p4info_helper
-    p4info_helper = p4runtime_lib.helper.P4InfoHelper(p4info_file_path)
+    p4info_helper = IndexedP4InfoHelper(p4info_file_path)
+    # P4Runtime消息转存默认关闭；binary为后台线程缓冲写入的二进制记录，text为原来的逐条文本日志
+    dump = MessageDump(log_mode, log_sample)
 
     try:
         # Create a switch connection object for s1 and s2;为s1、s2、s3创建交换机连接对象
@@ -63,71 +60,57 @@ def main(p4info_file_path, bmv2_file_path):
             name='s1',
             address='127.0.0.1:50051',
             device_id=0,
-            proto_dump_file='logs/s1-p4runtime-requests.txt')
+            proto_dump_file=dump.text_file('s1'))
         s2 = p4runtime_lib.bmv2.Bmv2SwitchConnection(
             name='s2',
             address='127.0.0.1:50052',
             device_id=1,
-            proto_dump_file='logs/s2-p4runtime-requests.txt')
+            proto_dump_file=dump.text_file('s2'))
         s3 = p4runtime_lib.bmv2.Bmv2SwitchConnection(
             name='s3',
             address='127.0.0.1:50053',
             device_id=2,
-            proto_dump_file='logs/s3-p4runtime-requests.txt')
-        # Send master arbitration update message to establish this controller as
-        # master (required by P4Runtime before performing any other write operation)
-        s1.MasterArbitrationUpdate()
-        s2.MasterArbitrationUpdate()
-        s3.MasterArbitrationUpdate()
-
-        # Install the P4 program on the switches在交换机上安装 P4 程序
-        s1.SetForwardingPipelineConfig(p4info=p4info_helper.p4info,
-                                       bmv2_json_file_path=bmv2_file_path)
-        print("Installed P4 Program using SetForwardingPipelineConfig on s1")
-        s2.SetForwardingPipelineConfig(p4info=p4info_helper.p4info,
-                                       bmv2_json_file_path=bmv2_file_path)
-        print("Installed P4 Program using SetForwardingPipelineConfig on s2")
-        s3.SetForwardingPipelineConfig(p4info=p4info_helper.p4info,
-                                       bmv2_json_file_path=bmv2_file_path)
-        print("Installed P4 Program using SetForwardingPipelineConfig on s3")
-
-        #s1
-        forwardRules(p4info_helper, ingress_sw=s1, dst_eth_addr="08:00:00:00:01:01",
-                          dst_ip_addr=["10.0.1.1", 32], dst_port=2)
-        forwardRules(p4info_helper, ingress_sw=s1, dst_eth_addr="08:00:00:00:01:11",
-                          dst_ip_addr=["10.0.1.11", 32], dst_port=1)
-        forwardRules(p4info_helper, ingress_sw=s1, dst_eth_addr="08:00:00:00:02:00",
-                          dst_ip_addr=["10.0.2.0", 24], dst_port=3)
-        forwardRules(p4info_helper, ingress_sw=s1, dst_eth_addr="08:00:00:00:03:00",
-                          dst_ip_addr=["10.0.3.0", 24], dst_port=4)
-        swtraceRules(p4info_helper, s1, 1)
-        #s2
-        forwardRules(p4info_helper, ingress_sw=s2, dst_eth_addr="08:00:00:00:02:02",
-                          dst_ip_addr=["10.0.2.2", 32], dst_port=2)
-        forwardRules(p4info_helper, ingress_sw=s2, dst_eth_addr="08:00:00:00:02:22",
-                          dst_ip_addr=["10.0.2.22", 32], dst_port=1)
-        forwardRules(p4info_helper, ingress_sw=s2, dst_eth_addr="08:00:00:00:01:00",
-                          dst_ip_addr=["10.0.1.0", 24], dst_port=3)
-        forwardRules(p4info_helper, ingress_sw=s2, dst_eth_addr="08:00:00:00:03:00",
-                          dst_ip_addr=["10.0.3.0", 24], dst_port=4)
-        swtraceRules(p4info_helper, s2, 2)
-
-        #s3
-        forwardRules(p4info_helper, ingress_sw=s3, dst_eth_addr="08:00:00:00:03:03",
-                          dst_ip_addr=["10.0.3.3", 32], dst_port=1)
-        forwardRules(p4info_helper, ingress_sw=s3, dst_eth_addr="08:00:00:00:01:00",
-                          dst_ip_addr=["10.0.1.0", 24], dst_port=2)
-        forwardRules(p4info_helper, ingress_sw=s3, dst_eth_addr="08:00:00:00:02:00",
-                          dst_ip_addr=["10.0.2.0", 24], dst_port=3)
-        swtraceRules(p4info_helper, s3, 3)
-
+            proto_dump_file=dump.text_file('s3'))
+        for sw in (s1, s2, s3):
+            dump.attach(sw)
+        # 规则先放入批量写缓冲区，等流水线下发后按交换机合并成多条update的WriteRequest下发
+        writer = BatchWriter(batch_size=WRITE_BATCH_SIZE, autoflush=False)
+
+        # 由拓扑文件计算各交换机之间的最短路径，生成ipv4_lpm规则
+        topo = Topology.load(topo_file_path)
+        rules = compileIpv4Lpm(topo)
+        sizes = tableSizes(p4info_helper, bmv2_file_path)
+        # p4info、BMv2 JSON、拓扑文件、本控制器和规则编译代码都没变时，直接使用上次编码好的规则包，不再逐条编码
+        key = bundleKey(p4info_file_path, (bmv2_file_path, topo_file_path,
+                                           os.path.abspath(__file__)))
+        bundle = RuleBundle.load(bundle_path, key) if bundle_path else None
+        if bundle is None:
+            for sw in (s1, s2, s3):
+                writeRules(p4info_helper, writer.wrap(sw), rules[sw.name])
+                swtraceRules(p4info_helper, writer.wrap(sw), switchNumber(sw.name))
+
+            # 下发前按BMv2 JSON中的表大小检查待写的表项能否装下，装不下就一条都不写
+            checkPending(writer, [s1, s2, s3], sizes)
+            if bundle_path:
+                RuleBundle.fromWriter(key, writer, [s1, s2, s3], WRITE_BATCH_SIZE).save(bundle_path)
+
+        # 各交换机并行完成仲裁(MasterArbitrationUpdate)、下发P4程序，
+        # 再把上面的规则与交换机上已有的表项比对，只写入需要增删改的条目
+        bring_up([s1, s2, s3], p4info_helper, bmv2_file_path,
+                 install_rules=bundle.installer(writer, sizes) if bundle
+                 else installer(writer, sizes=sizes))
 
     except KeyboardInterrupt:
         print(" Shutting down.")
     except grpc.RpcError as e:
         printGrpcError(e)
+    except BringUpError as e:
+        print(e)
+    except CapacityError as e:
+        print(e)
 
     ShutdownAllSwitchConnections()
+    dump.close()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='P4Runtime Controller')
@@ -137,6 +120,21 @@ if __name__ == '__main__':
     parser.add_argument('--bmv2-json', help='BMv2 JSON file from p4c',
                         type=str, action="store", required=False,
                         default='./build/mri.json')
+    parser.add_argument('--topo', help='Topology file the forwarding rules are computed from',
+                        type=str, action="store", required=False,
+                        default='./topology.json')
+    parser.add_argument('--log', help='P4Runtime message log: off, binary (buffered, '
+                        'render with utils/p4runtime_ext/dump.py) or text',
+                        type=str, action="store", required=False,
+                        choices=LOG_MODES, default=LOG_OFF)
+    parser.add_argument('--log-sample', help='Fraction of messages kept in the binary log',
+                        type=float, action="store", required=False, default=1.0)
+    parser.add_argument('--bundle', help='Rule bundle: the encoded rules are saved here and '
+                        'streamed back as they are while the inputs stay the same',
+                        type=str, action="store", required=False,
+                        default='./build/mri.rules.bundle')
+    parser.add_argument('--no-bundle', help='Build and encode the rules on every run',
+                        action="store_true", required=False)
     args = parser.parse_args()
 
     if not os.path.exists(args.p4info):
@@ -147,4 +145,9 @@ if __name__ == '__main__':
         parser.print_help()
         print("\nBMv2 JSON file not found: %s\nHave you run 'make'?" % args.bmv2_json)
         parser.exit(1)
-    main(args.p4info, args.bmv2_json)
+    if not os.path.exists(args.topo):
+        parser.print_help()
+        print("\nTopology file not found: %s" % args.topo)
+        parser.exit(1)
+    main(args.p4info, args.bmv2_json, args.topo, args.log, args.log_sample,
+         None if args.no_bundle else args.bundle)
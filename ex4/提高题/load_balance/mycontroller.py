@@ -4,15 +4,30 @@ import argparse
 import os
 import sys
 import grpc
-from time import sleep
 
 
 sys.path.append(
     os.path.join(os.path.dirname(os.path.abspath(__file__)),
                  '../../utils/'))
 import p4runtime_lib.bmv2
-import p4runtime_lib.helper
 from p4runtime_lib.switch import ShutdownAllSwitchConnections
+# p4runtime_ext lives in the utils dir at the top of this repository
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                 '../../../utils/'))
+from p4runtime_ext.batch import BatchWriter
+from p4runtime_ext.bringup import BringUpError, bring_up
+from p4runtime_ext.capacity import CapacityError, checkPending, tableSizes
+from p4runtime_ext.dump import LOG_MODES, LOG_OFF, MessageDump
+from p4runtime_ext.ecmp import DEFAULT_GROUP_SLOTS, EcmpManager, ElephantPinner, PortLoad
+from p4runtime_ext.helper import IndexedP4InfoHelper
+from p4runtime_ext.reconcile import installer
+from p4runtime_ext.runtime import ControllerRuntime
+from p4runtime_ext.sampler import INCOMING, PacketSampler, localInterfaces
+
+WRITE_BATCH_SIZE = 256   # 每个WriteRequest最多携带的update数
+REBALANCE_INTERVAL = 5   # 按链路负载调整ECMP权重的周期（秒）
+PIN_INTERVAL = 2         # 检测大象流并固定其槽位的周期（秒）
 
 
 # 定义规则
@@ -63,6 +78,43 @@ def sendframeRules(p4info_helper, engress_sw, egress_port, smac):
     print("Installed send_frame rule on %s" % engress_sw.name)
 
 
+def runEcmp(manager, switches, rebalance, pin, sample_every):
+    """
+    Runs until Ctrl-C. With rebalance, measures the load of every port used
+    by an ECMP group from sampled packets and moves weight to the idler
+    members; with pin, finds elephant flows in the packets the group
+    switches receive and pins their slots to the least loaded members.
+    """
+    runtime = ControllerRuntime(switches, max_workers=1)
+    samplers = []
+    if rebalance:
+        ifaces = {}
+        for group in manager.groups:
+            for port in group.ports():
+                ifaces["%s-eth%d" % (group.sw.name, port)] = (group.sw.name, port)
+        load = PortLoad(ifaces, sample_every)
+        samplers.append(PacketSampler(ifaces, load, sample_every=sample_every))
+        runtime.every(REBALANCE_INTERVAL, lambda: manager.rebalance(load.rates()))
+        print("Rebalancing ECMP weights every %ds from %s" % (REBALANCE_INTERVAL,
+                                                            ", ".join(sorted(ifaces))))
+    if pin:
+        ifaces = {}
+        for name in set(group.sw.name for group in manager.groups):
+            ifaces.update(localInterfaces(name))
+        pinner = ElephantPinner(manager)
+        samplers.append(PacketSampler(ifaces, pinner, sample_every=sample_every,
+                                      direction=INCOMING))
+        runtime.every(PIN_INTERVAL, pinner.tick)
+        print("Pinning elephant flows every %ds from %s" % (PIN_INTERVAL, ", ".join(sorted(ifaces))))
+    for sampler in samplers:
+        sampler.start()
+    try:
+        runtime.run()
+    finally:
+        for sampler in samplers:
+            sampler.stop()
+
+
 def printGrpcError(e):
     print("gRPC Error:", e.details(), end=' ')
     status_code = e.code()
@@ -71,9 +123,12 @@ def printGrpcError(e):
     print("[%s:%d]" % (traceback.tb_frame.f_code.co_filename, traceback.tb_lineno))
 
 
-def main(p4info_file_path, bmv2_file_path):
+def main(p4info_file_path, bmv2_file_path, log_mode, log_sample, group_slots, rebalance,
+         pin, sample_every):
     # Instantiate a P4Runtime helper from the p4info file初始化 p4info_helper
-    p4info_helper = p4runtime_lib.helper.P4InfoHelper(p4info_file_path)
+    p4info_helper = IndexedP4InfoHelper(p4info_file_path)
+    # P4Runtime消息转存默认关闭；binary为后台线程缓冲写入的二进制记录，text为原来的逐条文本日志
+    dump = MessageDump(log_mode, log_sample)
 
     try:
         # Create a switch connection object for s1 and s2;为s1、s2、s3创建交换机连接对象
@@ -83,64 +138,69 @@ def main(p4info_file_path, bmv2_file_path):
             name='s1',
             address='127.0.0.1:50051',
             device_id=0,
-            proto_dump_file='logs/s1-p4runtime-requests.txt')
+            proto_dump_file=dump.text_file('s1'))
         s2 = p4runtime_lib.bmv2.Bmv2SwitchConnection(
             name='s2',
             address='127.0.0.1:50052',
             device_id=1,
-            proto_dump_file='logs/s2-p4runtime-requests.txt')
+            proto_dump_file=dump.text_file('s2'))
         s3 = p4runtime_lib.bmv2.Bmv2SwitchConnection(
             name='s3',
             address='127.0.0.1:50053',
             device_id=2,
-            proto_dump_file='logs/s3-p4runtime-requests.txt')
-        # Send master arbitration update message to establish this controller as
-        # master (required by P4Runtime before performing any other write operation)
-        s1.MasterArbitrationUpdate()
-        s2.MasterArbitrationUpdate()
-        s3.MasterArbitrationUpdate()
-
-        # Install the P4 program on the switches在交换机上安装 P4 程序
-        s1.SetForwardingPipelineConfig(p4info=p4info_helper.p4info,
-                                       bmv2_json_file_path=bmv2_file_path)
-        print("Installed P4 Program using SetForwardingPipelineConfig on s1")
-        s2.SetForwardingPipelineConfig(p4info=p4info_helper.p4info,
-                                       bmv2_json_file_path=bmv2_file_path)
-        print("Installed P4 Program using SetForwardingPipelineConfig on s2")
-        s3.SetForwardingPipelineConfig(p4info=p4info_helper.p4info,
-                                       bmv2_json_file_path=bmv2_file_path)
-        print("Installed P4 Program using SetForwardingPipelineConfig on s3")
+            proto_dump_file=dump.text_file('s3'))
+        for sw in (s1, s2, s3):
+            dump.attach(sw)
+        # 规则先放入批量写缓冲区，等流水线下发后按交换机合并成多条update的WriteRequest下发
+        writer = BatchWriter(batch_size=WRITE_BATCH_SIZE, autoflush=False)
+        b1, b2, b3 = writer.wrap(s1), writer.wrap(s2), writer.wrap(s3)
+        # 加权ECMP组：每个成员按权重占若干个ecmp_nhop槽位，之后调整权重只改写换手的槽位
+        manager = EcmpManager(p4info_helper, writer, group_slots=group_slots)
 
         #s1
-        ecmpRules(p4info_helper, ingress_sw=s1, dst_ip_addr=["10.0.0.1",32], ecmp_base=0,
-                  ecmp_count=2)
-        nhopRules(p4info_helper, ingress_sw=s1, ecmp_select=0, nhop_dmac="00:00:00:00:01:02",
-                  nhop_ipv4="10.0.2.2", port=2)
-        nhopRules(p4info_helper, ingress_sw=s1, ecmp_select=1, nhop_dmac="00:00:00:00:01:03",
-                  nhop_ipv4="10.0.3.3", port=3)
-        sendframeRules(p4info_helper, engress_sw=s1, egress_port=2, smac="00:00:00:01:02:00")
-        sendframeRules(p4info_helper, engress_sw=s1, egress_port=3, smac="00:00:00:01:03:00")
+        manager.add_group(s1, ("10.0.0.1", 32), [("00:00:00:00:01:02", "10.0.2.2", 2),
+                                                 ("00:00:00:00:01:03", "10.0.3.3", 3)])
+        sendframeRules(p4info_helper, engress_sw=b1, egress_port=2, smac="00:00:00:01:02:00")
+        sendframeRules(p4info_helper, engress_sw=b1, egress_port=3, smac="00:00:00:01:03:00")
 
         #s2
-        ecmpRules(p4info_helper, ingress_sw=s2, dst_ip_addr=["10.0.2.2", 32], ecmp_base=0,
+        ecmpRules(p4info_helper, ingress_sw=b2, dst_ip_addr=["10.0.2.2", 32], ecmp_base=0,
                   ecmp_count=1)
-        nhopRules(p4info_helper, ingress_sw=s2, ecmp_select=0, nhop_dmac="00:00:00:00:02:02",
+        nhopRules(p4info_helper, ingress_sw=b2, ecmp_select=0, nhop_dmac="00:00:00:00:02:02",
                   nhop_ipv4="10.0.2.2", port=1)
-        sendframeRules(p4info_helper, engress_sw=s2, egress_port=1, smac="00:00:00:02:01:00")
+        sendframeRules(p4info_helper, engress_sw=b2, egress_port=1, smac="00:00:00:02:01:00")
 
         #s3
-        ecmpRules(p4info_helper, ingress_sw=s3, dst_ip_addr=["10.0.3.3", 32], ecmp_base=0,
+        ecmpRules(p4info_helper, ingress_sw=b3, dst_ip_addr=["10.0.3.3", 32], ecmp_base=0,
                   ecmp_count=1)
-        nhopRules(p4info_helper, ingress_sw=s3, ecmp_select=0, nhop_dmac="08:00:00:00:03:03",
+        nhopRules(p4info_helper, ingress_sw=b3, ecmp_select=0, nhop_dmac="08:00:00:00:03:03",
                   nhop_ipv4="10.0.3.3",port=1)
-        sendframeRules(p4info_helper, engress_sw=s3, egress_port=1, smac="00:00:00:03:01:00")
+        sendframeRules(p4info_helper, engress_sw=b3, egress_port=1, smac="00:00:00:03:01:00")
+
+        # 下发前按BMv2 JSON中的表大小检查待写的表项能否装下，装不下就一条都不写
+        sizes = tableSizes(p4info_helper, bmv2_file_path)
+        checkPending(writer, [s1, s2, s3], sizes)
+
+        # 各交换机并行完成仲裁(MasterArbitrationUpdate)、下发P4程序，
+        # 再把上面的规则与交换机上已有的表项比对，只写入需要增删改的条目
+        bring_up([s1, s2, s3], p4info_helper, bmv2_file_path,
+                 install_rules=installer(writer, sizes=sizes))
+
+        # 按s1出端口的实测负载周期性调整权重，并把相互碰撞的大象流所在槽位固定到较空闲的下一跳
+        if rebalance or pin:
+            runEcmp(manager, [s1, s2, s3], rebalance, pin, sample_every)
 
     except KeyboardInterrupt:
             print(" Shutting down.")
     except grpc.RpcError as e:
             printGrpcError(e)
+    except BringUpError as e:
+            print(e)
+    except CapacityError as e:
+            print(e)
 
     ShutdownAllSwitchConnections()
+    dump.close()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='P4Runtime Controller')
@@ -150,6 +210,23 @@ if __name__ == '__main__':
     parser.add_argument('--bmv2-json', help='BMv2 JSON file from p4c',
                         type=str, action="store", required=False,
                         default='./build/load_balance.json')
+    parser.add_argument('--log', help='P4Runtime message log: off, binary (buffered, '
+                        'render with utils/p4runtime_ext/dump.py) or text',
+                        type=str, action="store", required=False,
+                        choices=LOG_MODES, default=LOG_OFF)
+    parser.add_argument('--log-sample', help='Fraction of messages kept in the binary log',
+                        type=float, action="store", required=False, default=1.0)
+    parser.add_argument('--slots', help='ecmp_nhop slots per ECMP group (the weight resolution)',
+                        type=int, action="store", required=False, default=DEFAULT_GROUP_SLOTS)
+    parser.add_argument('--rebalance', help='Keep running: adjust the ECMP weights to the '
+                        'measured load of the member links',
+                        action="store_true", required=False)
+    parser.add_argument('--pin-elephants', help='Keep running: move elephant flows that share '
+                        'a next hop onto the less loaded ones',
+                        action="store_true", required=False)
+    parser.add_argument('--sample', help='Sample 1 in N packets when measuring link load '
+                        'or looking for elephant flows',
+                        type=int, action="store", required=False, default=1)
     args = parser.parse_args()
 
     if not os.path.exists(args.p4info):
@@ -160,4 +237,5 @@ if __name__ == '__main__':
         parser.print_help()
         print("\nBMv2 JSON file not found: %s\nHave you run 'make'?" % args.bmv2_json)
         parser.exit(1)
-    main(args.p4info, args.bmv2_json)
+    main(args.p4info, args.bmv2_json, args.log, args.log_sample, args.slots, args.rebalance,
+         args.pin_elephants, args.sample)
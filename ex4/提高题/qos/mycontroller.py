@@ -4,32 +4,33 @@ import argparse
 import os
 import sys
 import grpc
-from time import sleep
 
 
 sys.path.append(
     os.path.join(os.path.dirname(os.path.abspath(__file__)),
                  '../../utils/'))
 import p4runtime_lib.bmv2
-import p4runtime_lib.helper
 from p4runtime_lib.switch import ShutdownAllSwitchConnections
-
-
-# 定义规则
-def forwardRules(p4info_helper, ingress_sw, dst_eth_addr, dstAddr, port):
-    table_entry = p4info_helper.buildTableEntry(    # 使用p4info_helper解析器将规则转化为P4Runtime能够识别的形式
-        table_name="MyIngress.ipv4_lpm",            # 定义表名
-        match_fields={                              # 设置匹配域
-            "hdr.ipv4.dstAddr": dstAddr         # 包头对应的hdr.ipv4.dstAddr字段与参数中的dstAddr匹配，则执行这一条表项的对应动作
-        },
-        action_name="MyIngress.ipv4_forward",       # 设置匹配成功对应的动作名
-        action_params={                             # 动作参数
-            "dstAddr": dst_eth_addr,
-            "port": port
-        })
-    ingress_sw.WriteTableEntry(table_entry)         # 调用WriteTableEntry，将生成的匹配动作表项加入交换机
-    print("Installed ecmp rule on %s" % ingress_sw.name)
-
+# p4runtime_ext lives in the utils dir at the top of this repository
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                 '../../../utils/'))
+from p4runtime_ext.batch import BatchWriter
+from p4runtime_ext.bringup import BringUpError, bring_up
+from p4runtime_ext.bundle import RuleBundle, bundleKey
+from p4runtime_ext.capacity import CapacityError, checkPending, tableSizes
+from p4runtime_ext.compiler import compileIpv4Lpm
+from p4runtime_ext.dump import LOG_MODES, LOG_OFF, MessageDump
+from p4runtime_ext.helper import IndexedP4InfoHelper
+from p4runtime_ext.qos import ClassTelemetry, QosPolicy
+from p4runtime_ext.reconcile import installer
+from p4runtime_ext.rules import writeRules
+from p4runtime_ext.runtime import ControllerRuntime
+from p4runtime_ext.sampler import BOTH, PacketSampler, switchInterfaces
+from p4runtime_ext.topology import Topology
+
+WRITE_BATCH_SIZE = 256   # 每个WriteRequest最多携带的update数
+QOS_INTERVAL = 5         # 统计各类吞吐量与时延并执行策略的周期（秒）
 
 
 def printGrpcError(e):
@@ -40,9 +41,34 @@ def printGrpcError(e):
     print("[%s:%d]" % (traceback.tb_frame.f_code.co_filename, traceback.tb_lineno))
 
 
-def main(p4info_file_path, bmv2_file_path):
+def monitorQos(topo, p4info_helper, switches, writer, sample_every, delay_target):
+    """
+    Runs until Ctrl-C: prints the throughput and transit delay of every DSCP
+    class per switch, and remarks bulk classes where the latency-sensitive
+    ones suffer (see QosPolicy).
+    """
+    ifaces = switchInterfaces(topo, inter_switch_only=False)
+    telemetry = ClassTelemetry(ifaces, sample_every)
+    policy = QosPolicy(telemetry, p4info_helper, dict((sw.name, sw) for sw in switches), writer,
+                       delay_target=delay_target)
+    sampler = PacketSampler(ifaces, telemetry, sample_every=sample_every, direction=BOTH,
+                            ident=True)
+    sampler.start()
+    print("Monitoring QoS classes on %d ports (1 in %d packets)" % (len(ifaces), sample_every))
+    runtime = ControllerRuntime(switches, max_workers=1)
+    runtime.every(QOS_INTERVAL, policy.tick)
+    try:
+        runtime.run()
+    finally:
+        sampler.stop()
+
+
+def main(p4info_file_path, bmv2_file_path, topo_file_path, log_mode, log_sample,
+         monitor, sample_every, delay_target, bundle_path):
     # Instantiate a P4Runtime helper from the p4info file初始化 p4info_helper
-    p4info_helper = p4runtime_lib.helper.P4InfoHelper(p4info_file_path)
+    p4info_helper = IndexedP4InfoHelper(p4info_file_path)
+    # P4Runtime消息转存默认关闭；binary为后台线程缓冲写入的二进制记录，text为原来的逐条文本日志
+    dump = MessageDump(log_mode, log_sample)
 
     try:
         # Create a switch connection object for s1 and s2;为s1、s2、s3创建交换机连接对象
@@ -52,57 +78,60 @@ def main(p4info_file_path, bmv2_file_path):
             name='s1',
             address='127.0.0.1:50051',
             device_id=0,
-            proto_dump_file='logs/s1-p4runtime-requests.txt')
+            proto_dump_file=dump.text_file('s1'))
         s2 = p4runtime_lib.bmv2.Bmv2SwitchConnection(
             name='s2',
             address='127.0.0.1:50052',
             device_id=1,
-            proto_dump_file='logs/s2-p4runtime-requests.txt')
+            proto_dump_file=dump.text_file('s2'))
         s3 = p4runtime_lib.bmv2.Bmv2SwitchConnection(
             name='s3',
             address='127.0.0.1:50053',
             device_id=2,
-            proto_dump_file='logs/s3-p4runtime-requests.txt')
-        # Send master arbitration update message to establish this controller as
-        # master (required by P4Runtime before performing any other write operation)
-        s1.MasterArbitrationUpdate()
-        s2.MasterArbitrationUpdate()
-        s3.MasterArbitrationUpdate()
-
-        # Install the P4 program on the switches在交换机上安装 P4 程序
-        s1.SetForwardingPipelineConfig(p4info=p4info_helper.p4info,
-                                       bmv2_json_file_path=bmv2_file_path)
-        print("Installed P4 Program using SetForwardingPipelineConfig on s1")
-        s2.SetForwardingPipelineConfig(p4info=p4info_helper.p4info,
-                                       bmv2_json_file_path=bmv2_file_path)
-        print("Installed P4 Program using SetForwardingPipelineConfig on s2")
-        s3.SetForwardingPipelineConfig(p4info=p4info_helper.p4info,
-                                       bmv2_json_file_path=bmv2_file_path)
-        print("Installed P4 Program using SetForwardingPipelineConfig on s3")
-
-        #s1
-        forwardRules(p4info_helper, ingress_sw=s1, dst_eth_addr="08:00:00:00:01:01", dstAddr=["10.0.1.1",32], port=2)
-        forwardRules(p4info_helper, ingress_sw=s1, dst_eth_addr="08:00:00:00:01:11", dstAddr=["10.0.1.11",32], port=1)
-        forwardRules(p4info_helper, ingress_sw=s1, dst_eth_addr="08:00:00:00:02:00", dstAddr=["10.0.2.0",24], port=3)
-        forwardRules(p4info_helper, ingress_sw=s1, dst_eth_addr="08:00:00:00:03:00", dstAddr=["10.0.3.0",24], port=4)
-
-        #s2
-        forwardRules(p4info_helper, ingress_sw=s2, dst_eth_addr="08:00:00:00:02:02", dstAddr=["10.0.2.2", 32], port=2)
-        forwardRules(p4info_helper, ingress_sw=s2, dst_eth_addr="08:00:00:00:02:22", dstAddr=["10.0.2.22", 32], port=1)
-        forwardRules(p4info_helper, ingress_sw=s2, dst_eth_addr="08:00:00:00:01:00", dstAddr=["10.0.1.0", 24], port=3)
-        forwardRules(p4info_helper, ingress_sw=s2, dst_eth_addr="08:00:00:00:03:00", dstAddr=["10.0.3.0", 24], port=4)
-
-        #s3
-        forwardRules(p4info_helper, ingress_sw=s3, dst_eth_addr="08:00:00:00:03:03", dstAddr=["10.0.3.3", 32], port=1)
-        forwardRules(p4info_helper, ingress_sw=s3, dst_eth_addr="08:00:00:00:01:00", dstAddr=["10.0.1.0", 24], port=2)
-        forwardRules(p4info_helper, ingress_sw=s3, dst_eth_addr="08:00:00:00:02:00", dstAddr=["10.0.2.0", 24], port=3)
+            proto_dump_file=dump.text_file('s3'))
+        for sw in (s1, s2, s3):
+            dump.attach(sw)
+        # 规则先放入批量写缓冲区，等流水线下发后按交换机合并成多条update的WriteRequest下发
+        writer = BatchWriter(batch_size=WRITE_BATCH_SIZE, autoflush=False)
+
+        # 由拓扑文件计算各交换机之间的最短路径，生成ipv4_lpm规则
+        topo = Topology.load(topo_file_path)
+        rules = compileIpv4Lpm(topo)
+        sizes = tableSizes(p4info_helper, bmv2_file_path)
+        # p4info、BMv2 JSON、拓扑文件、本控制器和规则编译代码都没变时，直接使用上次编码好的规则包，不再逐条编码
+        key = bundleKey(p4info_file_path, (bmv2_file_path, topo_file_path,
+                                           os.path.abspath(__file__)))
+        bundle = RuleBundle.load(bundle_path, key) if bundle_path else None
+        if bundle is None:
+            for sw in (s1, s2, s3):
+                writeRules(p4info_helper, writer.wrap(sw), rules[sw.name])
+
+            # 下发前按BMv2 JSON中的表大小检查待写的表项能否装下，装不下就一条都不写
+            checkPending(writer, [s1, s2, s3], sizes)
+            if bundle_path:
+                RuleBundle.fromWriter(key, writer, [s1, s2, s3], WRITE_BATCH_SIZE).save(bundle_path)
+
+        # 各交换机并行完成仲裁(MasterArbitrationUpdate)、下发P4程序，
+        # 再把上面的规则与交换机上已有的表项比对，只写入需要增删改的条目
+        bring_up([s1, s2, s3], p4info_helper, bmv2_file_path,
+                 install_rules=bundle.installer(writer, sizes) if bundle
+                 else installer(writer, sizes=sizes))
+
+        # 监控模式：按DSCP类统计吞吐量与交换机内时延，EF类时延超标时把批量类重标记为CS1
+        if monitor:
+            monitorQos(topo, p4info_helper, [s1, s2, s3], writer, sample_every, delay_target)
 
     except KeyboardInterrupt:
             print(" Shutting down.")
     except grpc.RpcError as e:
             printGrpcError(e)
+    except BringUpError as e:
+            print(e)
+    except CapacityError as e:
+            print(e)
 
     ShutdownAllSwitchConnections()
+    dump.close()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='P4Runtime Controller')
@@ -112,6 +141,29 @@ if __name__ == '__main__':
     parser.add_argument('--bmv2-json', help='BMv2 JSON file from p4c',
                         type=str, action="store", required=False,
                         default='./build/qos.json')
+    parser.add_argument('--topo', help='Topology file the forwarding rules are computed from',
+                        type=str, action="store", required=False,
+                        default='./topology.json')
+    parser.add_argument('--log', help='P4Runtime message log: off, binary (buffered, '
+                        'render with utils/p4runtime_ext/dump.py) or text',
+                        type=str, action="store", required=False,
+                        choices=LOG_MODES, default=LOG_OFF)
+    parser.add_argument('--log-sample', help='Fraction of messages kept in the binary log',
+                        type=float, action="store", required=False, default=1.0)
+    parser.add_argument('--monitor', help='Keep running: per-class throughput and delay, '
+                        'with bulk classes remarked when EF traffic is delayed',
+                        action="store_true", required=False)
+    parser.add_argument('--sample', help='Sample 1 in N packets (by IP ID) in the QoS monitor',
+                        type=int, action="store", required=False, default=1)
+    parser.add_argument('--delay-target', help='EF transit delay (ms) above which a switch '
+                        'counts as loaded',
+                        type=float, action="store", required=False, default=5.0)
+    parser.add_argument('--bundle', help='Rule bundle: the encoded rules are saved here and '
+                        'streamed back as they are while the inputs stay the same',
+                        type=str, action="store", required=False,
+                        default='./build/qos.rules.bundle')
+    parser.add_argument('--no-bundle', help='Build and encode the rules on every run',
+                        action="store_true", required=False)
     args = parser.parse_args()
 
     if not os.path.exists(args.p4info):
@@ -122,4 +174,10 @@ if __name__ == '__main__':
         parser.print_help()
         print("\nBMv2 JSON file not found: %s\nHave you run 'make'?" % args.bmv2_json)
         parser.exit(1)
-    main(args.p4info, args.bmv2_json)
+    if not os.path.exists(args.topo):
+        parser.print_help()
+        print("\nTopology file not found: %s" % args.topo)
+        parser.exit(1)
+    main(args.p4info, args.bmv2_json, args.topo, args.log, args.log_sample,
+         args.monitor, args.sample, args.delay_target / 1000.0,
+         None if args.no_bundle else args.bundle)
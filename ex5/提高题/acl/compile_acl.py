@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# 把s1-acl.policy中的访问控制策略编译成acl表项：写入运行时JSON（替换其中的MyIngress.acl条目），
+# 或用--install以批量写的方式增量同步到运行中的交换机
+import argparse
+import json
+import os
+import sys
+import grpc
+
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                 '../../utils/'))
+import p4runtime_lib.bmv2
+from p4runtime_lib.switch import ShutdownAllSwitchConnections
+# p4runtime_ext lives in the utils dir at the top of this repository
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                 '../../../utils/'))
+from p4runtime_ext.acl import AclPolicy, compileAcl
+from p4runtime_ext.batch import BatchWriter
+from p4runtime_ext.capacity import CapacityError, tableSizes
+from p4runtime_ext.compiler import tableMatchKinds
+from p4runtime_ext.helper import IndexedP4InfoHelper
+from p4runtime_ext.reconcile import reconcile
+from p4runtime_ext.rules import buildEntry
+
+ACL_TABLE = "MyIngress.acl"
+# acl.p4中acl表的匹配域与大小，没有p4info（尚未make）时使用
+ACL_MATCH_KINDS = {"hdr.ipv4.dstAddr": "ternary", "hdr.udp.dstPort": "ternary"}
+ACL_SIZE = 1024
+WRITE_BATCH_SIZE = 256   # 每个WriteRequest最多携带的update数
+
+
+def install(p4info_helper, table_entries, address, device_id):
+    """Reconciles the switch's tables with the runtime JSON entries, in batched writes."""
+    try:
+        s1 = p4runtime_lib.bmv2.Bmv2SwitchConnection(
+            name='s1',
+            address=address,
+            device_id=device_id)
+        s1.MasterArbitrationUpdate()
+        writer = BatchWriter(batch_size=WRITE_BATCH_SIZE, autoflush=False)
+        reconcile(writer, s1, [buildEntry(p4info_helper, rule) for rule in table_entries],
+                  sizes=tableSizes(p4info_helper))
+    except grpc.RpcError as e:
+        print("gRPC Error:", e.details(), "(%s)" % e.code().name)
+    except CapacityError as e:
+        print(e)
+    ShutdownAllSwitchConnections()
+
+
+def writeRuntime(runtime_file_path, runtime):
+    # 每个表项占一行，上万条表项时文件仍便于阅读和diff
+    lines = []
+    for key, value in runtime.items():
+        if key == "table_entries":
+            entries = ",\n".join("    %s" % json.dumps(rule) for rule in value)
+            lines.append('  "table_entries": [\n%s\n  ]' % entries)
+        else:
+            lines.append("  %s: %s" % (json.dumps(key), json.dumps(value)))
+    with open(runtime_file_path, 'w') as f:
+        f.write("{\n%s\n}\n" % ",\n".join(lines))
+
+
+def main(policy_file_path, runtime_file_path, p4info_file_path, install_to, device_id):
+    policy = AclPolicy.load(policy_file_path)
+    p4info_helper = None
+    if os.path.exists(p4info_file_path):
+        p4info_helper = IndexedP4InfoHelper(p4info_file_path)
+        match_kinds = tableMatchKinds(p4info_helper, ACL_TABLE)
+        # p4c writes the declared size; 0 means the target default (1024 on bmv2)
+        size = p4info_helper.get("tables", name=ACL_TABLE).size or ACL_SIZE
+    else:
+        print("p4info file not found: %s, using the acl table of acl.p4" % p4info_file_path)
+        match_kinds, size = ACL_MATCH_KINDS, ACL_SIZE
+    rules, stats = compileAcl(policy, match_kinds, table_name=ACL_TABLE, size=size)
+    print("%d policy rules -> %d entries (%d after expansion, %d shadowed, %d redundant), "
+          "%d/%d used" % (stats["rules"], stats["entries"], stats["expanded"], stats["shadowed"],
+                          stats["redundant"], stats["entries"], size))
+
+    with open(runtime_file_path, 'r') as f:
+        runtime = json.load(f)
+    runtime["table_entries"] = [rule for rule in runtime["table_entries"]
+                                if rule["table"] != ACL_TABLE] + rules
+    writeRuntime(runtime_file_path, runtime)
+    print("Wrote %s" % runtime_file_path)
+
+    if install_to:
+        if p4info_helper is None:
+            print("--install needs the p4info file, have you run 'make'?")
+            return
+        install(p4info_helper, runtime["table_entries"], install_to, device_id)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='ACL policy compiler')
+    parser.add_argument('--policy', help='ACL policy, one rule per line',
+                        type=str, action="store", required=False,
+                        default='./s1-acl.policy')
+    parser.add_argument('--runtime', help='Runtime JSON file whose acl entries are replaced',
+                        type=str, action="store", required=False,
+                        default='./s1-acl.json')
+    parser.add_argument('--p4info', help='p4info proto in text format from p4c',
+                        type=str, action="store", required=False,
+                        default='./build/acl.p4.p4info.txt')
+    parser.add_argument('--install', help='Also write the entries to the running switch at '
+                        'this gRPC address, e.g. 127.0.0.1:50051',
+                        type=str, action="store", required=False, default=None)
+    parser.add_argument('--device-id', help='Device ID of the switch',
+                        type=int, action="store", required=False, default=0)
+    args = parser.parse_args()
+
+    if not os.path.exists(args.policy):
+        parser.print_help()
+        print("\nPolicy file not found: %s" % args.policy)
+        parser.exit(1)
+    if not os.path.exists(args.runtime):
+        parser.print_help()
+        print("\nRuntime JSON file not found: %s" % args.runtime)
+        parser.exit(1)
+    try:
+        main(args.policy, args.runtime, args.p4info, args.install, args.device_id)
+    except ValueError as e:
+        print(e)
+        parser.exit(1)
@@ -4,48 +4,58 @@ import argparse
 import os
 import sys
 import grpc
-from time import sleep
 
 
 sys.path.append(
     os.path.join(os.path.dirname(os.path.abspath(__file__)),
                  '../../utils/'))
 import p4runtime_lib.bmv2
-import p4runtime_lib.helper
 from p4runtime_lib.switch import ShutdownAllSwitchConnections
-
-
-# 定义规则
-def forwardRules(p4info_helper, ingress_sw, dst_eth_addr, dstAddr, port):
-    table_entry = p4info_helper.buildTableEntry(    # 使用p4info_helper解析器将规则转化为P4Runtime能够识别的形式
-        table_name="MyIngress.ipv4_lpm",            # 定义表名
-        match_fields={                              # 设置匹配域
-            "hdr.ipv4.dstAddr": dstAddr         # 包头对应的hdr.ipv4.dstAddr字段与参数中的dstAddr匹配，则执行这一条表项的对应动作
-        },
-        action_name="MyIngress.ipv4_forward",       # 设置匹配成功对应的动作名
-        action_params={                             # 动作参数
-            "dstAddr": dst_eth_addr,
-            "port": port
-        })
-    ingress_sw.WriteTableEntry(table_entry)         # 调用WriteTableEntry，将生成的匹配动作表项加入交换机
-    print("Installed forward rule on %s" % ingress_sw.name)
-
-
-def checkPortsRules(p4info_helper, ingress_sw, ingress_port, egress_spec, dir):
-    table_entry = p4info_helper.buildTableEntry(    # 使用p4info_helper解析器将规则转化为P4Runtime能够识别的形式
-        table_name="MyIngress.check_ports",            # 定义表名
-        match_fields={                              # 设置匹配域
-            "standard_metadata.ingress_port": ingress_port,
-            # 包头对应的standard_metadata.ingress_port字段与参数中的ingress_port匹配，则执行这一条表项的对应动作
-            "standard_metadata.egress_spec": egress_spec
-            # 包头对应的standard_metadata.egress_spec字段与参数中的egress_spec匹配，则执行这一条表项的对应动作
-            },
-        action_name="MyIngress.set_direction",       # 设置匹配成功对应的动作名
-        action_params={                             # 动作参数
-            "dir": dir
-        })
-    ingress_sw.WriteTableEntry(table_entry)         # 调用WriteTableEntry，将生成的匹配动作表项加入交换机
-    print("Installed check port rule on %s" % ingress_sw.name)
+# p4runtime_ext lives in the utils dir at the top of this repository
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                 '../../../utils/'))
+from p4runtime_ext.batch import BatchWriter
+from p4runtime_ext.bloom import ConnectionTracker
+from p4runtime_ext.bringup import BringUpError, bring_up
+from p4runtime_ext.bundle import RuleBundle, bundleKey
+from p4runtime_ext.capacity import CapacityError, checkPending, tableSizes
+from p4runtime_ext.compiler import compileCheckPorts, compileIpv4Lpm, tableMatchKinds
+from p4runtime_ext.dump import LOG_MODES, LOG_OFF, MessageDump
+from p4runtime_ext.helper import IndexedP4InfoHelper
+from p4runtime_ext.reconcile import installer
+from p4runtime_ext.rules import writeRules
+from p4runtime_ext.runtime import ControllerRuntime
+from p4runtime_ext.sampler import INCOMING, PacketSampler, switchInterfaces
+from p4runtime_ext.topology import Topology
+
+WRITE_BATCH_SIZE = 256   # 每个WriteRequest最多携带的update数
+CHECK_PORTS_TABLE = "MyIngress.check_ports"
+TRACK_INTERVAL = 30      # 读取并老化Bloom过滤器的周期（秒）
+
+
+def trackConnections(topo, p4info_helper, firewall, switches, writer, internal_ports,
+                     idle_timeout, sample_every):
+    """
+    Runs until Ctrl-C: follows the TCP connections through the firewall
+    switch and ages the cells of idle ones out of its Bloom filters.
+    """
+    tracker = ConnectionTracker(p4info_helper, firewall, writer, internal_ports,
+                                idle_timeout=idle_timeout)
+    ifaces = dict((iface, key) for iface, key in
+                  switchInterfaces(topo, inter_switch_only=False).items()
+                  if key[0] == firewall.name)
+    sampler = PacketSampler(ifaces, tracker.handler(ifaces), sample_every=sample_every,
+                            direction=INCOMING)
+    sampler.start()
+    print("Tracking connections through %s every %ds (idle timeout %ds)"
+          % (firewall.name, TRACK_INTERVAL, idle_timeout))
+    runtime = ControllerRuntime(switches, max_workers=1)
+    runtime.every(TRACK_INTERVAL, tracker.tick)
+    try:
+        runtime.run()
+    finally:
+        sampler.stop()
 
 
 def printGrpcError(e):
@@ -56,9 +66,12 @@ def printGrpcError(e):
     print("[%s:%d]" % (traceback.tb_frame.f_code.co_filename, traceback.tb_lineno))
 
 
-def main(p4info_file_path, bmv2_file_path):
+def main(p4info_file_path, bmv2_file_path, topo_file_path, log_mode, log_sample,
+         track, idle_timeout, sample_every, bundle_path):
     # Instantiate a P4Runtime helper from the p4info file初始化 p4info_helper
-    p4info_helper = p4runtime_lib.helper.P4InfoHelper(p4info_file_path)
+    p4info_helper = IndexedP4InfoHelper(p4info_file_path)
+    # P4Runtime消息转存默认关闭；binary为后台线程缓冲写入的二进制记录，text为原来的逐条文本日志
+    dump = MessageDump(log_mode, log_sample)
 
     try:
         # Create a switch connection object for s1 and s2;为s1、s2、s3创建交换机连接对象
@@ -68,81 +81,74 @@ def main(p4info_file_path, bmv2_file_path):
             name='s1',
             address='127.0.0.1:50051',
             device_id=0,
-            proto_dump_file='logs/s1-p4runtime-requests.txt')
+            proto_dump_file=dump.text_file('s1'))
         s2 = p4runtime_lib.bmv2.Bmv2SwitchConnection(
             name='s2',
             address='127.0.0.1:50052',
             device_id=1,
-            proto_dump_file='logs/s2-p4runtime-requests.txt')
+            proto_dump_file=dump.text_file('s2'))
         s3 = p4runtime_lib.bmv2.Bmv2SwitchConnection(
             name='s3',
             address='127.0.0.1:50053',
             device_id=2,
-            proto_dump_file='logs/s3-p4runtime-requests.txt')
+            proto_dump_file=dump.text_file('s3'))
         s4 = p4runtime_lib.bmv2.Bmv2SwitchConnection(
             name='s4',
             address='127.0.0.1:50054',
             device_id=3,
-            proto_dump_file='logs/s4-p4runtime-requests.txt')
-        # Send master arbitration update message to establish this controller as
-        # master (required by P4Runtime before performing any other write operation)
-        s1.MasterArbitrationUpdate()
-        s2.MasterArbitrationUpdate()
-        s3.MasterArbitrationUpdate()
-        s4.MasterArbitrationUpdate()
-
-        # Install the P4 program on the switches在交换机上安装 P4 程序
-        s1.SetForwardingPipelineConfig(p4info=p4info_helper.p4info,
-                                       bmv2_json_file_path=bmv2_file_path)
-        print("Installed P4 Program using SetForwardingPipelineConfig on s1")
-        s2.SetForwardingPipelineConfig(p4info=p4info_helper.p4info,
-                                       bmv2_json_file_path=bmv2_file_path)
-        print("Installed P4 Program using SetForwardingPipelineConfig on s2")
-        s3.SetForwardingPipelineConfig(p4info=p4info_helper.p4info,
-                                       bmv2_json_file_path=bmv2_file_path)
-        print("Installed P4 Program using SetForwardingPipelineConfig on s3")
-        s4.SetForwardingPipelineConfig(p4info=p4info_helper.p4info,
-                                       bmv2_json_file_path=bmv2_file_path)
-        print("Installed P4 Program using SetForwardingPipelineConfig on s4")
-
-        #s1
-        checkPortsRules(p4info_helper, ingress_sw=s1, ingress_port=1, egress_spec=3, dir=0)
-        checkPortsRules(p4info_helper, ingress_sw=s1, ingress_port=1, egress_spec=4, dir=0)
-        checkPortsRules(p4info_helper, ingress_sw=s1, ingress_port=2, egress_spec=3, dir=0)
-        checkPortsRules(p4info_helper, ingress_sw=s1, ingress_port=2, egress_spec=4, dir=0)
-        checkPortsRules(p4info_helper, ingress_sw=s1, ingress_port=3, egress_spec=1, dir=1)
-        checkPortsRules(p4info_helper, ingress_sw=s1, ingress_port=3, egress_spec=2, dir=1)
-        checkPortsRules(p4info_helper, ingress_sw=s1, ingress_port=4, egress_spec=1, dir=1)
-        checkPortsRules(p4info_helper, ingress_sw=s1, ingress_port=4, egress_spec=2, dir=1)
-        forwardRules(p4info_helper, ingress_sw=s1, dst_eth_addr="08:00:00:00:01:11", dstAddr=["10.0.1.1", 32], port=1)
-        forwardRules(p4info_helper, ingress_sw=s1, dst_eth_addr="08:00:00:00:02:22", dstAddr=["10.0.2.2", 32], port=2)
-        forwardRules(p4info_helper, ingress_sw=s1, dst_eth_addr="08:00:00:00:03:00", dstAddr=["10.0.3.3", 32], port=3)
-        forwardRules(p4info_helper, ingress_sw=s1, dst_eth_addr="08:00:00:00:04:00", dstAddr=["10.0.4.4", 32], port=4)
-
-        #s2
-        forwardRules(p4info_helper, ingress_sw=s2, dst_eth_addr="08:00:00:00:03:00", dstAddr=["10.0.1.1", 32], port=4)
-        forwardRules(p4info_helper, ingress_sw=s2, dst_eth_addr="08:00:00:00:04:00", dstAddr=["10.0.2.2", 32], port=3)
-        forwardRules(p4info_helper, ingress_sw=s2, dst_eth_addr="08:00:00:00:03:33", dstAddr=["10.0.3.3", 32], port=1)
-        forwardRules(p4info_helper, ingress_sw=s2, dst_eth_addr="08:00:00:00:04:44", dstAddr=["10.0.4.4", 32], port=2)
-
-        #s3
-        forwardRules(p4info_helper, ingress_sw=s3, dst_eth_addr="08:00:00:00:01:00", dstAddr=["10.0.1.1", 32], port=1)
-        forwardRules(p4info_helper, ingress_sw=s3, dst_eth_addr="08:00:00:00:01:00", dstAddr=["10.0.2.2", 32], port=1)
-        forwardRules(p4info_helper, ingress_sw=s3, dst_eth_addr="08:00:00:00:02:00", dstAddr=["10.0.3.3", 32], port=2)
-        forwardRules(p4info_helper, ingress_sw=s3, dst_eth_addr="08:00:00:00:02:00", dstAddr=["10.0.4.4", 32], port=2)
-        #s4
-        forwardRules(p4info_helper, ingress_sw=s4, dst_eth_addr="08:00:00:00:01:00", dstAddr=["10.0.1.1", 32], port=2)
-        forwardRules(p4info_helper, ingress_sw=s4, dst_eth_addr="08:00:00:00:01:00", dstAddr=["10.0.2.2", 32], port=2)
-        forwardRules(p4info_helper, ingress_sw=s4, dst_eth_addr="08:00:00:00:02:00", dstAddr=["10.0.3.3", 32], port=1)
-        forwardRules(p4info_helper, ingress_sw=s4, dst_eth_addr="08:00:00:00:02:00", dstAddr=["10.0.4.4", 32], port=1)
-
+            proto_dump_file=dump.text_file('s4'))
+        for sw in (s1, s2, s3, s4):
+            dump.attach(sw)
+        # 规则先放入批量写缓冲区，等流水线下发后按交换机合并成多条update的WriteRequest下发
+        writer = BatchWriter(batch_size=WRITE_BATCH_SIZE, autoflush=False)
+        # 由拓扑文件计算各交换机之间的最短路径，生成ipv4_lpm规则
+        topo = Topology.load(topo_file_path)
+        rules = compileIpv4Lpm(topo)
+        sizes = tableSizes(p4info_helper, bmv2_file_path)
+        # p4info、BMv2 JSON、拓扑文件、本控制器和规则编译代码都没变时，直接使用上次编码好的规则包，不再逐条编码
+        key = bundleKey(p4info_file_path, (bmv2_file_path, topo_file_path,
+                                           os.path.abspath(__file__)))
+        bundle = RuleBundle.load(bundle_path, key) if bundle_path else None
+        if bundle is None:
+            for sw in (s1, s2, s3, s4):
+                writeRules(p4info_helper, writer.wrap(sw), rules[sw.name])
+
+            # check_ports规则由拓扑文件中各端口的internal/external角色生成，
+            # 表支持ternary/range匹配时用掩码或区间合并端口，否则逐端口写exact条目
+            check_ports = compileCheckPorts(topo, tableMatchKinds(p4info_helper, CHECK_PORTS_TABLE),
+                                            table_name=CHECK_PORTS_TABLE)
+            for sw in (s1, s2, s3, s4):
+                if sw.name in check_ports:
+                    writeRules(p4info_helper, writer.wrap(sw), check_ports[sw.name])
+
+            # 下发前按BMv2 JSON中的表大小检查待写的表项能否装下，装不下就一条都不写
+            checkPending(writer, [s1, s2, s3, s4], sizes)
+            if bundle_path:
+                RuleBundle.fromWriter(key, writer, [s1, s2, s3, s4], WRITE_BATCH_SIZE).save(bundle_path)
+
+        # 各交换机并行完成仲裁(MasterArbitrationUpdate)、下发P4程序，
+        # 再把上面的规则与交换机上已有的表项比对，只写入需要增删改的条目
+        bring_up([s1, s2, s3, s4], p4info_helper, bmv2_file_path,
+                 install_rules=bundle.installer(writer, sizes) if bundle
+                 else installer(writer, sizes=sizes))
+
+        # 连接跟踪：按s1的internal端口区分连接方向，定期清除空闲连接在Bloom过滤器中占用的比特
+        if track:
+            internal = [port for port, role in topo.port_roles('s1').items() if role == "internal"]
+            trackConnections(topo, p4info_helper, s1, [s1, s2, s3, s4], writer, internal,
+                             idle_timeout, sample_every)
 
     except KeyboardInterrupt:
             print(" Shutting down.")
     except grpc.RpcError as e:
             printGrpcError(e)
+    except BringUpError as e:
+            print(e)
+    except CapacityError as e:
+            print(e)
 
     ShutdownAllSwitchConnections()
+    dump.close()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='P4Runtime Controller')
@@ -152,6 +158,29 @@ if __name__ == '__main__':
     parser.add_argument('--bmv2-json', help='BMv2 JSON file from p4c',
                         type=str, action="store", required=False,
                         default='./build/firewall.json')
+    parser.add_argument('--topo', help='Topology file the forwarding rules are computed from',
+                        type=str, action="store", required=False,
+                        default='./pod-topo/topology.json')
+    parser.add_argument('--log', help='P4Runtime message log: off, binary (buffered, '
+                        'render with utils/p4runtime_ext/dump.py) or text',
+                        type=str, action="store", required=False,
+                        choices=LOG_MODES, default=LOG_OFF)
+    parser.add_argument('--log-sample', help='Fraction of messages kept in the binary log',
+                        type=float, action="store", required=False, default=1.0)
+    parser.add_argument('--track', help='Keep running: track connections and age idle ones '
+                        'out of the Bloom filters',
+                        action="store_true", required=False)
+    parser.add_argument('--idle-timeout', help='Seconds without a packet before a connection '
+                        'is forgotten',
+                        type=float, action="store", required=False, default=120.0)
+    parser.add_argument('--sample', help='Sample 1 in N packets when tracking connections',
+                        type=int, action="store", required=False, default=1)
+    parser.add_argument('--bundle', help='Rule bundle: the encoded rules are saved here and '
+                        'streamed back as they are while the inputs stay the same',
+                        type=str, action="store", required=False,
+                        default='./build/firewall.rules.bundle')
+    parser.add_argument('--no-bundle', help='Build and encode the rules on every run',
+                        action="store_true", required=False)
     args = parser.parse_args()
 
     if not os.path.exists(args.p4info):
@@ -162,4 +191,10 @@ if __name__ == '__main__':
         parser.print_help()
         print("\nBMv2 JSON file not found: %s\nHave you run 'make'?" % args.bmv2_json)
         parser.exit(1)
-    main(args.p4info, args.bmv2_json)
+    if not os.path.exists(args.topo):
+        parser.print_help()
+        print("\nTopology file not found: %s" % args.topo)
+        parser.exit(1)
+    main(args.p4info, args.bmv2_json, args.topo, args.log, args.log_sample,
+         args.track, args.idle_timeout, args.sample,
+         None if args.no_bundle else args.bundle)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# 按topology.json下发各交换机的运行时JSON：多进程并行解析并按p4info校验全部文件，有错误时一条都不写；
+# 通过后各交换机并行、批量写入，取代run_exercise中逐条写表项的做法。在练习目录下运行（与make run相同）
+import argparse
+import os
+import sys
+
+import grpc
+
+# p4runtime_lib comes with the tutorial, in the utils dir two levels above the exercise
+sys.path.append(os.path.join(os.getcwd(), '../../utils/'))
+import p4runtime_lib.bmv2
+from p4runtime_lib.switch import ShutdownAllSwitchConnections
+from p4runtime_ext.bringup import BringUpError
+from p4runtime_ext.capacity import CapacityError
+from p4runtime_ext.runtime_json import RuntimeValidationError, applyRuntimeFiles, loadRuntimeFiles
+from p4runtime_ext.topology import Topology
+
+WRITE_BATCH_SIZE = 256   # 每个WriteRequest最多携带的update数
+
+
+def main(topo_file_path, grpc_port, processes, timeout):
+    topo = Topology.load(topo_file_path)
+    # run_exercise按拓扑文件中交换机的顺序分配gRPC端口和device_id
+    switches = [(name, i) for i, name in enumerate(topo.switches)
+                if "runtime_json" in topo.switches[name]]
+    try:
+        loaded = loadRuntimeFiles([topo.switches[name]["runtime_json"] for name, _ in switches],
+                                  processes)
+    except RuntimeValidationError as e:
+        print(e)
+        return False
+    print("Loaded %d entries from %d runtime files" % (
+        sum(len(runtime.entries) for runtime in loaded.values()), len(loaded)))
+
+    try:
+        switch_files = []
+        for name, i in switches:
+            sw = p4runtime_lib.bmv2.Bmv2SwitchConnection(
+                name=name,
+                address='127.0.0.1:%d' % (grpc_port + i),
+                device_id=i)
+            switch_files.append((sw, loaded[topo.switches[name]["runtime_json"]]))
+        applyRuntimeFiles(switch_files, WRITE_BATCH_SIZE, timeout)
+        return True
+    except grpc.RpcError as e:
+        print("gRPC Error:", e.details(), "(%s)" % e.code().name)
+    except (BringUpError, CapacityError) as e:
+        print(e)
+    finally:
+        ShutdownAllSwitchConnections()
+    return False
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runtime JSON loader')
+    parser.add_argument('--topo', help='Topology file naming the runtime JSON of each switch',
+                        type=str, action="store", required=False,
+                        default='./topology.json')
+    parser.add_argument('--grpc-port', help='gRPC port of the first switch',
+                        type=int, action="store", required=False, default=50051)
+    parser.add_argument('--processes', help='Worker processes parsing the runtime files '
+                        '(default: one per file, up to the number of CPUs)',
+                        type=int, action="store", required=False, default=None)
+    parser.add_argument('--timeout', help='Seconds each switch gets to come up',
+                        type=float, action="store", required=False, default=30.0)
+    args = parser.parse_args()
+
+    if not os.path.exists(args.topo):
+        parser.print_help()
+        print("\nTopology file not found: %s" % args.topo)
+        parser.exit(1)
+    if not main(args.topo, args.grpc_port, args.processes, args.timeout):
+        parser.exit(1)
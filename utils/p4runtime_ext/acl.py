@@ -0,0 +1,401 @@
+# ACL编译器：把人写的访问控制策略（CIDR、端口区间、协议、allow/deny、先后顺序）编译成acl表的ternary/range条目，
+# 端口区间展开为最少的前缀，删除被遮蔽和多余的规则，自动分配优先级
+import bisect
+import ipaddress
+import itertools
+from collections import OrderedDict
+
+ALLOW = "allow"
+DENY = "deny"
+PROTOCOLS = {"icmp": 1, "tcp": 6, "udp": 17}
+
+# policy keyword -> (match field, width); %s is the transport header of the rule
+FIELDS = OrderedDict((
+    ("src", ("hdr.ipv4.srcAddr", 32)),
+    ("dst", ("hdr.ipv4.dstAddr", 32)),
+    ("proto", ("hdr.ipv4.protocol", 8)),
+    ("sport", ("hdr.%s.srcPort", 16)),
+    ("dport", ("hdr.%s.dstPort", 16)),
+))
+ADDRESS_FIELDS = ("hdr.ipv4.srcAddr", "hdr.ipv4.dstAddr")
+
+
+def prefixCover(lo, hi, width):
+    """
+    The fewest aligned blocks (prefixes) whose union is [lo, hi], as (lo, hi)
+    pairs: at most 2 * width - 2 of them.
+    """
+    blocks = []
+    while lo <= hi:
+        size = lo & -lo if lo else 1 << width
+        while size > hi - lo + 1:
+            size >>= 1
+        blocks.append((lo, lo + size - 1))
+        lo += size
+    return blocks
+
+
+def mergeIntervals(intervals):
+    """Sorted disjoint intervals with the union of intervals, adjacent ones joined."""
+    merged = []
+    for lo, hi in sorted(intervals):
+        if merged and lo <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], hi))
+        else:
+            merged.append((lo, hi))
+    return merged
+
+
+def _parseAddress(text):
+    if "-" in text:
+        first, last = text.split("-", 1)
+        lo, hi = int(ipaddress.IPv4Address(first)), int(ipaddress.IPv4Address(last))
+    else:
+        network = ipaddress.IPv4Network(text)
+        lo, hi = int(network.network_address), int(network.broadcast_address)
+    if lo > hi:
+        raise ValueError("empty address range %s" % text)
+    return lo, hi
+
+
+def _dotted(addr):
+    return "%d.%d.%d.%d" % (addr >> 24, addr >> 16 & 0xff, addr >> 8 & 0xff, addr & 0xff)
+
+
+def _parsePort(text):
+    first, _, last = text.partition("-")
+    lo, hi = int(first), int(last or first)
+    if not 0 <= lo <= hi <= 0xffff:
+        raise ValueError("bad port range %s" % text)
+    return lo, hi
+
+
+class AclRule(object):
+    """
+    One line of a policy: an action and, per policy keyword, the sorted
+    disjoint intervals it matches. Keywords left out match anything.
+    """
+
+    def __init__(self, action, fields, proto=None, line=None):
+        self.action = action
+        self.fields = fields    # keyword -> [(lo, hi)]
+        self.proto = proto      # "tcp", "udp", ... or None
+        self.line = line
+
+    def __repr__(self):
+        return "AclRule(%r, %r, line=%r)" % (self.action, self.fields, self.line)
+
+
+class AclPolicy(object):
+    """
+    An ordered access control policy, first match wins. The text format has
+    one rule per line, # starts a comment:
+
+        default allow
+        deny dst 10.0.1.4
+        deny udp dport 80
+        allow tcp src 10.0.1.0/24 dst 10.0.2.0/24,10.0.3.0/24 dport 1000-2000,443
+
+    A rule is allow or deny, an optional protocol (tcp, udp, icmp or a
+    number; sport and dport need tcp or udp), then src, dst (CIDRs, single
+    addresses or first-last ranges), sport and dport (ports or ranges), each
+    a comma separated list or any.
+    """
+
+    def __init__(self, rules, default=ALLOW):
+        self.rules = rules
+        self.default = default
+
+    @classmethod
+    def load(cls, policy_file_path):
+        with open(policy_file_path, 'r') as f:
+            return cls.parse(f)
+
+    @classmethod
+    def parse(cls, lines):
+        rules = []
+        default = ALLOW
+        for number, line in enumerate(lines, 1):
+            words = line.split("#", 1)[0].split()
+            if not words:
+                continue
+            try:
+                if words[0] == "default":
+                    if len(words) != 2 or words[1] not in (ALLOW, DENY):
+                        raise ValueError("expected 'default allow' or 'default deny'")
+                    default = words[1]
+                else:
+                    rules.append(cls._parse_rule(words, number))
+            except ValueError as e:
+                raise ValueError("line %d: %s" % (number, e))
+        return cls(rules, default)
+
+    @staticmethod
+    def _parse_rule(words, number):
+        action = words[0]
+        if action not in (ALLOW, DENY):
+            raise ValueError("a rule starts with allow or deny, not %r" % action)
+        words = words[1:]
+        proto = None
+        if words and words[0] not in FIELDS:
+            proto = words.pop(0)
+        elif words[:1] == ["proto"]:
+            proto = words[1] if len(words) > 1 else ""
+            words = words[2:]
+        fields = {}
+        if proto is not None and proto not in ("ip", "any"):
+            value = str(PROTOCOLS.get(proto, proto))
+            if not value.isdigit() or int(value) > 0xff:
+                raise ValueError("unknown protocol %r" % proto)
+            fields["proto"] = [(int(value), int(value))]
+        else:
+            proto = None
+        if len(words) % 2:
+            raise ValueError("%r has no value" % words[-1])
+        for keyword, value in zip(words[::2], words[1::2]):
+            if keyword not in FIELDS or keyword == "proto":
+                raise ValueError("unknown keyword %r" % keyword)
+            if keyword in fields:
+                raise ValueError("%s given twice" % keyword)
+            if value == "any":
+                continue
+            if keyword in ("sport", "dport") and proto not in ("tcp", "udp"):
+                raise ValueError("%s needs tcp or udp" % keyword)
+            parse = _parseAddress if keyword in ("src", "dst") else _parsePort
+            fields[keyword] = mergeIntervals(parse(item) for item in value.split(","))
+        return AclRule(action, fields, proto, number)
+
+
+class _PrefixIndex(object):
+    """
+    Cubes indexed by their interval on one field, which must be a prefix
+    (aligned block), so that the cubes whose interval contains or lies
+    inside a given prefix are found with a dict lookup or a bisect per
+    prefix length in use instead of a scan.
+    """
+
+    def __init__(self, field, width):
+        self.field = field
+        self.width = width
+        self._starts = {}       # prefix length -> start -> [position]
+        self._sorted = None     # prefix length -> sorted [(start, position)], built on demand
+
+    def _length(self, lo, hi):
+        return self.width - (hi - lo + 1).bit_length() + 1
+
+    def add(self, position, cube):
+        lo, hi = cube[self.field]
+        self._starts.setdefault(self._length(lo, hi), {}).setdefault(lo, []).append(position)
+        self._sorted = None
+
+    def containing(self, cube):
+        """Positions of the cubes whose prefix contains (or equals) the cube's."""
+        lo, hi = cube[self.field]
+        full = (1 << self.width) - 1
+        length = self._length(lo, hi)
+        for other, starts in self._starts.items():
+            if other <= length:
+                for position in starts.get(lo & (full ^ (full >> other)), ()):
+                    yield position
+
+    def overlapping(self, cube):
+        """Positions of the cubes whose prefix contains or lies inside the cube's."""
+        for position in self.containing(cube):
+            yield position
+        if self._sorted is None:
+            self._sorted = dict((length, sorted((lo, position) for lo, positions in starts.items()
+                                                for position in positions))
+                                for length, starts in self._starts.items())
+        lo, hi = cube[self.field]
+        length = self._length(lo, hi)
+        for other, entries in self._sorted.items():
+            if other > length:
+                i = bisect.bisect_left(entries, (lo, -1))
+                while i < len(entries) and entries[i][0] <= hi:
+                    yield entries[i][1]
+                    i += 1
+
+
+class _LinearIndex(object):
+    """Fallback when no field is a prefix: every cube is a candidate."""
+
+    def __init__(self):
+        self.positions = []
+
+    def add(self, position, cube):
+        self.positions.append(position)
+
+    def containing(self, cube):
+        return iter(self.positions)
+
+    overlapping = containing
+
+
+def _contains(outer, inner):
+    return all(o_lo <= i_lo and i_hi <= o_hi for (o_lo, o_hi), (i_lo, i_hi) in zip(outer, inner))
+
+
+def _overlaps(a, b):
+    return all(a_lo <= b_hi and b_lo <= a_hi for (a_lo, a_hi), (b_lo, b_hi) in zip(a, b))
+
+
+def compileAcl(policy, match_kinds, table_name="MyIngress.acl", deny_action="MyIngress.drop",
+               allow_action="NoAction", size=None):
+    """
+    Compiles a policy into entries of a table matching on some of the
+    FIELDS with ternary, lpm, range or exact match kinds.
+
+    Every rule becomes the cross product of its intervals: ternary and lpm
+    fields take the prefix cover of each interval, range fields the
+    intervals themselves, exact fields every value. The resulting cubes are
+    then pruned, in policy order:
+
+    - a cube inside an earlier cube is shadowed and dropped;
+    - a cube is redundant, and dropped, when every later cube overlapping
+      it up to the first one containing it (or the table default) has the
+      same action: packets falling through get the same verdict anyway.
+      This drops in particular trailing rules that repeat the default.
+
+    All entries of a rule share one priority, higher for earlier rules, so
+    the first match still wins on the switch. Port fields are those of the
+    rule's transport header (hdr.tcp or hdr.udp); when the table has no
+    hdr.ipv4.protocol field the protocol is implied by that header. The
+    pipeline leaves that header zeroed for other protocols, so a port range
+    including 0 would match them as well and raises ValueError instead.
+
+    :param policy: the AclPolicy
+    :param match_kinds: the table's match kinds, from tableMatchKinds()
+    :param size: table capacity; more entries raise ValueError before
+                 anything is written
+    :return: (rules, stats): the entries in the runtime JSON format, the
+             default action entry last, and a dict with the numbers of
+             policy rules, expanded, shadowed and redundant cubes and
+             entries
+    """
+    widths = {}     # match field -> width, for the fields the policy language knows
+    for field, width in FIELDS.values():
+        for name in ([field % proto for proto in ("tcp", "udp")] if "%s" in field else [field]):
+            if name in match_kinds:
+                widths[name] = width
+    keys = [field for field in match_kinds if field in widths]
+    for field, kind in match_kinds.items():
+        if field not in widths and kind == "exact":
+            raise ValueError("%s matches %s exactly, which the policy cannot express"
+                             % (table_name, field))
+
+    cubes = []      # (cube, rule)
+    for rule in policy.rules:
+        intervals = {}
+        for keyword, ranges in rule.fields.items():
+            field = FIELDS[keyword][0]
+            if "%s" in field:
+                field %= rule.proto
+            if field not in widths:
+                if keyword == "proto" and any(k in rule.fields for k in ("sport", "dport")):
+                    if any(rule.fields[k][0][0] == 0 for k in ("sport", "dport") if k in rule.fields):
+                        raise ValueError("line %s: %s has no %s field, port 0 would also match "
+                                         "packets other than %s" % (rule.line, table_name, field,
+                                                                    rule.proto))
+                    continue    # implied by the port fields' header
+                raise ValueError("line %s: %s has no %s field" % (rule.line, table_name, field))
+            intervals[field] = ranges
+        atoms = []
+        for field in keys:
+            kind = match_kinds[field]
+            full = (0, (1 << widths[field]) - 1)
+            ranges = intervals.get(field, [full])
+            if kind == "range":
+                atoms.append(ranges)
+            elif kind == "exact":
+                if field not in intervals:
+                    raise ValueError("line %s: %s matches %s exactly, a value is needed"
+                                     % (rule.line, table_name, field))
+                atoms.append([(v, v) for lo, hi in ranges for v in range(lo, hi + 1)])
+            else:
+                atoms.append([block for lo, hi in ranges
+                              for block in prefixCover(lo, hi, widths[field])])
+        for cube in itertools.product(*atoms):
+            cubes.append((cube, rule))
+
+    def newIndex():
+        for i, field in enumerate(keys):
+            if match_kinds[field] != "range":
+                return _PrefixIndex(i, widths[field])
+        return _LinearIndex()
+
+    # Shadowed: inside an earlier cube that is kept
+    kept = []
+    index = newIndex()
+    for position, (cube, rule) in enumerate(cubes):
+        if any(_contains(cubes[other][0], cube) for other in index.containing(cube)):
+            continue
+        index.add(position, cube)
+        kept.append(position)
+    shadowed = len(cubes) - len(kept)
+
+    # Redundant: falling through to the later cubes gives the same action
+    index = newIndex()
+    for position in kept:
+        index.add(position, cubes[position][0])
+    removed = set()
+    for position in reversed(kept):
+        cube, rule = cubes[position]
+        later = sorted(set(other for other in index.overlapping(cube)
+                           if other > position and other not in removed and
+                           _overlaps(cubes[other][0], cube)))
+        redundant = rule.action == policy.default
+        for other in later:
+            other_cube, other_rule = cubes[other]
+            if other_rule.action != rule.action:
+                redundant = False
+                break
+            if _contains(other_cube, cube):
+                redundant = True
+                break
+        if redundant:
+            removed.add(position)
+    survivors = [position for position in kept if position not in removed]
+
+    ranks = {}
+    for position in survivors:
+        ranks.setdefault(id(cubes[position][1]), len(ranks))
+    actions = {ALLOW: allow_action, DENY: deny_action}
+    rules = []
+    for position in survivors:
+        cube, rule = cubes[position]
+        match = {}
+        for field, (lo, hi) in zip(keys, cube):
+            kind = match_kinds[field]
+            if kind != "exact" and (lo, hi) == (0, (1 << widths[field]) - 1):
+                continue    # don't care
+            value = _dotted(lo) if field in ADDRESS_FIELDS else lo
+            if kind == "exact":
+                match[field] = value
+            elif kind == "range":
+                high = _dotted(hi) if field in ADDRESS_FIELDS else hi
+                match[field] = [value, high]
+            elif kind == "lpm":
+                match[field] = [value, widths[field] - (hi - lo + 1).bit_length() + 1]
+            else:
+                match[field] = [value, ((1 << widths[field]) - 1) ^ (hi - lo)]
+        entry = {
+            "table": table_name,
+            "match": match,
+            "action_name": actions[rule.action],
+            "action_params": {},
+        }
+        if any(match_kinds[field] != "exact" for field in keys):
+            entry["priority"] = len(ranks) - ranks[id(rule)]
+        rules.append(entry)
+    if size is not None and len(rules) > size:
+        raise ValueError("The policy needs %d entries in %s, which holds %d"
+                         % (len(rules), table_name, size))
+    rules.append({
+        "table": table_name,
+        "default_action": True,
+        "action_name": actions[policy.default],
+        "action_params": {},
+    })
+    stats = {"rules": len(policy.rules), "expanded": len(cubes), "shadowed": shadowed,
+             "redundant": len(removed), "entries": len(survivors)}
+    return rules, stats
@@ -0,0 +1,267 @@
+# 批量写P4Runtime表项：按交换机缓存Update，合并成多条update的WriteRequest下发
+import threading
+import time
+
+import grpc
+from google.rpc import code_pb2, status_pb2
+from p4.v1 import p4runtime_pb2
+
+DEFAULT_BATCH_SIZE = 256
+
+
+class BatchWriteError(Exception):
+    """Raised when one or more updates of a batched write were rejected.
+
+    :param switch_name: the switch the batch was sent to
+    :param failures: list of (update, p4.v1.Error) pairs, one per rejected update
+    """
+
+    def __init__(self, switch_name, failures):
+        self.switch_name = switch_name
+        self.failures = failures
+        super(BatchWriteError, self).__init__(switch_name, failures)
+
+    def __str__(self):
+        lines = ["%d update(s) rejected by %s:" % (len(self.failures), self.switch_name)]
+        for update, error in self.failures:
+            lines.append("  %s %s: %s (%s)" % (
+                p4runtime_pb2.Update.Type.Name(update.type),
+                describeEntity(update.entity),
+                code_pb2.Code.Name(error.canonical_code),
+                error.message))
+        return "\n".join(lines)
+
+
+class BatchAbortedError(BatchWriteError, grpc.RpcError):
+    """Raised when a Write call failed as a whole, without per-update
+    details (e.g. UNAVAILABLE or DEADLINE_EXCEEDED): the updates of that
+    batch and of the batches after it were not sent. Still a grpc.RpcError,
+    with the code and details of the failed call.
+
+    :param switch_name: the switch the batches were sent to
+    :param error: the grpc.RpcError of the failed call
+    :param rejected: (update, p4.v1.Error) for the updates the earlier batches had rejected
+    :param unsent: the updates that were not sent
+    """
+
+    def __init__(self, switch_name, error, rejected, unsent):
+        status = p4runtime_pb2.Error()
+        status.canonical_code = error.code().value[0]
+        status.message = error.details() or ""
+        super(BatchAbortedError, self).__init__(
+            switch_name, list(rejected) + [(update, status) for update in unsent])
+        self.error = error
+        self.rejected = list(rejected)
+        self.unsent = list(unsent)
+
+    def code(self):
+        return self.error.code()
+
+    def details(self):
+        return self.error.details()
+
+    def __str__(self):
+        lines = ["Write to %s failed: %s (%s), %d update(s) not sent" % (
+            self.switch_name, self.error.code().name, self.error.details(), len(self.unsent))]
+        if self.rejected:
+            lines.append(str(BatchWriteError(self.switch_name, self.rejected)))
+        return "\n".join(lines)
+
+
+def describeEntity(entity):
+    kind = entity.WhichOneof("entity")
+    if kind == "table_entry":
+        return "table_entry(table_id=%d)" % entity.table_entry.table_id
+    return kind
+
+
+def parseWriteErrors(e):
+    """
+    Extracts the per-update errors from a failed Write RPC.
+
+    P4Runtime reports them as a google.rpc.Status in the trailing metadata,
+    with one packed p4.v1.Error per update of the request (in order).
+    :param e: the grpc.RpcError raised by the Write call
+    :return: list of (index, p4.v1.Error) for the updates that failed, or
+             None if the error carries no per-update details
+    """
+    if e.code() != grpc.StatusCode.UNKNOWN:
+        return None
+    status = None
+    for key, value in e.trailing_metadata() or ():
+        if key == "grpc-status-details-bin":
+            status = status_pb2.Status()
+            status.ParseFromString(value)
+            break
+    if status is None or not status.details:
+        return None
+    errors = []
+    for index, detail in enumerate(status.details):
+        error = p4runtime_pb2.Error()
+        if not detail.Unpack(error):
+            return None
+        if error.canonical_code != code_pb2.OK:
+            errors.append((index, error))
+    return errors
+
+
+class BatchedSwitch(object):
+    """
+    Stands in for a SwitchConnection in the rule helpers: WriteTableEntry()
+    queues the entry on the BatchWriter instead of sending it right away.
+    Everything else is forwarded to the real connection.
+    """
+
+    def __init__(self, writer, sw):
+        self._writer = writer
+        self._sw = sw
+
+    def WriteTableEntry(self, table_entry, dry_run=False):
+        self._writer.add(self._sw, table_entry)
+
+    def __getattr__(self, attr):
+        return getattr(self._sw, attr)
+
+
+class BatchWriter(object):
+    """
+    Collects updates per switch and sends them as multi-update WriteRequests.
+
+    A switch's queue is flushed when it reaches batch_size updates, or when
+    its oldest queued update is older than flush_interval seconds (checked on
+    add() and poll()). Set autoflush=False to only send on flush().
+    """
+
+    def __init__(self, batch_size=DEFAULT_BATCH_SIZE, flush_interval=None,
+                 autoflush=True):
+        if batch_size < 1:
+            raise ValueError("batch_size must be positive, got %r" % batch_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.autoflush = autoflush
+        self._lock = threading.Lock()
+        self._switches = {}     # name -> switch connection
+        self._pending = {}      # name -> [Update]
+        self._since = {}        # name -> time the oldest pending update was queued
+
+    def wrap(self, sw):
+        return BatchedSwitch(self, sw)
+
+    def add(self, sw, table_entry, update_type=None):
+        """
+        Queues a table entry write for the switch.
+
+        :param sw: the switch connection
+        :param table_entry: the p4.v1.TableEntry to write
+        :param update_type: p4runtime_pb2.Update type; by default INSERT, or
+                            MODIFY for a default action entry
+        """
+        update = p4runtime_pb2.Update()
+        if update_type is not None:
+            update.type = update_type
+        elif table_entry.is_default_action:
+            update.type = p4runtime_pb2.Update.MODIFY
+        else:
+            update.type = p4runtime_pb2.Update.INSERT
+        update.entity.table_entry.CopyFrom(table_entry)
+        self.add_update(sw, update)
+
+    def add_update(self, sw, update):
+        with self._lock:
+            queue = self._pending.setdefault(sw.name, [])
+            if not queue:
+                self._since[sw.name] = time.time()
+            self._switches[sw.name] = sw
+            queue.append(update)
+            due = self.autoflush and self._due(sw.name)
+        if due:
+            self.flush(sw)
+
+    def pending(self, sw=None):
+        with self._lock:
+            if sw is not None:
+                return len(self._pending.get(sw.name, ()))
+            return sum(len(q) for q in self._pending.values())
+
+    def queued(self, sw):
+        """A copy of the updates queued for the switch, which stay queued."""
+        with self._lock:
+            return list(self._pending.get(sw.name, ()))
+
+    def take(self, sw):
+        """Removes and returns the updates queued for the switch, unsent."""
+        with self._lock:
+            self._since.pop(sw.name, None)
+            return self._pending.pop(sw.name, [])
+
+    def poll(self):
+        """Flushes every switch whose queue is due under the flush policy."""
+        with self._lock:
+            due = [self._switches[name] for name in self._pending if self._due(name)]
+        for sw in due:
+            self.flush(sw)
+
+    def _due(self, name):
+        queue = self._pending.get(name)
+        if not queue:
+            return False
+        if len(queue) >= self.batch_size:
+            return True
+        return (self.flush_interval is not None and
+                time.time() - self._since[name] >= self.flush_interval)
+
+    def flush(self, sw):
+        """
+        Sends all queued updates for the switch, batch_size updates per
+        WriteRequest. Batches that partly fail do not stop the remaining ones;
+        the rejected updates are reported together once all batches are sent.
+        A call that fails as a whole stops the flush, and the updates it did
+        not send are reported with the ones rejected so far.
+
+        :param sw: the switch connection
+        :return: the number of updates sent
+        :raises BatchWriteError: if the switch rejected any update
+        :raises BatchAbortedError: if a Write call failed as a whole
+        """
+        with self._lock:
+            queue = self._pending.pop(sw.name, [])
+            self._since.pop(sw.name, None)
+        failures = []
+        for start in range(0, len(queue), self.batch_size):
+            chunk = queue[start:start + self.batch_size]
+            request = p4runtime_pb2.WriteRequest()
+            request.device_id = sw.device_id
+            request.election_id.low = 1
+            request.updates.extend(chunk)
+            try:
+                sw.client_stub.Write(request)
+            except grpc.RpcError as e:
+                errors = parseWriteErrors(e)
+                if errors is None:
+                    raise BatchAbortedError(sw.name, e, failures, queue[start:])
+                failures.extend((chunk[index], error) for index, error in errors)
+        if queue:
+            print("Wrote %d update(s) to %s in %d batch(es)" % (
+                len(queue), sw.name, (len(queue) + self.batch_size - 1) // self.batch_size))
+        if failures:
+            raise BatchWriteError(sw.name, failures)
+        return len(queue)
+
+    def flush_all(self):
+        """
+        Flushes every switch with queued updates, one switch after another.
+        A switch rejecting updates does not stop the others from being flushed.
+
+        :raises BatchWriteError: covering the rejected updates of all switches
+        """
+        with self._lock:
+            switches = [self._switches[name] for name in self._pending]
+        names, failures = [], []
+        for sw in switches:
+            try:
+                self.flush(sw)
+            except BatchWriteError as e:
+                names.append(e.switch_name)
+                failures.extend(e.failures)
+        if failures:
+            raise BatchWriteError(", ".join(names), failures)
@@ -0,0 +1,159 @@
+# 防火墙连接跟踪：周期读取数据平面的Bloom过滤器寄存器，报告占用率与误判率，只清除不属于活跃连接的比特，过滤器不会悄悄饱和
+import threading
+import time
+
+from p4.v1 import p4runtime_pb2
+
+from .hashes import crc16, crc32, packFields
+
+BLOOM_REGISTERS = ("MyIngress.bloom_filter_1", "MyIngress.bloom_filter_2")
+TCP = 6
+
+
+def readRegister(sw, register_id, size):
+    """
+    Reads every cell of a register in one wildcard request.
+
+    :return: list of the cell values as ints, of length size
+    """
+    request = p4runtime_pb2.ReadRequest()
+    request.device_id = sw.device_id
+    request.entities.add().register_entry.register_id = register_id
+    values = [0] * size
+    for response in sw.client_stub.Read(request):
+        for entity in response.entities:
+            entry = entity.register_entry
+            if entry.index.index < size:
+                values[entry.index.index] = int.from_bytes(entry.data.bitstring, "big")
+    return values
+
+
+def clearUpdate(register_id, index):
+    update = p4runtime_pb2.Update()
+    update.type = p4runtime_pb2.Update.MODIFY
+    entry = update.entity.register_entry
+    entry.register_id = register_id
+    entry.index.index = index
+    entry.data.bitstring = b"\x00"
+    return update
+
+
+def bloomPositions(conn, sizes):
+    """
+    The cells the firewall pipeline sets for an outgoing connection:
+    crc16 and crc32 of (srcAddr, dstAddr, srcPort, dstPort, protocol), mod
+    the sizes of the two filters. Replies are hashed with the addresses and
+    ports swapped, which lands on the same cells.
+
+    :param conn: (src, dst, sport, dport) of the outgoing direction,
+                 addresses as 4-byte strings
+    """
+    src, dst, sport, dport = conn
+    data = packFields((src, 32), (dst, 32), (sport, 16), (dport, 16), (TCP, 8))
+    return crc16(data) % sizes[0], crc32(data) % sizes[1]
+
+
+class ConnectionTracker(object):
+    """
+    Keeps the firewall's Bloom filters from saturating.
+
+    The pipeline sets one cell in each filter on an outgoing SYN and never
+    clears them, so every connection ever opened stays admitted and the
+    false positive rate of unsolicited incoming packets only grows. The
+    tracker learns the live TCP connections from sampled packets (a
+    PacketSampler handler, see handler()) and every tick() reads both
+    registers and clears the cells set by connections idle for more than
+    idle_timeout seconds: the cells that were already set on the previous
+    tick (so a SYN sent since is never lost) and that no live connection
+    hashes to. A connection must be sampled at least once per idle_timeout
+    to be kept, so sample sparingly only with long timeouts.
+
+    With the filters' occupancies o1 and o2, an unrelated incoming flow is
+    admitted with probability o1 * o2, the false positive rate reported.
+    """
+
+    def __init__(self, p4info_helper, sw, writer, internal_ports, registers=BLOOM_REGISTERS,
+                 idle_timeout=120.0, max_fpr=0.01, max_connections=100000):
+        """
+        :param sw: the firewall switch connection
+        :param writer: the BatchWriter the clears are sent through
+        :param internal_ports: the switch ports facing the protected hosts
+        :param registers: names of the two filters, hashed with crc16 and crc32
+        """
+        self.sw = sw
+        self.writer = writer
+        self.internal_ports = set(internal_ports)
+        self.idle_timeout = idle_timeout
+        self.max_fpr = max_fpr
+        self.max_connections = max_connections
+        self.registers = []     # (name, id, size)
+        for name in registers:
+            register = p4info_helper.get("registers", name=name)
+            self.registers.append((name, register.preamble.id, register.size))
+        self.connections = {}   # (src, dst, sport, dport) outgoing -> last seen
+        self._previous = None   # cells set on the previous tick, per filter
+        self._lock = threading.Lock()
+
+    def handler(self, ifaces):
+        """
+        PacketSampler handler for the switch's interfaces, sampling INCOMING
+        packets: those entering on an internal port are outgoing connections.
+        """
+        ports = dict((iface, port) for iface, (name, port) in ifaces.items()
+                     if name == self.sw.name)
+        connections = self.connections
+        lock = self._lock
+
+        def onPacket(iface, t, flow, tos, length):
+            src, dst, proto, sport, dport = flow
+            port = ports.get(iface)
+            if proto != TCP or port is None:
+                return
+            if port in self.internal_ports:
+                conn = (src, dst, sport, dport)
+            else:
+                conn = (dst, src, dport, sport)
+            with lock:
+                if conn in connections or len(connections) < self.max_connections:
+                    connections[conn] = t
+        return onPacket
+
+    def tick(self):
+        filters = [readRegister(self.sw, register_id, size)
+                   for _, register_id, size in self.registers]
+        # Connections are listed after the read, so that a SYN seen meanwhile is kept
+        now = time.time()
+        with self._lock:
+            for conn, seen in list(self.connections.items()):
+                if now - seen > self.idle_timeout:
+                    del self.connections[conn]
+            live = list(self.connections)
+        sets = [set(i for i, v in enumerate(values) if v) for values in filters]
+        sizes = [size for _, _, size in self.registers]
+        keep = [set(), set()]
+        for conn in live:
+            for keep_cells, position in zip(keep, bloomPositions(conn, sizes)):
+                keep_cells.add(position)
+        cleared = 0
+        aged = self._previous is not None
+        if aged:
+            for (_, register_id, _), cells, previous, keep_cells in zip(
+                    self.registers, sets, self._previous, keep):
+                stale = (cells & previous) - keep_cells
+                for index in sorted(stale):
+                    self.writer.add_update(self.sw, clearUpdate(register_id, index))
+                cells -= stale
+                cleared += len(stale)
+            if cleared:
+                self.writer.flush(self.sw)
+        self._previous = sets
+        occupancy = [len(cells) / float(size) for cells, (_, _, size) in zip(sets, self.registers)]
+        fpr = occupancy[0] * occupancy[1]
+        print("%s firewall: %d live connection(s), filter occupancy %.1f%% / %.1f%%, "
+              "FPR %.4f%%, %d cell(s) cleared" % (self.sw.name, len(live), 100 * occupancy[0],
+                                                 100 * occupancy[1], 100 * fpr, cleared))
+        if aged and fpr > self.max_fpr:
+            print("%s firewall: FPR above %.2f%% with only live connections left, "
+                  "the filters are too small for this many connections"
+                  % (self.sw.name, 100 * self.max_fpr))
+        return fpr
@@ -0,0 +1,176 @@
+# 并行启动交换机：仲裁、下发P4程序、安装初始规则，每台交换机一个线程
+import threading
+import time
+from collections import OrderedDict
+
+import grpc
+from p4.v1 import p4runtime_pb2_grpc
+
+from .pipeline import ensurePipeline
+
+DEFAULT_TIMEOUT = 30.0   # seconds each switch gets to finish its bring-up
+
+
+class BringUpError(Exception):
+    """Raised by bring_up() when at least one switch failed or timed out."""
+
+    def __init__(self, report):
+        self.report = report
+        super(BringUpError, self).__init__(report)
+
+    def __str__(self):
+        return "Bring-up failed on %s" % ", ".join(sorted(self.report.failed))
+
+
+class BringUpCancelled(Exception):
+    """Raised by the calls of a switch whose bring-up timed out."""
+
+
+class CancelInterceptor(grpc.UnaryUnaryClientInterceptor,
+                        grpc.UnaryStreamClientInterceptor):
+    """
+    Fails every unary call (Write, Read, pipeline config) once cancel is set,
+    so that a switch left behind by bring_up() stops at its next batch.
+    """
+
+    def __init__(self, name, cancel):
+        self.name = name
+        self.cancel = cancel
+
+    def _check(self):
+        if self.cancel.is_set():
+            raise BringUpCancelled("Bring-up of %s was cancelled" % self.name)
+
+    def intercept_unary_unary(self, continuation, client_call_details, request):
+        self._check()
+        return continuation(client_call_details, request)
+
+    def intercept_unary_stream(self, continuation, client_call_details, request):
+        self._check()
+        return continuation(client_call_details, request)
+
+
+class BringUpReport(object):
+    """Outcome of a bring_up() call, per switch and in the order given."""
+
+    def __init__(self, names):
+        self.results = OrderedDict((name, None) for name in names)
+        self.reattached = set()   # switches that kept their running pipeline
+
+    def record(self, name, seconds, error=None):
+        if self.results[name] is None:
+            self.results[name] = (seconds, error)
+
+    @property
+    def failed(self):
+        return dict((name, result[1]) for name, result in self.results.items()
+                    if result is None or result[1] is not None)
+
+    @property
+    def ok(self):
+        return not self.failed
+
+    def print_summary(self):
+        print('\n----- Switch bring-up summary -----')
+        for name, result in self.results.items():
+            if result is None:
+                print(' %s: did not finish' % name)
+                continue
+            seconds, error = result
+            if error is None:
+                print(' %s: ok%s (%.2fs)' % (
+                    name, ', pipeline reattached' if name in self.reattached else '', seconds))
+            else:
+                print(' %s: FAILED after %.2fs: %s' % (name, seconds, error))
+
+
+def bringUpSwitch(sw, p4info_helper, bmv2_file_path, install_rules=None,
+                  reuse_pipeline=True):
+    """
+    Brings up a single switch: becomes master, pushes the P4 program and then
+    runs install_rules(sw), if given.
+
+    With reuse_pipeline, a switch already running the same program keeps it
+    along with its table state; install_rules still runs, so it should
+    reconcile with that state rather than insert blindly (see
+    reconcile.installer).
+    :return: True if the program was pushed
+    """
+    sw.MasterArbitrationUpdate()
+    if reuse_pipeline:
+        pushed = ensurePipeline(sw, p4info_helper.p4info, bmv2_file_path)
+    else:
+        sw.SetForwardingPipelineConfig(p4info=p4info_helper.p4info,
+                                       bmv2_json_file_path=bmv2_file_path)
+        print("Installed P4 Program using SetForwardingPipelineConfig on %s" % sw.name)
+        pushed = True
+    if install_rules is not None:
+        install_rules(sw)
+    return pushed
+
+
+def bring_up(switches, p4info_helper, bmv2_file_path, install_rules=None,
+             timeout=DEFAULT_TIMEOUT, reuse_pipeline=True, pipelines=None):
+    """
+    Brings up all switches concurrently, one thread per switch.
+
+    :param switches: the switch connections
+    :param p4info_helper: the P4Info helper
+    :param bmv2_file_path: the BMv2 JSON file to push
+    :param install_rules: optional callable(sw) run once the pipeline is in
+                          place, e.g. reconcile.installer(writer)
+    :param timeout: seconds each switch gets before it is reported as failed;
+                    its unary calls fail with BringUpCancelled from then on,
+                    so install_rules stops at its next batch (one already in
+                    flight may still land)
+    :param reuse_pipeline: skip the push on switches already running the
+                           program (see pipeline.ensurePipeline)
+    :param pipelines: dict switch name -> (p4info_helper, bmv2_file_path,
+                      install_rules) for switches running another program
+                      than the one given above
+    :return: the BringUpReport, after printing its summary
+    :raises BringUpError: if any switch failed or did not finish in time
+    """
+    report = BringUpReport([sw.name for sw in switches])
+    start = time.time()
+
+    pipelines = pipelines or {}
+    cancels = dict((sw.name, threading.Event()) for sw in switches)
+
+    def run(sw):
+        sw_p4info_helper, sw_bmv2_file_path, sw_install_rules = pipelines.get(
+            sw.name, (p4info_helper, bmv2_file_path, install_rules))
+        # Like MessageDump.attach; the stream channel stays on the plain channel
+        channel, client_stub = sw.channel, sw.client_stub
+        sw.channel = grpc.intercept_channel(channel, CancelInterceptor(sw.name, cancels[sw.name]))
+        sw.client_stub = p4runtime_pb2_grpc.P4RuntimeStub(sw.channel)
+        try:
+            pushed = bringUpSwitch(sw, sw_p4info_helper, sw_bmv2_file_path,
+                                   sw_install_rules, reuse_pipeline)
+        except Exception as e:
+            report.record(sw.name, time.time() - start, e)
+        else:
+            if not pushed:
+                report.reattached.add(sw.name)
+            report.record(sw.name, time.time() - start)
+        finally:
+            sw.channel, sw.client_stub = channel, client_stub
+
+    # Daemon threads, so that a switch that never answers cannot keep the
+    # controller from exiting.
+    threads = [threading.Thread(target=run, args=(sw,), name="bring-up-%s" % sw.name)
+               for sw in switches]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    deadline = start + timeout
+    for sw, thread in zip(switches, threads):
+        thread.join(max(0.0, deadline - time.time()))
+        if thread.is_alive():
+            cancels[sw.name].set()
+            report.record(sw.name, time.time() - start, "timed out")
+
+    report.print_summary()
+    if not report.ok:
+        raise BringUpError(report)
+    return report
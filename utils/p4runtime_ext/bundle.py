@@ -0,0 +1,211 @@
+# 预编译规则包：把控制器的全部规则按交换机编码成序列化的WriteRequest存盘，以p4info等输入文件的指纹为键；
+# 重启时直接把字节流发回交换机，不再重新解析拓扑、编码每条规则
+import hashlib
+import json
+import os
+import struct
+
+import grpc
+import p4runtime_lib
+from p4.v1 import p4runtime_pb2
+
+from .batch import BatchWriteError, parseWriteErrors
+from .reconcile import readEntries, reconcile
+
+MAGIC = b"P4RULES1"
+LENGTH = struct.Struct(">I")
+WRITE_METHOD = "/p4.v1.P4Runtime/Write"
+# The code that compiles and encodes the rules: this package and the
+# tutorial's p4runtime_lib, wherever the controller imported it from
+RULE_CODE_DIRS = (os.path.dirname(os.path.abspath(__file__)),
+                  os.path.dirname(os.path.abspath(p4runtime_lib.__file__)))
+
+
+def ruleCodeFiles():
+    """The Python sources of RULE_CODE_DIRS, in a fixed order."""
+    paths = []
+    for directory in RULE_CODE_DIRS:
+        paths.extend(os.path.join(directory, f) for f in sorted(os.listdir(directory))
+                     if f.endswith(".py"))
+    return paths
+
+
+def bundleKey(p4info_file_path, files=(), options=()):
+    """
+    Fingerprint of everything a rule set is compiled from: the p4info file,
+    the other input files (BMv2 JSON, topology, the controller itself), any
+    options that change the rules, the bundle format and the sources of the
+    rule compilers and encoders (see ruleCodeFiles), so that a fix there
+    rebuilds the bundles instead of replaying stale entries.
+
+    :return: the hex SHA-256 digest
+    """
+    digest = hashlib.sha256(MAGIC)
+    for path in (p4info_file_path,) + tuple(files) + tuple(ruleCodeFiles()):
+        with open(path, 'rb') as f:
+            data = f.read()
+        digest.update(LENGTH.pack(len(data)))
+        digest.update(data)
+    digest.update(json.dumps(list(options)).encode())
+    return digest.hexdigest()
+
+
+class RuleBundle(object):
+    """
+    The full rule set of a controller as serialized WriteRequests, per
+    switch, in the batches a BatchWriter would send.
+
+    A bundle is built once from the writer the rules were queued on
+    (fromWriter) and saved next to the compiled program. Later runs with the
+    same key load it and install it with installer(): a switch with empty
+    tables, e.g. after a restart, gets the bytes streamed back as they are,
+    with no rule built or encoded again; a switch that kept its entries is
+    reconciled with the bundled entries as usual.
+
+    File format: MAGIC, then length-prefixed records, a JSON header first
+    ({"key": ..., "switches": [[name, device_id, requests, updates], ...]})
+    and then the requests of each switch in order.
+    """
+
+    def __init__(self, key, switches):
+        """
+        :param switches: list of (switch name, device_id, [serialized WriteRequest], updates)
+        """
+        self.key = key
+        self.switches = dict((name, (device_id, requests, updates))
+                             for name, device_id, requests, updates in switches)
+        self._order = [name for name, _, _, _ in switches]
+
+    @classmethod
+    def fromWriter(cls, key, writer, switches, batch_size):
+        """Bundles the updates queued on the writer for each switch, which stay queued."""
+        bundled = []
+        for sw in switches:
+            queue = writer.queued(sw)
+            requests = []
+            for start in range(0, len(queue), batch_size):
+                request = p4runtime_pb2.WriteRequest()
+                request.device_id = sw.device_id
+                request.election_id.low = 1
+                request.updates.extend(queue[start:start + batch_size])
+                requests.append(request.SerializeToString())
+            bundled.append((sw.name, sw.device_id, requests, len(queue)))
+        return cls(key, bundled)
+
+    def save(self, path):
+        header = {"key": self.key,
+                  "switches": [[name, self.switches[name][0], len(self.switches[name][1]),
+                                self.switches[name][2]] for name in self._order]}
+        tmp = path + ".tmp"
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(tmp, 'wb') as f:
+            f.write(MAGIC)
+            for record in [json.dumps(header).encode()] + [
+                    request for name in self._order for request in self.switches[name][1]]:
+                f.write(LENGTH.pack(len(record)))
+                f.write(record)
+        os.replace(tmp, path)
+        print("Saved the rule bundle for %s to %s" % (", ".join(self._order), path))
+
+    @classmethod
+    def load(cls, path, key):
+        """:return: the bundle saved at path, or None if there is none for this key"""
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except IOError:
+            return None
+        if not data.startswith(MAGIC):
+            print("%s is not a rule bundle, ignoring it" % path)
+            return None
+        try:
+            header, switches = cls._parse(data)
+        except (ValueError, KeyError, TypeError, struct.error) as e:
+            print("Rule bundle %s is damaged (%s), rebuilding it" % (path, e))
+            return None
+        if header["key"] != key:
+            print("Rule bundle %s was built from other inputs, rebuilding it" % path)
+            return None
+        print("Loaded the rule bundle from %s" % path)
+        return cls(key, switches)
+
+    @staticmethod
+    def _parse(data):
+        offset = len(MAGIC)
+        records = []
+        while offset < len(data):
+            length, = LENGTH.unpack_from(data, offset)
+            offset += LENGTH.size
+            if offset + length > len(data):
+                raise ValueError("record %d runs past the end of the file" % len(records))
+            records.append(data[offset:offset + length])
+            offset += length
+        if not records:
+            raise ValueError("no header")
+        header = json.loads(records[0].decode())
+        if not isinstance(header, dict) or not isinstance(header["key"], str):
+            raise ValueError("bad header")
+        switches, start = [], 1
+        for name, device_id, count, updates in header["switches"]:
+            if not isinstance(count, int) or count < 0:
+                raise ValueError("bad request count %r for %s" % (count, name))
+            switches.append((name, device_id, records[start:start + count], updates))
+            start += count
+        if start != len(records):
+            raise ValueError("the header lists %d request(s), the file holds %d"
+                             % (start - 1, len(records) - 1))
+        return header, switches
+
+    def entries(self, name):
+        """The table entries bundled for a switch, decoded."""
+        entries = []
+        for data in self.switches[name][1]:
+            request = p4runtime_pb2.WriteRequest.FromString(data)
+            entries.extend(update.entity.table_entry for update in request.updates
+                           if update.entity.WhichOneof("entity") == "table_entry")
+        return entries
+
+    def stream(self, sw):
+        """
+        Sends the bundled requests of a switch as they are, through a Write
+        call that takes bytes.
+
+        :return: the number of updates sent
+        :raises BatchWriteError: if the switch rejected any update
+        """
+        device_id, requests, updates = self.switches[sw.name]
+        write = sw.channel.unary_unary(WRITE_METHOD, request_serializer=None,
+                                       response_deserializer=p4runtime_pb2.WriteResponse.FromString)
+        failures = []
+        for data in requests:
+            if device_id != sw.device_id:
+                request = p4runtime_pb2.WriteRequest.FromString(data)
+                request.device_id = sw.device_id
+                data = request.SerializeToString()
+            try:
+                write(data)
+            except grpc.RpcError as e:
+                errors = parseWriteErrors(e)
+                if errors is None:
+                    raise
+                request = p4runtime_pb2.WriteRequest.FromString(data)
+                failures.extend((request.updates[index], error) for index, error in errors)
+        print("Streamed %d update(s) to %s from the rule bundle in %d batch(es)"
+              % (updates, sw.name, len(requests)))
+        if failures:
+            raise BatchWriteError(sw.name, failures)
+        return updates
+
+    def installer(self, writer, sizes=None):
+        """
+        The install_rules hook for bring_up(): streams the bundle to a switch
+        with empty tables, reconciles one with entries (see reconcile.installer).
+        """
+        def install_rules(sw):
+            if not readEntries(sw):
+                self.stream(sw)
+            else:
+                reconcile(writer, sw, self.entries(sw.name), sizes=sizes)
+        return install_rules
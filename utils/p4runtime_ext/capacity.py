@@ -0,0 +1,171 @@
+# 表容量规划：从BMv2 JSON/p4info读出各表大小，统计交换机上已有的表项，写入前预测待下发的规则能否装下，
+# 不会写到一半才遇到RESOURCE_EXHAUSTED
+import json
+from collections import OrderedDict
+
+from p4.v1 import p4runtime_pb2
+
+DEFAULT_TABLE_SIZE = 1024   # what bmv2 gives a table declared without a size
+WARN_FRACTION = 0.9         # tables fuller than this are reported
+
+
+def tableSizes(p4info_helper, bmv2_file_path=None):
+    """
+    The capacity of every table of the program: max_size from the BMv2
+    JSON when given, which is what simple_switch allocates, otherwise the
+    size in the p4info (0 there means the target default).
+
+    :return: OrderedDict table id -> (name, size)
+    """
+    max_sizes = {}
+    if bmv2_file_path is not None:
+        with open(bmv2_file_path, 'r') as f:
+            for pipeline in json.load(f).get("pipelines", ()):
+                for table in pipeline.get("tables", ()):
+                    max_sizes[table["name"]] = table.get("max_size")
+    sizes = OrderedDict()
+    for table in p4info_helper.p4info.tables:
+        name = table.preamble.name
+        sizes[table.preamble.id] = (name, max_sizes.get(name) or table.size or DEFAULT_TABLE_SIZE)
+    return sizes
+
+
+class TableUsage(object):
+    """Entries of one table on one switch: installed, and after pending updates."""
+
+    def __init__(self, name, size, installed=0):
+        self.name = name
+        self.size = size
+        self.installed = installed
+        self.inserts = 0
+        self.deletes = 0
+
+    @property
+    def peak(self):
+        # Inserts are sent before deletes, see reconcile.diffEntries
+        return self.installed + self.inserts
+
+    @property
+    def final(self):
+        return self.installed + self.inserts - self.deletes
+
+    def __str__(self):
+        text = "%s: %d/%d (%.1f%%)" % (self.name, self.final, self.size,
+                                       100.0 * self.final / self.size)
+        if self.installed or self.deletes:
+            text += ", %d installed, +%d -%d" % (self.installed, self.inserts, self.deletes)
+        return text
+
+
+class CapacityReport(object):
+    """Table usage per switch, in the order added."""
+
+    def __init__(self):
+        self.usage = OrderedDict()      # (switch name, table id) -> TableUsage
+
+    def table(self, sw_name, table_id, sizes):
+        key = (sw_name, table_id)
+        if key not in self.usage:
+            name, size = sizes[table_id]
+            self.usage[key] = TableUsage(name, size)
+        return self.usage[key]
+
+    @property
+    def overflows(self):
+        """(switch, TableUsage) of the tables the pending updates do not fit in."""
+        return [(sw, usage) for (sw, _), usage in self.usage.items() if usage.final > usage.size]
+
+    @property
+    def tight(self):
+        """Tables that fit only if their deletes are sent before their inserts."""
+        return [(sw, usage) for (sw, _), usage in self.usage.items()
+                if usage.peak > usage.size >= usage.final]
+
+    @property
+    def ok(self):
+        return not self.overflows
+
+    def print_report(self, title="Table capacity"):
+        print('\n----- %s -----' % title)
+        for (sw, _), usage in self.usage.items():
+            flag = ""
+            if usage.final > usage.size:
+                flag = "  OVERFLOW"
+            elif usage.final >= WARN_FRACTION * usage.size:
+                flag = "  nearly full"
+            print(' %s %s%s' % (sw, usage, flag))
+
+
+class CapacityError(Exception):
+    """Raised before writing when pending entries do not fit in their tables."""
+
+    def __init__(self, report):
+        self.report = report
+        super(CapacityError, self).__init__(report)
+
+    def __str__(self):
+        lines = ["Pending entries do not fit:"]
+        for sw, usage in self.report.overflows:
+            lines.append("  %s %s, %d too many" % (sw, usage, usage.final - usage.size))
+        return "\n".join(lines)
+
+
+def checkPending(writer, switches, sizes):
+    """
+    Checks, before anything is written, that the table entries queued on the
+    writer fit in every switch. When the queue is the full desired state of
+    the switches, as for reconcile.installer(), this is the state they end
+    up in whatever they hold now.
+
+    :param sizes: as returned by tableSizes()
+    :return: the CapacityReport, after printing it
+    :raises CapacityError: if any table would overflow
+    """
+    report = CapacityReport()
+    for sw in switches:
+        for update in writer.queued(sw):
+            if update.entity.WhichOneof("entity") != "table_entry":
+                continue
+            entry = update.entity.table_entry
+            if entry.is_default_action or update.type != p4runtime_pb2.Update.INSERT:
+                continue
+            report.table(sw.name, entry.table_id, sizes).inserts += 1
+    report.print_report()
+    if not report.ok:
+        raise CapacityError(report)
+    return report
+
+
+def planUpdates(sw_name, current, updates, sizes):
+    """
+    Projects the table usage of a switch after a list of updates, and puts
+    the deletes of a table first when its inserts would only fit once they
+    are done.
+
+    :param current: dict entryKey -> TableEntry installed on the switch
+    :param updates: list of (update type, TableEntry), from diffEntries()
+    :return: (the updates in the order to send them, the CapacityReport)
+    """
+    report = CapacityReport()
+    for key in current:
+        report.table(sw_name, key[0], sizes).installed += 1
+    for update_type, entry in updates:
+        if entry.is_default_action:
+            continue
+        usage = report.table(sw_name, entry.table_id, sizes)
+        if update_type == p4runtime_pb2.Update.INSERT:
+            usage.inserts += 1
+        elif update_type == p4runtime_pb2.Update.DELETE:
+            usage.deletes += 1
+    tight = set(usage.name for _, usage in report.tight)
+    if tight:
+        first = [(update_type, entry) for update_type, entry in updates
+                 if update_type == p4runtime_pb2.Update.DELETE and
+                 sizes[entry.table_id][0] in tight]
+        moved = set(id(entry) for _, entry in first)
+        updates = first + [(update_type, entry) for update_type, entry in updates
+                           if id(entry) not in moved]
+        for sw, usage in report.tight:
+            print("%s %s: deleting stale entries before inserting, the table is too full "
+                  "to do it the other way round" % (sw, usage.name))
+    return updates, report
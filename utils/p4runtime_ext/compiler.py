@@ -0,0 +1,253 @@
+# 由topology.json自动生成各交换机的转发规则，取代手写的forwardRules调用列表
+import bisect
+import ipaddress
+from collections import OrderedDict, defaultdict
+
+CPU_PORT = 255      # the usual --cpu-port of simple_switch_grpc
+DROP_PORT = 511     # egress_spec set by mark_to_drop on bmv2
+
+
+def lpmRule(table_name, network, action_name, action_params):
+    return {
+        "table": table_name,
+        "match": {"hdr.ipv4.dstAddr": [str(network.network_address), network.prefixlen]},
+        "action_name": action_name,
+        "action_params": action_params,
+    }
+
+
+def exactRule(table_name, field, value, action_name, action_params):
+    return {
+        "table": table_name,
+        "match": {field: value},
+        "action_name": action_name,
+        "action_params": action_params,
+    }
+
+
+def equalCostHops(topo, sw, host):
+    """
+    The (port, peer_switch) choices sw forwards on towards the switch of
+    host, ordered by peer switch position in topology.json.
+    """
+    hops = topo.next_hops(host.switch).get(sw, [])
+    return tuple(sorted(hops, key=lambda hop: topo.switch_index[hop[1]]))
+
+
+class _HostIndex(object):
+    """
+    Hosts sorted by address, to find the hosts inside a prefix quickly, plus
+    the subnet and /32 of every host, computed once for all switches.
+    """
+
+    def __init__(self, hosts):
+        hosts = sorted(hosts, key=lambda host: int(host.interface.ip))
+        self.addrs = [int(host.interface.ip) for host in hosts]
+        self.hosts = hosts
+        self.subnet = dict((host, host.interface.network) for host in hosts)
+        self.host_net = dict((host, ipaddress.ip_network(host.ip + "/32")) for host in hosts)
+        self.members = {}   # subnet -> hosts whose address falls inside it
+        for network in set(self.subnet.values()):
+            self.members[network] = self.within(network)
+
+    def within(self, network):
+        lo = bisect.bisect_left(self.addrs, int(network.network_address))
+        hi = bisect.bisect_right(self.addrs, int(network.broadcast_address))
+        return self.hosts[lo:hi]
+
+
+def aggregate(sw, actions, index):
+    """
+    Turns per-host actions on one switch into a small set of prefixes.
+
+    A remote host is routed by its subnet (from its address in topology.json)
+    when every host inside that subnet gets the same action on this switch;
+    otherwise, and always for directly attached hosts, by its /32. Prefixes
+    with the same action are then merged with collapse_addresses, which only
+    joins prefixes that exactly tile their supernet, so no address changes
+    action.
+
+    :param sw: the switch name
+    :param actions: dict host -> hashable action
+    :param index: _HostIndex over all hosts
+    :return: list of (network, action), sorted by address
+    """
+    uniform = {}
+    by_action = defaultdict(set)
+    for host, action in actions.items():
+        network = index.subnet[host]
+        if host.switch != sw:
+            if network not in uniform:
+                uniform[network] = all(other.switch != sw and actions.get(other) == action
+                                       for other in index.members[network])
+            if uniform[network]:
+                by_action[action].add(network)
+                continue
+        by_action[action].add(index.host_net[host])
+    routes = []
+    for action, networks in by_action.items():
+        routes.extend((network, action) for network in ipaddress.collapse_addresses(networks))
+    routes.sort(key=lambda route: (int(route[0].network_address), route[0].prefixlen))
+    return routes
+
+
+def compileIpv4Lpm(topo, table_name="MyIngress.ipv4_lpm",
+                   action_name="MyIngress.ipv4_forward"):
+    """
+    IPv4 forwarding rules for every switch: directly attached hosts get a /32
+    to the host's MAC and port, remote ones are forwarded on a shortest path
+    to the next switch's MAC (see Topology.switch_mac).
+
+    Remote hosts are aggregated by their set of equal-cost next hops first;
+    the resulting prefixes are then spread round-robin over those next hops,
+    so parallel links all carry traffic without splitting a prefix.
+
+    :param topo: the Topology
+    :return: OrderedDict switch name -> list of rules in the runtime JSON format
+    """
+    hosts = [host for host in topo.hosts.values() if host.switch is not None]
+    index = _HostIndex(hosts)
+    macs = dict((sw, topo.switch_mac(sw)) for sw in topo.switches)
+    rules = OrderedDict()
+    for sw in topo.switches:
+        actions = {}    # host -> ((mac, port), ...) it may be forwarded to
+        for host in hosts:
+            if host.switch == sw:
+                actions[host] = ((host.mac, host.port),)
+                continue
+            hops = equalCostHops(topo, sw, host)
+            if hops:
+                actions[host] = tuple((macs[peer], port) for port, peer in hops)
+        rules[sw] = []
+        spread = defaultdict(int)   # next hop choices -> prefixes given out
+        for network, choices in aggregate(sw, actions, index):
+            mac, port = choices[spread[choices] % len(choices)]
+            spread[choices] += 1
+            rules[sw].append(lpmRule(table_name, network, action_name,
+                                     {"dstAddr": mac, "port": port}))
+    return rules
+
+
+def ternaryCover(ports, dont_care=(), width=9):
+    """
+    A small set of (value, mask) pairs matching every port in ports and none
+    outside ports and dont_care: the prime implicants (Quine-McCluskey) over
+    ports plus dont_care, chosen greedily by how many ports they cover.
+    """
+    ports = set(ports)
+    if not ports:
+        return []
+    full = (1 << width) - 1
+    terms = set((port, full) for port in ports | set(dont_care))
+    primes = set()
+    while terms:
+        merged = set()
+        used = set()
+        by_mask = defaultdict(set)
+        for value, mask in terms:
+            by_mask[mask].add(value)
+        for mask, values in by_mask.items():
+            for value in values:
+                bit = mask
+                while bit:
+                    low = bit & -bit
+                    bit ^= low
+                    other = value ^ low
+                    if other in values:
+                        merged.add((value & ~low, mask & ~low))
+                        used.add((value, mask))
+                        used.add((other, mask))
+        primes |= terms - used
+        terms = merged
+    cover = []
+    left = set(ports)
+    while left:
+        value, mask = max(sorted(primes), key=lambda term: sum(1 for port in left
+                                                                if port & term[1] == term[0]))
+        cover.append((value, mask))
+        left = set(port for port in left if port & mask != value)
+    return cover
+
+
+def rangeCover(ports):
+    """The runs of consecutive ports as (low, high) pairs."""
+    runs = []
+    for port in sorted(set(ports)):
+        if runs and runs[-1][1] == port - 1:
+            runs[-1] = (runs[-1][0], port)
+        else:
+            runs.append((port, port))
+    return runs
+
+
+def tableMatchKinds(p4info_helper, table_name):
+    """:return: dict match field name -> "exact", "lpm", "ternary", "range", ... of a table"""
+    table = p4info_helper.get("tables", name=table_name)
+    return dict((field.name, field.MatchType.Name(field.match_type).lower())
+                for field in table.match_fields)
+
+
+def _portMatches(kind, ports, dont_care):
+    # A cover no smaller than the port set gains nothing: match each port
+    if kind == "ternary":
+        cover = ternaryCover(ports, dont_care)
+        if len(cover) < len(ports):
+            return [list(term) for term in cover]
+        return [[port, (1 << 9) - 1] for port in sorted(ports)]
+    if kind == "range":
+        cover = rangeCover(ports)
+        if len(cover) < len(ports):
+            return [list(run) for run in cover]
+        return [[port, port] for port in sorted(ports)]
+    return sorted(ports)
+
+
+def compileCheckPorts(topo, match_kinds=None, table_name="MyIngress.check_ports",
+                      ingress_field="standard_metadata.ingress_port",
+                      egress_field="standard_metadata.egress_spec",
+                      reserved_ports=(CPU_PORT, DROP_PORT)):
+    """
+    check_ports rules of the ex5 firewall from the port roles in
+    topology.json (Topology.port_roles): traffic from an internal to an
+    external port gets direction 0, from external to internal direction 1.
+    Other port pairs are left to miss.
+
+    The internal and external port sets of each field are written as
+    ternary (value, mask) or range matches when the table uses them, with
+    the port numbers that have no link in the topology as don't cares (a
+    linked port without a role, the CPU port and bmv2's drop port are never
+    matched), and as one entry per port for exact matches or when the cover
+    is not smaller; a switch gets 2 * |internal| * |external| entries with
+    exact matches and usually a handful with ternary or range ones.
+
+    :param match_kinds: the table's match kinds, from tableMatchKinds();
+                        exact when omitted
+    :param reserved_ports: port numbers that are never don't cares
+    :return: OrderedDict switch name -> list of rules in the runtime JSON
+             format, for the switches with port roles
+    """
+    match_kinds = match_kinds or {}
+    rules = OrderedDict()
+    for sw in topo.switches:
+        roles = topo.port_roles(sw)
+        if not roles:
+            continue
+        internal = set(port for port, role in roles.items() if role == "internal")
+        external = set(port for port, role in roles.items() if role == "external")
+        unused = (set(range(512)) - set(topo.ports[sw]) - internal - external
+                  - set(reserved_ports))
+        rules[sw] = []
+        for direction, (src, dst) in enumerate(((internal, external), (external, internal))):
+            for ingress in _portMatches(match_kinds.get(ingress_field, "exact"), src, unused):
+                for egress in _portMatches(match_kinds.get(egress_field, "exact"), dst, unused):
+                    rule = {
+                        "table": table_name,
+                        "match": {ingress_field: ingress, egress_field: egress},
+                        "action_name": "MyIngress.set_direction",
+                        "action_params": {"dir": direction},
+                    }
+                    if any(match_kinds.get(field) in ("ternary", "range")
+                           for field in (ingress_field, egress_field)):
+                        rule["priority"] = 1
+                    rules[sw].append(rule)
+    return rules
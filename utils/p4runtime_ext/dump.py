@@ -0,0 +1,216 @@
+# P4Runtime消息转存：可关闭或抽样，开启时由后台线程缓冲写入带长度前缀的二进制记录并滚动文件，另附离线转文本工具
+import argparse
+import os
+import queue
+import random
+import struct
+import sys
+import threading
+import time
+
+import google.protobuf.text_format
+import grpc
+from p4.v1 import p4runtime_pb2, p4runtime_pb2_grpc
+
+LOG_OFF = "off"
+LOG_BINARY = "binary"
+LOG_TEXT = "text"           # p4runtime_lib's synchronous text logger
+LOG_MODES = (LOG_OFF, LOG_BINARY, LOG_TEXT)
+
+MAGIC = b"P4RTDUMP1\n"
+# Record: timestamp (double), method name length, message length, then both
+RECORD_HEADER = struct.Struct("<dHI")
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_BACKUPS = 3
+DEFAULT_QUEUE_SIZE = 100000
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+
+class DumpWriter(object):
+    """
+    Writes dump records from a background thread.
+
+    log() only puts the message on a bounded queue, so the caller pays
+    neither the serialization nor the file I/O; when the queue is full the
+    message is dropped and counted rather than blocking the caller. Records
+    go through a large write buffer that is flushed whenever the queue runs
+    empty, and the file is rotated to path.1 ... path.<backups> once it
+    grows past max_bytes.
+    """
+
+    def __init__(self, path, sample=1.0, max_bytes=DEFAULT_MAX_BYTES,
+                 backups=DEFAULT_BACKUPS, queue_size=DEFAULT_QUEUE_SIZE):
+        self.path = path
+        self.sample = sample
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.dropped = 0
+        self._queue = queue.Queue(queue_size)
+        self._file = None
+        self._thread = threading.Thread(target=self._run, name="dump-%s" % os.path.basename(path))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def log(self, method, message):
+        if self.sample < 1.0 and random.random() >= self.sample:
+            return
+        try:
+            self._queue.put_nowait((time.time(), method, message))
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """Writes out everything queued so far and stops the thread."""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _open(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._file = open(self.path, "wb", buffering=WRITE_BUFFER_SIZE)
+        self._file.write(MAGIC)
+
+    def _rotate(self):
+        self._file.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists("%s.%d" % (self.path, i)):
+                os.replace("%s.%d" % (self.path, i), "%s.%d" % (self.path, i + 1))
+        if self.backups > 0:
+            os.replace(self.path, self.path + ".1")
+        self._open()
+
+    def _run(self):
+        self._open()
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            t, method, message = item
+            name = method.encode()
+            # Rule bundles send their requests already serialized
+            body = message if isinstance(message, bytes) else message.SerializeToString()
+            self._file.write(RECORD_HEADER.pack(t, len(name), len(body)))
+            self._file.write(name)
+            self._file.write(body)
+            if self._file.tell() >= self.max_bytes:
+                self._rotate()
+            elif self._queue.empty():
+                self._file.flush()
+        self._file.close()
+
+
+class DumpInterceptor(grpc.UnaryUnaryClientInterceptor,
+                      grpc.UnaryStreamClientInterceptor):
+    """Logs the request of every unary call (Write, Read, pipeline config) to a DumpWriter."""
+
+    def __init__(self, writer):
+        self.writer = writer
+
+    def intercept_unary_unary(self, continuation, client_call_details, request):
+        self.writer.log(client_call_details.method, request)
+        return continuation(client_call_details, request)
+
+    def intercept_unary_stream(self, continuation, client_call_details, request):
+        self.writer.log(client_call_details.method, request)
+        return continuation(client_call_details, request)
+
+
+class MessageDump(object):
+    """
+    P4Runtime message logging for the switch connections of a controller.
+
+    LOG_OFF logs nothing; LOG_TEXT keeps the p4runtime_lib text log (pass
+    text_file() as proto_dump_file); LOG_BINARY attaches a DumpInterceptor
+    writing logs/<switch>-p4runtime-requests.bin, sampled with the given
+    probability. Render binary dumps with: python3 dump.py <file>
+    """
+
+    def __init__(self, mode=LOG_OFF, sample=1.0, log_dir="logs"):
+        if mode not in LOG_MODES:
+            raise ValueError("Unknown log mode %r, expected one of %s" % (mode, ", ".join(LOG_MODES)))
+        self.mode = mode
+        self.sample = sample
+        self.log_dir = log_dir
+        self.writers = []
+
+    def text_file(self, name):
+        if self.mode != LOG_TEXT:
+            return None
+        return os.path.join(self.log_dir, "%s-p4runtime-requests.txt" % name)
+
+    def attach(self, sw):
+        """Starts binary logging of the unary calls made through sw, if enabled."""
+        if self.mode != LOG_BINARY:
+            return sw
+        writer = DumpWriter(os.path.join(self.log_dir, "%s-p4runtime-requests.bin" % sw.name),
+                            sample=self.sample)
+        self.writers.append(writer)
+        # The stream channel stays on the plain channel, like with the text logger
+        sw.channel = grpc.intercept_channel(sw.channel, DumpInterceptor(writer))
+        sw.client_stub = p4runtime_pb2_grpc.P4RuntimeStub(sw.channel)
+        return sw
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+            if writer.dropped:
+                print("%s: %d message(s) dropped, the dump writer fell behind"
+                      % (writer.path, writer.dropped))
+
+
+def _requestType(method):
+    # '/p4.v1.P4Runtime/Write' -> p4runtime_pb2.WriteRequest
+    service = p4runtime_pb2.DESCRIPTOR.services_by_name["P4Runtime"]
+    rpc = service.methods_by_name.get(method.rsplit("/", 1)[-1])
+    if rpc is None:
+        return None
+    return getattr(p4runtime_pb2, rpc.input_type.name)
+
+
+def readDump(path):
+    """Yields (timestamp, method, message) from a binary dump file."""
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a P4Runtime dump file" % path)
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            t, name_len, body_len = RECORD_HEADER.unpack(header)
+            method = f.read(name_len).decode()
+            body = f.read(body_len)
+            if len(body) < body_len:
+                return      # cut short, e.g. the controller was killed mid-write
+            cls = _requestType(method)
+            if cls is None:
+                yield t, method, body
+                continue
+            message = cls()
+            message.ParseFromString(body)
+            yield t, method, message
+
+
+def renderDump(path, out=sys.stdout):
+    """Writes a binary dump in the format of p4runtime_lib's text log."""
+    for t, method, message in readDump(path):
+        out.write("\n[%s.%03d]\n" % (time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t)),
+                                     int(t * 1000) % 1000))
+        out.write("%s\n" % method)
+        if isinstance(message, bytes):
+            out.write("<%d bytes>\n" % len(message))
+        else:
+            out.write(google.protobuf.text_format.MessageToString(message))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Render binary P4Runtime message dumps as text')
+    parser.add_argument('files', nargs='+', help='dump files, e.g. logs/s1-p4runtime-requests.bin')
+    args = parser.parse_args()
+    for path in args.files:
+        renderDump(path)
+
+
+if __name__ == '__main__':
+    main()
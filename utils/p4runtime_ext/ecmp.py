@@ -0,0 +1,469 @@
+# 加权ECMP：按权重把成员复制到ecmp_nhop的多个槽位，权重变化只改动最少的槽位，组扩缩容先建后拆，按链路负载重新分配权重
+import ipaddress
+import threading
+import time
+
+from p4.v1 import p4runtime_pb2
+
+from .compiler import exactRule
+from .hashes import crc16, packFields
+from .rules import buildEntry
+from .sketch import SpaceSaving
+
+DEFAULT_GROUP_SLOTS = 16
+MIN_WEIGHT = 0.05       # members never drop below this share of a group in rebalance()
+
+
+def flowSlot(flow, count):
+    """
+    The offset in its group that load_balance.p4 hashes a flow to:
+    crc16 over srcAddr, dstAddr, protocol, srcPort, dstPort, mod ecmp_count.
+
+    :param flow: (src, dst, proto, sport, dport), addresses as 4-byte strings
+    """
+    src, dst, proto, sport, dport = flow
+    return crc16(packFields((src, 32), (dst, 32), (proto, 8), (sport, 16), (dport, 16))) % count
+
+
+def allocateSlots(weights, slots):
+    """
+    Splits slots between members by weight with the largest remainder
+    method; every member with a positive weight gets at least one slot.
+
+    :param weights: list of non-negative weights
+    :return: list of slot counts summing to slots
+    """
+    live = [i for i, w in enumerate(weights) if w > 0]
+    if not live:
+        raise ValueError("ECMP group needs at least one member with a positive weight")
+    if slots < len(live):
+        raise ValueError("%d slots cannot hold %d members" % (slots, len(live)))
+    counts = [0] * len(weights)
+    for i in live:
+        counts[i] = 1
+    spare = slots - len(live)
+    total = float(sum(weights[i] for i in live))
+    quotas = dict((i, spare * weights[i] / total) for i in live)
+    for i in live:
+        counts[i] += int(quotas[i])
+    left = slots - sum(counts)
+    for i in sorted(live, key=lambda i: (-(quotas[i] - int(quotas[i])), i))[:left]:
+        counts[i] += 1
+    return counts
+
+
+def assignSlots(current, counts):
+    """
+    Lays counts[m] slots out for every member m, reusing the current layout:
+    only slots of members over their new count change hands, so only the
+    flows hashed to those slots move.
+
+    :param current: list slot -> member, of len(sum(counts)), or None for a new group
+    :param counts: list member -> slot count
+    :return: list slot -> member
+    """
+    size = sum(counts)
+    if current is None or len(current) != size:
+        layout = []
+        # Interleaved, so that a later change of one member is spread over the range
+        remaining = list(counts)
+        while len(layout) < size:
+            for member, n in enumerate(remaining):
+                if n:
+                    layout.append(member)
+                    remaining[member] -= 1
+        return layout
+    layout = list(current)
+    held = [0] * len(counts)
+    free = []
+    for slot, member in enumerate(layout):
+        if member < len(counts) and held[member] < counts[member]:
+            held[member] += 1
+        else:
+            free.append(slot)
+    for member, n in enumerate(counts):
+        for _ in range(n - held[member]):
+            layout[free.pop()] = member
+    return layout
+
+
+class SlotSpace(object):
+    """First-fit allocator of ecmp_nhop index ranges on one switch."""
+
+    def __init__(self, size):
+        self.size = size
+        self.free = [(0, size)]     # sorted (start, length)
+
+    def alloc(self, length):
+        for i, (start, free_length) in enumerate(self.free):
+            if free_length >= length:
+                if free_length == length:
+                    del self.free[i]
+                else:
+                    self.free[i] = (start + length, free_length - length)
+                return start
+        raise ValueError("ecmp_nhop has no free range of %d slots (table size %d)"
+                         % (length, self.size))
+
+    def release(self, start, length):
+        self.free.append((start, length))
+        self.free.sort()
+        merged = []
+        for s, n in self.free:
+            if merged and merged[-1][0] + merged[-1][1] == s:
+                merged[-1] = (merged[-1][0], merged[-1][1] + n)
+            else:
+                merged.append((s, n))
+        self.free = merged
+
+
+class EcmpGroup(object):
+    """
+    One ecmp_group entry and its ecmp_nhop slots on a switch.
+
+    :param members: list of (nhop_dmac, nhop_ipv4, port)
+    """
+
+    def __init__(self, sw, dst, members, weights):
+        self.sw = sw
+        self.dst = dst          # (address, prefix length) matched by ecmp_group
+        self.members = list(members)
+        self.weights = list(weights)
+        self.base = None
+        self.layout = None      # slot -> member index
+        self.pins = {}          # slot -> member index, overriding the layout
+
+    def ports(self):
+        return [port for _, _, port in self.members]
+
+    def member(self, slot):
+        """The member a slot currently points to, pins included."""
+        return self.pins.get(slot, self.layout[slot])
+
+
+class EcmpManager(object):
+    """
+    Weighted ECMP groups for the load_balance pipeline.
+
+    The pipeline hashes a flow to ecmp_base + (hash mod ecmp_count) and looks
+    that slot up in ecmp_nhop, so a member's weight is its number of slots.
+    With the slot count of a group fixed, a weight or member change only
+    rewrites the slots that change hands, each with a single MODIFY, so
+    only the flows on those slots move and no slot is ever empty.
+
+    Changing the slot count remaps every flow anyway, so it is done make
+    before break: the new slots are written into a free range, the
+    ecmp_group entry is switched over with one MODIFY, then the old range is
+    deleted.
+
+    The slot space of a switch is the size of ecmp_nhop in the p4info; a
+    resize needs room for the old and new ranges at the same time.
+    """
+
+    def __init__(self, p4info_helper, writer, group_slots=DEFAULT_GROUP_SLOTS,
+                 group_table="MyIngress.ecmp_group", nhop_table="MyIngress.ecmp_nhop"):
+        """
+        :param writer: the BatchWriter updates go through
+        :param group_slots: slots given to a new group
+        """
+        self.p4info_helper = p4info_helper
+        self.writer = writer
+        self.group_slots = group_slots
+        self.group_table = group_table
+        self.nhop_table = nhop_table
+        # p4c writes the declared size; 0 means the target default (1024 on bmv2)
+        self.nhop_size = p4info_helper.get("tables", name=nhop_table).size or 1024
+        self.groups = []
+        self._spaces = {}       # switch name -> SlotSpace
+        self._lock = threading.Lock()
+
+    def _space(self, sw):
+        if sw.name not in self._spaces:
+            self._spaces[sw.name] = SlotSpace(self.nhop_size)
+        return self._spaces[sw.name]
+
+    def _group_rule(self, group, base, count):
+        return {
+            "table": self.group_table,
+            "match": {"hdr.ipv4.dstAddr": list(group.dst)},
+            "action_name": "MyIngress.set_ecmp_select",
+            "action_params": {"ecmp_base": base, "ecmp_count": count},
+        }
+
+    def _nhop_rule(self, group, slot, member):
+        mac, ip, port = group.members[member]
+        return exactRule(self.nhop_table, "meta.ecmp_select", group.base + slot,
+                         "MyIngress.set_nhop", {"nhop_dmac": mac, "nhop_ipv4": ip, "port": port})
+
+    def _queue(self, sw, rules, update_type):
+        for rule in rules:
+            self.writer.add(sw, buildEntry(self.p4info_helper, rule), update_type)
+
+    def add_group(self, sw, dst, members, weights=None, slots=None):
+        """
+        Queues the entries of a new group on the writer (send them with
+        flush(), or let installer() reconcile them at bring-up).
+
+        :param sw: the switch connection
+        :param dst: (address, prefix length) to match, e.g. ("10.0.0.1", 32)
+        :param members: list of (nhop_dmac, nhop_ipv4, port)
+        :param weights: list of member weights, equal by default
+        :param slots: slots of the group, group_slots by default (at most
+                      the table size, at least one per member)
+        """
+        if weights is None:
+            weights = [1] * len(members)
+        if slots is None:
+            slots = max(min(self.group_slots, self.nhop_size), len(members))
+            if slots < self.group_slots:
+                print("%s: %s has %d entries, group %s/%d gets %d slots instead of %d"
+                      % (sw.name, self.nhop_table, self.nhop_size, dst[0], dst[1],
+                         slots, self.group_slots))
+        group = EcmpGroup(sw, dst, members, weights)
+        with self._lock:
+            group.base = self._space(sw).alloc(slots)
+            group.layout = assignSlots(None, allocateSlots(weights, slots))
+            self.groups.append(group)
+        self._queue(sw, [self._group_rule(group, group.base, slots)],
+                    p4runtime_pb2.Update.INSERT)
+        self._queue(sw, [self._nhop_rule(group, slot, member)
+                         for slot, member in enumerate(group.layout)],
+                    p4runtime_pb2.Update.INSERT)
+        return group
+
+    def set_weights(self, group, weights, members=None):
+        """
+        Changes the weights (and optionally the members) of a group in
+        place, rewriting only the slots that change member.
+
+        :param members: new member list; existing members must keep their
+                        position, new ones are appended
+        :return: the number of slots rewritten
+        """
+        with self._lock:
+            if members is not None:
+                group.members = list(members)
+            before = [group.member(slot) for slot in range(len(group.layout))]
+            counts = allocateSlots(weights, len(group.layout))
+            group.layout = assignSlots(group.layout, counts)
+            group.weights = list(weights)
+            # Pins to a member that lost all its slots are dropped
+            for slot, member in list(group.pins.items()):
+                if not counts[member]:
+                    del group.pins[slot]
+            changed = [slot for slot, member in enumerate(before) if group.member(slot) != member]
+        self._queue(group.sw, [self._nhop_rule(group, slot, group.member(slot)) for slot in changed],
+                    p4runtime_pb2.Update.MODIFY)
+        self.writer.flush(group.sw)
+        return len(changed)
+
+    def pin(self, group, slot, member):
+        """Points one slot of a group at member, whatever the weights say."""
+        with self._lock:
+            if group.member(slot) == member:
+                return False
+            if member == group.layout[slot]:
+                group.pins.pop(slot, None)
+            else:
+                group.pins[slot] = member
+        self._queue(group.sw, [self._nhop_rule(group, slot, member)], p4runtime_pb2.Update.MODIFY)
+        self.writer.flush(group.sw)
+        return True
+
+    def unpin(self, group, slot):
+        """Points a pinned slot back at its member in the weighted layout."""
+        with self._lock:
+            if group.pins.pop(slot, None) is None:
+                return False
+        self._queue(group.sw, [self._nhop_rule(group, slot, group.layout[slot])],
+                    p4runtime_pb2.Update.MODIFY)
+        self.writer.flush(group.sw)
+        return True
+
+    def resize(self, group, slots, weights=None):
+        """
+        Moves a group to a new range of slots, make before break. Every
+        flow of the group is rehashed, and its pins are dropped.
+        """
+        if weights is None:
+            weights = group.weights
+        sw = group.sw
+        with self._lock:
+            space = self._space(sw)
+            old_base, old_size = group.base, len(group.layout)
+            new_base = space.alloc(slots)
+            group.base = new_base
+            group.layout = assignSlots(None, allocateSlots(weights, slots))
+            group.weights = list(weights)
+            group.pins = {}
+        # 1) 新槽位写好之前不引用它们
+        self._queue(sw, [self._nhop_rule(group, slot, member)
+                         for slot, member in enumerate(group.layout)],
+                    p4runtime_pb2.Update.INSERT)
+        self.writer.flush(sw)
+        # 2) 一次MODIFY把组切换到新槽位
+        self._queue(sw, [self._group_rule(group, new_base, slots)], p4runtime_pb2.Update.MODIFY)
+        self.writer.flush(sw)
+        # 3) 旧槽位已无引用，再删除
+        self._queue(sw, [exactRule(self.nhop_table, "meta.ecmp_select", old_base + slot,
+                                   "MyIngress.set_nhop", None)
+                         for slot in range(old_size)],
+                    p4runtime_pb2.Update.DELETE)
+        self.writer.flush(sw)
+        with self._lock:
+            space.release(old_base, old_size)
+
+    def rebalance(self, loads, capacities=None, damping=0.5):
+        """
+        Shifts weight from the busier members of every group to the idler
+        ones. A member's weight is scaled by (mean utilization / its
+        utilization) ** damping, with the factor kept within [0.5, 2] and
+        the weight above MIN_WEIGHT of the group, so that the weights move
+        towards equal utilization over a few rounds without oscillating.
+
+        :param loads: dict (switch name, port) -> bits per second
+        :param capacities: dict (switch name, port) -> bits per second;
+                           all links equal when omitted
+        :return: the number of slots rewritten
+        """
+        moved = 0
+        for group in list(self.groups):
+            keys = [(group.sw.name, port) for port in group.ports()]
+            if not any(loads.get(key) for key in keys):
+                continue
+            utils = []
+            for key in keys:
+                capacity = capacities.get(key, 1.0) if capacities else 1.0
+                utils.append(loads.get(key, 0.0) / capacity)
+            mean = sum(utils) / len(utils)
+            total = float(sum(group.weights))
+            weights = []
+            for w, u in zip(group.weights, utils):
+                if w <= 0:
+                    weights.append(0)   # removed member
+                    continue
+                factor = (mean / u) ** damping if u > 0 else 2.0
+                weights.append(max(w / total * min(max(factor, 0.5), 2.0), MIN_WEIGHT))
+            if allocateSlots(weights, len(group.layout)) == \
+                    allocateSlots(group.weights, len(group.layout)):
+                continue
+            n = self.set_weights(group, weights)
+            moved += n
+            print("%s %s/%d: weights %s, %d slot(s) moved" % (
+                group.sw.name, group.dst[0], group.dst[1],
+                " ".join("port %d=%.2f" % (port, w / sum(weights))
+                         for port, w in zip(group.ports(), weights)), n))
+        return moved
+
+
+class PortLoad(object):
+    """
+    Byte counts of sampled packets per switch port, as a PacketSampler
+    handler; rates() turns them into bits per second since the last call.
+    """
+
+    def __init__(self, ifaces, sample_every=1):
+        """:param ifaces: dict interface -> (switch name, port), as from switchInterfaces()"""
+        self.ifaces = dict(ifaces)
+        self.sample_every = sample_every
+        self._bytes = dict((iface, 0) for iface in self.ifaces)
+        self._since = time.time()
+        self._lock = threading.Lock()
+
+    def __call__(self, iface, t, flow, tos, length):
+        with self._lock:
+            self._bytes[iface] += length
+
+    def rates(self):
+        now = time.time()
+        with self._lock:
+            counts, self._bytes = self._bytes, dict((iface, 0) for iface in self.ifaces)
+            elapsed, self._since = max(now - self._since, 1e-9), now
+        return dict((self.ifaces[iface], n * 8.0 * self.sample_every / elapsed)
+                    for iface, n in counts.items())
+
+
+class ElephantPinner(object):
+    """
+    Moves elephant flows off the ECMP members they collide on.
+
+    The handler counts the bytes of sampled packets per flow in one
+    SpaceSaving sketch per group; sample the switch's incoming packets, as
+    set_nhop rewrites the destination address. Every tick(), the flows
+    carrying at least share of a group's sampled bytes are its elephants:
+    they are placed largest first on the least loaded member (the mice
+    being spread by weight), and the slot of each elephant that should move
+    is pinned to its new member with a single ecmp_nhop MODIFY. Mice hashed
+    to the same slot move with it. A pin is released once its elephants
+    have not been seen for age seconds; at most max_changes pins change per
+    tick.
+    """
+
+    def __init__(self, manager, share=0.1, age=10.0, max_changes=4, k=64):
+        self.manager = manager
+        self.share = share
+        self.age = age
+        self.max_changes = max_changes
+        self.k = k
+        self._sketches = {}     # group -> SpaceSaving of the current window
+        self._seen = {}         # (group, slot) -> time an elephant on the pinned slot was last seen
+        self._networks = {}     # group -> (network address, netmask) as integers
+        self._lock = threading.Lock()
+
+    def _group(self, flow):
+        dst = int.from_bytes(flow[1], "big")
+        for group in self.manager.groups:
+            net = self._networks.get(group)
+            if net is None:
+                network = ipaddress.ip_network("%s/%d" % group.dst)
+                net = self._networks[group] = (int(network.network_address), int(network.netmask))
+            if dst & net[1] == net[0]:
+                return group
+        return None
+
+    def __call__(self, iface, t, flow, tos, length):
+        group = self._group(flow)
+        if group is None:
+            return
+        with self._lock:
+            sketch = self._sketches.get(group)
+            if sketch is None:
+                sketch = self._sketches[group] = SpaceSaving(self.k)
+            sketch.offer(flow, length)
+
+    def tick(self):
+        now = time.time()
+        with self._lock:
+            sketches, self._sketches = self._sketches, {}
+        changes = 0
+        for group in list(self.manager.groups):
+            sketch = sketches.get(group)
+            size = len(group.layout)
+            live = [m for m, w in enumerate(group.weights) if w > 0]
+            if sketch is not None and sketch.total and len(live) > 1:
+                elephants = [(flow, count - error) for flow, count, error in sketch.heavy(self.share)]
+                mice = sketch.total - sum(rate for _, rate in elephants)
+                counts = allocateSlots(group.weights, size)
+                load = dict((m, mice * counts[m] / float(size)) for m in live)
+                slots = {}      # slot -> elephant bytes hashed to it
+                for flow, rate in elephants:
+                    slot = flowSlot(flow, size)
+                    slots[slot] = slots.get(slot, 0) + rate
+                for slot, rate in sorted(slots.items(), key=lambda item: -item[1]):
+                    target = min(live, key=lambda m: (load[m], m != group.member(slot)))
+                    load[target] += rate
+                    if slot in group.pins or target != group.member(slot):
+                        self._seen[(group, slot)] = now
+                    if target != group.member(slot) and changes < self.max_changes:
+                        self.manager.pin(group, slot, target)
+                        changes += 1
+                        print("%s %s/%d: slot %d (%.0f%% of sampled bytes) pinned to port %d"
+                              % (group.sw.name, group.dst[0], group.dst[1], slot,
+                                 100.0 * rate / sketch.total, group.members[target][2]))
+            for slot in list(group.pins):
+                if now - self._seen.get((group, slot), 0) >= self.age and changes < self.max_changes:
+                    self.manager.unpin(group, slot)
+                    self._seen.pop((group, slot), None)
+                    changes += 1
+                    print("%s %s/%d: slot %d unpinned" % (group.sw.name, group.dst[0],
+                                                          group.dst[1], slot))
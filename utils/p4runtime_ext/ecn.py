@@ -0,0 +1,213 @@
+# ECN拥塞监控：统计各交换机间出端口上CE标记的比例，持续拥塞时把经过该端口的ipv4_lpm路由限速地改到备用下一跳，拥塞消失后再改回
+import ipaddress
+import threading
+import time
+
+from p4.v1 import p4runtime_pb2
+
+from .rules import buildEntry
+
+ECN_MASK = 0x03
+ECN_CE = 0x03
+
+
+def parseNetwork(rule):
+    # lpmRule的匹配格式: {"hdr.ipv4.dstAddr": [addr, prefixlen]}
+    addr, prefixlen = rule["match"]["hdr.ipv4.dstAddr"]
+    return ipaddress.ip_network("%s/%d" % (addr, prefixlen))
+
+
+class PortState(object):
+    """Window counts and congestion streaks of one switch egress port."""
+
+    def __init__(self):
+        self.ect = 0            # ECN-capable packets sampled in the current window
+        self.ce = 0             # of which marked CE
+        self.fraction = 0.0     # CE fraction of the last complete window
+        self.hot = 0            # consecutive windows above the high threshold
+        self.cool = 0           # consecutive windows below the low threshold
+        self.rerouted = None    # (time, [original rule]) while its routes are moved away
+
+
+class EcnMonitor(object):
+    """
+    Closes the loop from CE marks to forwarding changes.
+
+    handler() gives the PacketSampler handler for the switch-to-switch
+    interfaces, sampling what each switch sends out of a port (the ECN
+    pipeline marks CE on egress when the queue is deep); tick() closes a
+    window. A port whose CE fraction among ECN-capable packets stays above
+    high for sustain windows has the ipv4_lpm routes it carries moved, with
+    MODIFY updates, to another neighbour whose own shortest path does not
+    come back through the switch. Once the port has stayed below low for
+    clear windows, and the detour is at least hold seconds old, the
+    original routes are restored. Windows with fewer than min_packets
+    ECN-capable samples count as neither hot nor cool, except on a rerouted
+    port, where they mean the traffic has gone. A switch gets at most
+    one rule update every update_interval seconds.
+    """
+
+    def __init__(self, topo, p4info_helper, switches, rules, writer, high=0.10, low=0.02,
+                 sustain=3, clear=5, min_packets=20, hold=30.0, update_interval=5.0):
+        """
+        :param topo: the Topology the rules were compiled from
+        :param switches: dict switch name -> switch connection
+        :param rules: dict switch name -> ipv4_lpm rules, as from compileIpv4Lpm
+        :param writer: the BatchWriter the updates are sent through
+        """
+        self.topo = topo
+        self.p4info_helper = p4info_helper
+        self.switches = switches
+        self.writer = writer
+        self.high = high
+        self.low = low
+        self.sustain = sustain
+        self.clear = clear
+        self.min_packets = min_packets
+        self.hold = hold
+        self.update_interval = update_interval
+        self._lock = threading.Lock()
+        self._last_update = {}          # switch -> time of its last rule update
+        self._detours = {}              # (switch, destination switch) -> neighbour it detours to
+        self.ports = {}                 # (switch, port) -> PortState
+        for sw in topo.switches:
+            for port, _ in topo.neighbours(sw):
+                self.ports[(sw, port)] = PortState()
+        # (switch, port) -> [(rule, destination switches)] of the remote routes leaving that port
+        self._routes = dict((key, []) for key in self.ports)
+        for sw, sw_rules in rules.items():
+            for rule in sw_rules:
+                key = (sw, rule["action_params"]["port"])
+                if key not in self._routes:
+                    continue    # directly attached hosts
+                network = parseNetwork(rule)
+                dsts = set(host.switch for host in topo.hosts.values()
+                           if host.switch is not None and host.interface.ip in network)
+                self._routes[key].append((rule, dsts))
+
+    def handler(self, ifaces):
+        """
+        The PacketSampler handler for the interfaces of switchInterfaces(),
+        counting the ECN codepoint of every sampled packet against its port.
+        """
+        lock = self._lock
+        states = dict((iface, self.ports[key]) for iface, key in ifaces.items()
+                      if key in self.ports)
+
+        def onPacket(iface, t, flow, tos, length):
+            ecn = tos & ECN_MASK
+            if not ecn:
+                return
+            state = states[iface]
+            with lock:
+                state.ect += 1
+                if ecn == ECN_CE:
+                    state.ce += 1
+        return onPacket
+
+    def detour(self, sw, port, dsts):
+        """
+        The neighbour (port, peer) of sw, other than port, with the shortest
+        loop-free paths to all of dsts, or None. A neighbour currently
+        detouring one of dsts through sw does not qualify.
+        """
+        best = None
+        for alt_port, peer in self.topo.neighbours(sw):
+            if alt_port == port:
+                continue
+            cost = 0
+            for dst in dsts:
+                if dst == peer:
+                    continue
+                if self._detours.get((peer, dst)) == sw:
+                    break
+                try:
+                    path = self.topo.path(peer, dst)
+                except ValueError:
+                    break
+                if any(hop == sw for hop, _ in path):
+                    break
+                cost += len(path)
+            else:
+                if best is None or cost < best[0]:
+                    best = (cost, (alt_port, peer))
+        return best and best[1]
+
+    def tick(self):
+        """Closes the current window and reroutes or restores ports as needed."""
+        now = time.time()
+        with self._lock:
+            windows = []
+            for key, state in self.ports.items():
+                windows.append((key, state, state.ect, state.ce))
+                state.ect = state.ce = 0
+        for (sw, port), state, ect, ce in windows:
+            if ect >= self.min_packets:
+                state.fraction = float(ce) / ect
+            elif state.rerouted is not None:
+                state.fraction = 0.0
+            else:
+                continue
+            if state.fraction >= self.high:
+                state.hot += 1
+                state.cool = 0
+            elif state.fraction <= self.low:
+                state.cool += 1
+                state.hot = 0
+            else:
+                state.hot = state.cool = 0
+            if state.rerouted is None and state.hot >= self.sustain:
+                self._reroute(sw, port, state, now)
+            elif (state.rerouted is not None and state.cool >= self.clear and
+                  now - state.rerouted[0] >= self.hold):
+                self._restore(sw, port, state, now)
+
+    def _rate_limited(self, sw, now):
+        return now - self._last_update.get(sw, 0) < self.update_interval
+
+    def _write(self, sw, rules):
+        conn = self.switches[sw]
+        for rule in rules:
+            self.writer.add(conn, buildEntry(self.p4info_helper, rule), p4runtime_pb2.Update.MODIFY)
+        self.writer.flush(conn)
+
+    def _reroute(self, sw, port, state, now):
+        if self._rate_limited(sw, now):
+            return
+        moved, originals = [], []
+        for rule, dsts in self._routes[(sw, port)]:
+            hop = self.detour(sw, port, dsts)
+            if hop is None:
+                continue
+            alt_port, peer = hop
+            moved.append(dict(rule, action_params=dict(rule["action_params"],
+                                                       dstAddr=self.topo.switch_mac(peer),
+                                                       port=alt_port)))
+            originals.append(rule)
+            for dst in dsts:
+                self._detours[(sw, dst)] = peer
+        if not moved:
+            return
+        self._write(sw, moved)
+        self._last_update[sw] = now
+        state.rerouted = (now, originals)
+        print("%s port %d congested (CE %.1f%% for %d windows): moved %d route(s) away"
+              % (sw, port, 100.0 * state.fraction, state.hot, len(moved)))
+
+    def _restore(self, sw, port, state, now):
+        if self._rate_limited(sw, now):
+            return
+        rules = state.rerouted[1]
+        for _, dsts in self._routes[(sw, port)]:
+            for dst in dsts:
+                self._detours.pop((sw, dst), None)
+        self._write(sw, rules)
+        self._last_update[sw] = now
+        state.rerouted = None
+        print("%s port %d clear (CE %.1f%% for %d windows): restored %d route(s)"
+              % (sw, port, 100.0 * state.fraction, state.cool, len(rules)))
+
+    def print_status(self):
+        for (sw, port), state in sorted(self.ports.items()):
+            flag = "  rerouted" if state.rerouted is not None else ""
+            print("  %s port %d: CE %5.1f%%%s" % (sw, port, 100.0 * state.fraction, flag))
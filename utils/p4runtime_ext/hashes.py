@@ -0,0 +1,44 @@
+# bmv2哈希算法的Python实现，用于在控制器侧算出数据平面的哈希结果（ECMP槽位、Bloom过滤器下标）
+import zlib
+
+
+def _crc16Table():
+    # CRC-16/ARC (poly 0x8005, reflected), bmv2's "crc16", in its reflected table form
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xa001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+_CRC16_TABLE = _crc16Table()
+
+
+def crc16(data):
+    crc = 0
+    for byte in data:
+        crc = (crc >> 8) ^ _CRC16_TABLE[(crc ^ byte) & 0xff]
+    return crc
+
+
+def crc32(data):
+    # bmv2's "crc32" is the usual reflected CRC-32, as in zlib
+    return zlib.crc32(data) & 0xffffffff
+
+
+def packFields(*fields):
+    """
+    Packs header fields the way bmv2 feeds a field list to its hash:
+    (value, bit width) pairs concatenated most significant bit first, padded
+    to whole bytes at the end.
+    """
+    value, width = 0, 0
+    for field, bits in fields:
+        if isinstance(field, bytes):
+            field = int.from_bytes(field, "big")
+        value = (value << bits) | (field & ((1 << bits) - 1))
+        width += bits
+    pad = -width % 8
+    return (value << pad).to_bytes((width + pad) // 8, "big")
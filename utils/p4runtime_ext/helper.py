@@ -0,0 +1,86 @@
+# P4InfoHelper的索引版本：加载p4info时一次性建立名字/ID双向字典，查找不再线性遍历protobuf
+from p4runtime_lib.helper import P4InfoHelper
+
+
+class IndexedP4InfoHelper(P4InfoHelper):
+    """
+    Drop-in P4InfoHelper whose lookups are dict hits instead of scans over
+    the p4info protobuf.
+
+    Every entity with a preamble (tables, actions, counters, registers, ...)
+    is indexed by name, alias and ID, and the match fields and action params
+    of every table and action by name and ID. The indexes are built once, in
+    the constructor; they hold references into self.p4info, which must not be
+    modified afterwards.
+    """
+
+    def __init__(self, p4_info_filepath):
+        super(IndexedP4InfoHelper, self).__init__(p4_info_filepath)
+        self._by_name = {}      # entity_type -> name or alias -> entity
+        self._by_id = {}        # entity_type -> id -> entity
+        for field in self.p4info.DESCRIPTOR.fields:
+            message = field.message_type
+            if message is None or "preamble" not in message.fields_by_name:
+                continue
+            by_name, by_id = {}, {}
+            for o in getattr(self.p4info, field.name):
+                pre = o.preamble
+                # First match wins, like the scan in P4InfoHelper.get()
+                by_name.setdefault(pre.name, o)
+                if pre.alias:
+                    by_name.setdefault(pre.alias, o)
+                by_id.setdefault(pre.id, o)
+            self._by_name[field.name] = by_name
+            self._by_id[field.name] = by_id
+        self._match_fields = self._index_members(self.p4info.tables, "match_fields")
+        self._action_params = self._index_members(self.p4info.actions, "params")
+
+    @staticmethod
+    def _index_members(entities, member):
+        # entity name -> ({member name: member}, {member id: member})
+        index = {}
+        for o in entities:
+            if o.preamble.name in index:
+                continue
+            members = getattr(o, member)
+            index[o.preamble.name] = (dict((m.name, m) for m in reversed(members)),
+                                      dict((m.id, m) for m in reversed(members)))
+        return index
+
+    def get(self, entity_type, name=None, id=None):
+        if name is not None and id is not None:
+            raise AssertionError("name or id must be None")
+        if entity_type not in self._by_name:
+            # Not an entity with a preamble; let the scan raise as it would.
+            return super(IndexedP4InfoHelper, self).get(entity_type, name, id)
+        if name:
+            o = self._by_name[entity_type].get(name)
+            if o is None:
+                raise AttributeError("Could not find %r of type %s" % (name, entity_type))
+        else:
+            o = self._by_id[entity_type].get(id)
+            if o is None:
+                raise AttributeError("Could not find id %r of type %s" % (id, entity_type))
+        return o
+
+    def __getattr__(self, attr):
+        # Keep the get_<type>_id/get_<type>_name lambdas built by the base
+        # class, so the regex match runs once per name instead of per call.
+        if attr.startswith("_"):
+            raise AttributeError(attr)
+        fn = super(IndexedP4InfoHelper, self).__getattr__(attr)
+        self.__dict__[attr] = fn
+        return fn
+
+    def _lookup(self, index, owner, name, id):
+        by_name, by_id = index.get(owner, ({}, {}))
+        member = by_name.get(name) if name is not None else by_id.get(id)
+        if member is None:
+            raise AttributeError("%r has no attribute %r" % (owner, name if name is not None else id))
+        return member
+
+    def get_match_field(self, table_name, name=None, id=None):
+        return self._lookup(self._match_fields, table_name, name, id)
+
+    def get_action_param(self, action_name, name=None, id=None):
+        return self._lookup(self._action_params, action_name, name, id)
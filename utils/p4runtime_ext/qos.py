@@ -0,0 +1,241 @@
+# QoS分类遥测与自适应DSCP策略：按交换机和DSCP类统计吞吐量与交换机内的排队时延，受保护类时延超标时把批量类重标记到低优先级
+import threading
+import time
+
+from p4.v1 import p4runtime_pb2
+
+from .rules import buildEntry
+
+DSCP_EF = 46
+DSCP_CS1 = 8            # lower effort / scavenger
+PENDING_TIMEOUT = 1.0   # seconds an ingress sample waits for its egress copy
+MAX_PENDING = 65536
+MAX_DELAY_SAMPLES = 4096
+
+
+def dscpName(dscp):
+    if dscp == 0:
+        return "BE"
+    if dscp == DSCP_EF:
+        return "EF"
+    if dscp == 44:
+        return "VA"
+    if dscp & 0x07 == 0:
+        return "CS%d" % (dscp >> 3)
+    if dscp & 0x01 == 0 and 1 <= dscp >> 3 <= 4 and 1 <= (dscp >> 1) & 0x03 <= 3:
+        return "AF%d%d" % (dscp >> 3, (dscp >> 1) & 0x03)
+    return "DSCP%d" % dscp
+
+
+def _ms(seconds):
+    return "-" if seconds is None else "%.2fms" % (seconds * 1000)
+
+
+class ClassWindow(object):
+    """Throughput and transit delay of one DSCP class on one switch over a window."""
+
+    def __init__(self):
+        self.packets = 0
+        self.bytes = 0
+        self.delays = []
+
+    def delay(self, q):
+        """Delay quantile q (0..1) in seconds, or None without samples."""
+        if not self.delays:
+            return None
+        ordered = sorted(self.delays)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+class ClassTelemetry(object):
+    """
+    Per-class telemetry from a PacketSampler with ident set, over all the
+    ports of the switches (switchInterfaces(topo, inter_switch_only=False)).
+
+    Throughput is counted on egress, by the DSCP the packet leaves with, so
+    classification done by the pipeline is taken into account. The transit
+    delay of a switch (parsing, queueing and the veth hops) is the time
+    between a packet entering one of its ports and leaving another, matched
+    on source, destination, protocol and IP identification; sampling on the
+    IP identification makes both copies of a packet sampled together.
+    """
+
+    def __init__(self, ifaces, sample_every=1):
+        self.ifaces = dict(ifaces)
+        self.sample_every = sample_every
+        self._pending = {}      # (switch, src, dst, proto, ident) -> ingress time, oldest first
+        self._window = {}       # (switch, dscp) -> ClassWindow
+        self._since = time.time()
+        self._lock = threading.Lock()
+
+    def __call__(self, iface, t, flow, tos, length, outgoing, ident):
+        sw = self.ifaces[iface][0]
+        key = (sw, flow[0], flow[1], flow[2], ident)
+        with self._lock:
+            if not outgoing:
+                if len(self._pending) < MAX_PENDING:
+                    self._pending[key] = t
+                return
+            window = self._window.get((sw, tos >> 2))
+            if window is None:
+                window = self._window[(sw, tos >> 2)] = ClassWindow()
+            window.packets += self.sample_every
+            window.bytes += length * self.sample_every
+            t_in = self._pending.pop(key, None)
+            if t_in is not None and len(window.delays) < MAX_DELAY_SAMPLES:
+                window.delays.append(max(t - t_in, 0.0))
+
+    def tick(self):
+        """
+        Closes the window.
+
+        :return: (seconds, dict (switch, dscp) -> ClassWindow)
+        """
+        now = time.time()
+        with self._lock:
+            window, self._window = self._window, {}
+            elapsed, self._since = max(now - self._since, 1e-9), now
+            # Ingress samples whose egress copy never came (dropped, or sent to the host stack)
+            while self._pending:
+                key = next(iter(self._pending))
+                if now - self._pending[key] < PENDING_TIMEOUT:
+                    break
+                del self._pending[key]
+        return elapsed, window
+
+
+def findDscpTable(p4info_helper):
+    """
+    Looks for a DSCP remap table in the p4info: one exact match field on the
+    DSCP (6 bits) or the whole diffserv/TOS byte (8 bits), and an action with
+    a single parameter taking the new value.
+
+    :return: dict with table, field, field_width, action, param and
+             param_width, or None if the program has no such table
+    """
+    actions = dict((a.preamble.id, a) for a in p4info_helper.p4info.actions)
+    for table in p4info_helper.p4info.tables:
+        if len(table.match_fields) != 1:
+            continue
+        field = table.match_fields[0]
+        name = field.name.lower()
+        if field.match_type != field.EXACT or field.bitwidth not in (6, 8) or \
+                not any(word in name for word in ("dscp", "diffserv", "tos")):
+            continue
+        for ref in table.action_refs:
+            action = actions.get(ref.id)
+            if action is not None and len(action.params) == 1 and \
+                    action.params[0].bitwidth in (6, 8):
+                return {"table": table.preamble.name, "field": field.name,
+                        "field_width": field.bitwidth, "action": action.preamble.name,
+                        "param": action.params[0].name, "param_width": action.params[0].bitwidth}
+    return None
+
+
+class QosPolicy(object):
+    """
+    Protects latency-sensitive classes when a switch comes under load.
+
+    Every tick() closes a telemetry window and prints the throughput and
+    delay of every class. When the 95th percentile delay of a protected
+    class on a switch stays above delay_target for sustain windows, the bulk
+    classes on that switch are remarked to DSCP_CS1 through the DSCP remap
+    table (see findDscpTable), so that the downstream queues serve them
+    last; the entries are deleted again once the protected classes stayed
+    below half the target (or sent nothing) for clear windows. A switch's policy changes at
+    most once every update_interval seconds. Without a remap table the
+    policy only reports what it would do.
+    """
+
+    def __init__(self, telemetry, p4info_helper, switches, writer, protect=(DSCP_EF,),
+                 bulk=(0, 10, 12, 14, 18, 20, 22), delay_target=0.005, sustain=3, clear=10,
+                 update_interval=10.0, min_samples=10):
+        """
+        :param switches: dict switch name -> switch connection
+        :param writer: the BatchWriter remap entries are written through
+        :param protect: DSCP values of the latency-sensitive classes
+        :param bulk: DSCP values remarked under load
+        :param delay_target: seconds
+        """
+        self.telemetry = telemetry
+        self.p4info_helper = p4info_helper
+        self.switches = switches
+        self.writer = writer
+        self.protect = set(protect)
+        self.bulk = list(bulk)
+        self.delay_target = delay_target
+        self.sustain = sustain
+        self.clear = clear
+        self.update_interval = update_interval
+        self.min_samples = min_samples
+        self.remap = findDscpTable(p4info_helper)
+        self.demoted = {}       # switch -> time the bulk classes were remarked
+        self._hot = dict((sw, 0) for sw in switches)
+        self._cool = dict((sw, 0) for sw in switches)
+        self._last_update = {}
+        if self.remap is None:
+            print("No DSCP remap table in the p4info: QoS policy reports only")
+
+    def _remap_rules(self):
+        remap = self.remap
+        rules = []
+        for dscp in self.bulk:
+            # A match on the whole TOS byte needs one entry per ECN codepoint, which is kept
+            for ecn in (range(4) if remap["field_width"] == 8 else (0,)):
+                value = dscp << 2 | ecn if remap["field_width"] == 8 else dscp
+                target = DSCP_CS1 << 2 | ecn if remap["param_width"] == 8 else DSCP_CS1
+                rules.append({
+                    "table": remap["table"],
+                    "match": {remap["field"]: value},
+                    "action_name": remap["action"],
+                    "action_params": {remap["param"]: target},
+                })
+        return rules
+
+    def _apply(self, sw, demote):
+        if self.remap is None:
+            return
+        update_type = p4runtime_pb2.Update.INSERT if demote else p4runtime_pb2.Update.DELETE
+        conn = self.switches[sw]
+        for rule in self._remap_rules():
+            self.writer.add(conn, buildEntry(self.p4info_helper, rule), update_type)
+        self.writer.flush(conn)
+
+    def tick(self):
+        now = time.time()
+        elapsed, window = self.telemetry.tick()
+        worst = {}      # switch -> p95 delay of its worst protected class
+        for (sw, dscp), stats in sorted(window.items()):
+            p95 = stats.delay(0.95)
+            if p95 is not None and dscp in self.protect and len(stats.delays) >= self.min_samples:
+                worst[sw] = max(worst.get(sw, 0.0), p95)
+            print("  %s %-5s %8.0f pkt/s %10.3f Mbit/s  delay p50 %s p95 %s" % (
+                sw, dscpName(dscp), stats.packets / elapsed, stats.bytes * 8 / elapsed / 1e6,
+                _ms(stats.delay(0.5)), _ms(p95)))
+        for sw in self.switches:
+            if sw not in worst:
+                if sw not in self.demoted:
+                    continue
+                worst[sw] = 0.0     # the protected traffic has gone
+            if worst[sw] > self.delay_target:
+                self._hot[sw] += 1
+                self._cool[sw] = 0
+            elif worst[sw] < self.delay_target / 2:
+                self._cool[sw] += 1
+                self._hot[sw] = 0
+            if now - self._last_update.get(sw, 0) < self.update_interval:
+                continue
+            if sw not in self.demoted and self._hot[sw] >= self.sustain:
+                self._apply(sw, True)
+                self.demoted[sw] = now
+                self._last_update[sw] = now
+                print("%s: protected class delay %s above %s for %d windows, %s bulk DSCP %s to CS1"
+                      % (sw, _ms(worst[sw]), _ms(self.delay_target), self._hot[sw],
+                         "remarking" if self.remap else "would remark",
+                         ",".join(str(d) for d in self.bulk)))
+            elif sw in self.demoted and self._cool[sw] >= self.clear:
+                self._apply(sw, False)
+                del self.demoted[sw]
+                self._last_update[sw] = now
+                print("%s: protected class delay back under %s, bulk DSCP restored"
+                      % (sw, _ms(self.delay_target / 2)))
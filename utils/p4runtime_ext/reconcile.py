@@ -0,0 +1,133 @@
+# 增量同步表项：读出交换机当前表项，与期望的规则集比较，只下发需要的INSERT/MODIFY/DELETE
+from p4.v1 import p4runtime_pb2
+
+from .capacity import CapacityError, planUpdates
+
+
+def canonical(value):
+    # P4Runtime servers may return bytestrings without the leading zero bytes
+    # p4runtime_lib.convert pads with, so compare values with them stripped.
+    return value.lstrip(b'\x00')
+
+
+def matchKey(field_match):
+    kind = field_match.WhichOneof("field_match_type")
+    m = getattr(field_match, kind)
+    if kind == "exact":
+        values = (m.value,)
+    elif kind == "lpm":
+        values = (m.value, m.prefix_len)
+    elif kind == "ternary":
+        values = (m.value, m.mask)
+    elif kind == "range":
+        values = (m.low, m.high)
+    else:
+        return field_match.field_id, kind, m.SerializeToString()
+    return (field_match.field_id, kind) + tuple(
+        canonical(v) if isinstance(v, bytes) else v for v in values)
+
+
+def entryKey(entry):
+    """What identifies an entry inside a switch: table, match and priority."""
+    return (entry.table_id, entry.priority,
+            tuple(sorted(matchKey(fm) for fm in entry.match)))
+
+
+def actionKey(entry):
+    action = entry.action
+    if action.WhichOneof("type") != "action":
+        return action.SerializeToString(deterministic=True)
+    return (action.action.action_id,
+            tuple(sorted((p.param_id, canonical(p.value)) for p in action.action.params)))
+
+
+def readEntries(sw):
+    """Reads all (non-default) table entries of the switch, indexed by entryKey."""
+    current = {}
+    for response in sw.ReadTableEntries():
+        for entity in response.entities:
+            entry = entity.table_entry
+            current[entryKey(entry)] = entry
+    return current
+
+
+def diffEntries(current, desired, delete_stale=True):
+    """
+    Computes the updates that turn the current entries into the desired ones.
+
+    :param current: dict entryKey -> TableEntry, as returned by readEntries()
+    :param desired: iterable of TableEntry
+    :param delete_stale: also delete current entries that are not desired
+    :return: list of (update type, TableEntry), inserts and modifies first so
+             that traffic moves to new entries before old ones disappear
+    """
+    updates = []
+    wanted = {}
+    for entry in desired:
+        if entry.is_default_action:
+            # Default entries are not returned by a wildcard read; always set them.
+            updates.append((p4runtime_pb2.Update.MODIFY, entry))
+        else:
+            wanted[entryKey(entry)] = entry
+    for key, entry in wanted.items():
+        if key not in current:
+            updates.append((p4runtime_pb2.Update.INSERT, entry))
+        elif actionKey(current[key]) != actionKey(entry):
+            updates.append((p4runtime_pb2.Update.MODIFY, entry))
+    if delete_stale:
+        for key, entry in current.items():
+            if key not in wanted:
+                updates.append((p4runtime_pb2.Update.DELETE, entry))
+    return updates
+
+
+def reconcile(writer, sw, desired, delete_stale=True, sizes=None):
+    """
+    Brings the tables of a switch to the desired entries with as few updates
+    as possible, sent as batched writes.
+
+    :param writer: the BatchWriter to send the updates with
+    :param sw: the switch connection
+    :param desired: iterable of TableEntry
+    :param delete_stale: also delete entries that are not desired
+    :param sizes: table capacities, from capacity.tableSizes(); when given,
+                  the occupancy of every table touched (installed and after
+                  the updates) is printed, and nothing is written if the
+                  result would not fit
+    :return: dict update type name -> number of updates sent, with the
+             default actions set counted under DEFAULT rather than MODIFY
+    :raises CapacityError: if a table would overflow
+    """
+    current = readEntries(sw)
+    updates = diffEntries(current, desired, delete_stale)
+    if sizes is not None:
+        updates, report = planUpdates(sw.name, current, updates, sizes)
+        report.print_report("Table capacity of %s" % sw.name)
+        if not report.ok:
+            raise CapacityError(report)
+    counts = dict((name, 0) for name in ("INSERT", "MODIFY", "DELETE", "DEFAULT"))
+    for update_type, entry in updates:
+        writer.add(sw, entry, update_type)
+        # Default actions are always set and are not among the entries read back
+        counts["DEFAULT" if entry.is_default_action
+               else p4runtime_pb2.Update.Type.Name(update_type)] += 1
+    writer.flush(sw)
+    print("Reconciled %s: %d inserted, %d modified, %d deleted, %d unchanged, "
+          "%d default action(s) set" % (
+              sw.name, counts["INSERT"], counts["MODIFY"], counts["DELETE"],
+              len(current) - counts["MODIFY"] - counts["DELETE"], counts["DEFAULT"]))
+    return counts
+
+
+def installer(writer, delete_stale=True, sizes=None):
+    """
+    Returns an install_rules hook for bring_up() that reconciles the entries
+    queued on the writer for each switch, instead of inserting them blindly.
+    Works the same on a freshly pushed pipeline (everything is inserted) and
+    on a reattached one (only the differences are written).
+    """
+    def install_rules(sw):
+        desired = [update.entity.table_entry for update in writer.take(sw)
+                   if update.entity.WhichOneof("entity") == "table_entry"]
+        reconcile(writer, sw, desired, delete_stale, sizes)
+    return install_rules
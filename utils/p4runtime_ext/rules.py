@@ -0,0 +1,30 @@
+# 规则字典（与sX-runtime.json中table_entries的格式相同）与P4Runtime表项之间的转换
+
+
+def buildEntry(p4info_helper, rule):
+    """
+    Builds a TableEntry from a rule in the runtime JSON format, e.g.
+    {"table": ..., "match": {...}, "action_name": ..., "action_params": {...}}
+    with the optional "priority" and "default_action" keys.
+    """
+    return p4info_helper.buildTableEntry(
+        table_name=rule["table"],
+        match_fields=rule.get("match"),
+        default_action=rule.get("default_action", False),
+        action_name=rule.get("action_name"),
+        action_params=rule.get("action_params"),
+        priority=rule.get("priority"))
+
+
+def writeRules(p4info_helper, sw, rules):
+    """
+    Writes rules in the runtime JSON format to a switch. Pass a
+    BatchWriter-wrapped switch to have them batched.
+
+    :param p4info_helper: the P4Info helper
+    :param sw: the switch connection
+    :param rules: list of rule dicts
+    """
+    for rule in rules:
+        sw.WriteTableEntry(buildEntry(p4info_helper, rule))
+    print("Installed %d rules on %s" % (len(rules), sw.name))
@@ -0,0 +1,158 @@
+# 基于asyncio的控制器运行时：统一接管各交换机的StreamChannel，按消息类型分发事件，并在同一事件循环上调度周期任务
+import asyncio
+import functools
+import threading
+import traceback
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import grpc
+from p4.v1 import p4runtime_pb2
+
+# StreamMessageResponse update kinds handlers can be registered for
+EVENTS = ("packet", "digest", "idle_timeout_notification", "arbitration", "error")
+
+
+class ControllerRuntime(object):
+    """
+    Event loop for a running controller.
+
+    Each switch's StreamChannel is read by a daemon thread (the gRPC stream is
+    a blocking iterator) that hands every message to the loop; the loop calls
+    the handlers registered with on() for its kind. Jobs registered with
+    every() run at a fixed rate on the same loop: coroutine functions are
+    awaited, plain functions (e.g. counter polls, which block on gRPC) run in
+    a thread pool so that they never stall event dispatch.
+
+    Start the runtime after bring_up(): MasterArbitrationUpdate reads its
+    answer from the same stream.
+    """
+
+    def __init__(self, switches, max_workers=None):
+        """
+        :param switches: the switch connections whose streams to serve
+        :param max_workers: threads for blocking jobs and handlers
+        """
+        self.switches = list(switches)
+        self._handlers = defaultdict(list)  # event -> [handler(sw, message)]
+        self._jobs = []                     # (interval, job, args)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._loop = None
+        self._queue = None
+        self._tasks = set()                 # running coroutine handlers
+
+    def on(self, event, handler):
+        """
+        Registers handler(sw, message) for a stream event, e.g. "packet" gets
+        the PacketIn, "digest" the DigestList. Coroutine functions are run as
+        tasks; plain functions are called on the loop and should not block.
+        """
+        if event not in EVENTS:
+            raise ValueError("Unknown stream event %r, expected one of %s"
+                             % (event, ", ".join(EVENTS)))
+        self._handlers[event].append(handler)
+        return handler
+
+    def every(self, interval, job, *args):
+        """Runs job(*args) every interval seconds, starting one interval after serve()."""
+        self._jobs.append((interval, job, args))
+
+    def packet_out(self, sw, payload, metadata=()):
+        """
+        Sends a PacketOut on the switch's stream.
+
+        :param metadata: (metadata_id, value bytes) pairs
+        """
+        request = p4runtime_pb2.StreamMessageRequest()
+        request.packet.payload = payload
+        for metadata_id, value in metadata:
+            m = request.packet.metadata.add()
+            m.metadata_id = metadata_id
+            m.value = value
+        sw.requests_stream.put(request)
+
+    async def run_blocking(self, fn, *args, **kwargs):
+        """Runs a blocking call (e.g. a P4Runtime RPC) in the thread pool."""
+        return await self._loop.run_in_executor(
+            self._executor, functools.partial(fn, *args, **kwargs))
+
+    def _read_stream(self, sw):
+        try:
+            for message in sw.stream_msg_resp:
+                self._loop.call_soon_threadsafe(self._queue.put_nowait, (sw, message))
+        except grpc.RpcError as e:
+            if e.code() != grpc.StatusCode.CANCELLED:
+                print("%s stream closed: %s (%s)" % (sw.name, e.details(), e.code().name))
+        except ValueError:
+            # The channel was closed under the iterator on shutdown
+            pass
+
+    async def _dispatch(self):
+        while True:
+            sw, message = await self._queue.get()
+            event = message.WhichOneof("update")
+            for handler in self._handlers.get(event, ()):
+                try:
+                    result = handler(sw, getattr(message, event))
+                    if asyncio.iscoroutine(result):
+                        task = self._loop.create_task(result)
+                        self._tasks.add(task)
+                        task.add_done_callback(
+                            functools.partial(self._handler_done, handler, sw, event))
+                except Exception:
+                    print("Handler %r failed on %s %s:" % (handler, sw.name, event))
+                    traceback.print_exc()
+
+    def _handler_done(self, handler, sw, event, task):
+        # The loop only keeps weak references to tasks: hold them until they end
+        self._tasks.discard(task)
+        if task.cancelled() or task.exception() is None:
+            return
+        e = task.exception()
+        print("Handler %r failed on %s %s:" % (handler, sw.name, event))
+        traceback.print_exception(type(e), e, e.__traceback__)
+
+    async def _periodic(self, interval, job, args):
+        # Fixed-rate schedule: a slow run delays the next one, it is not queued up
+        next_run = self._loop.time() + interval
+        while True:
+            await asyncio.sleep(next_run - self._loop.time())
+            try:
+                if asyncio.iscoroutinefunction(job):
+                    await job(*args)
+                else:
+                    await self.run_blocking(job, *args)
+            except grpc.RpcError as e:
+                print("Job %r failed: %s (%s)" % (job, e.details(), e.code().name))
+            except Exception:
+                print("Job %r failed:" % (job,))
+                traceback.print_exc()
+            next_run = max(next_run + interval, self._loop.time())
+
+    async def serve(self, duration=None):
+        """Serves the streams and jobs, forever or for duration seconds."""
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        for sw in self.switches:
+            thread = threading.Thread(target=self._read_stream, args=(sw,),
+                                      name="stream-%s" % sw.name)
+            thread.daemon = True
+            thread.start()
+        tasks = [self._loop.create_task(self._dispatch())]
+        tasks.extend(self._loop.create_task(self._periodic(interval, job, args))
+                     for interval, job, args in self._jobs)
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=duration,
+                                         return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                task.result()
+        finally:
+            for task in tasks + list(self._tasks):
+                task.cancel()
+
+    def run(self, duration=None):
+        """Blocking entry point for the controllers; see serve()."""
+        try:
+            asyncio.run(self.serve(duration))
+        finally:
+            self._executor.shutdown(wait=False)
@@ -0,0 +1,269 @@
+# 运行时JSON（sX-runtime.json）加载：多进程并行解析各交换机的文件，按p4info检查表名、动作名、匹配域和位宽，
+# 全部通过后才连接交换机，按交换机并行批量下发
+import ipaddress
+import json
+import os
+import re
+from collections import OrderedDict
+from multiprocessing import Pool
+
+from p4.v1 import p4runtime_pb2
+
+from .batch import BatchWriter
+from .bringup import DEFAULT_TIMEOUT, bring_up
+from .capacity import checkPending, tableSizes
+from .helper import IndexedP4InfoHelper
+from .reconcile import installer
+from .rules import buildEntry
+
+MAC = re.compile(r"^([0-9a-fA-F]{2}:){5}[0-9a-fA-F]{2}$")
+PRIORITY_KINDS = ("ternary", "range", "optional")
+
+
+class RuntimeValidationError(Exception):
+    """
+    Raised by loadRuntimeFiles() when runtime files do not match their
+    p4info, before anything is written.
+
+    :param errors: list of (file path, entry index or None, message)
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        super(RuntimeValidationError, self).__init__(errors)
+
+    def __str__(self):
+        lines = ["%d problem(s) in the runtime files:" % len(self.errors)]
+        for path, index, message in self.errors:
+            where = path if index is None else "%s entry %d" % (path, index)
+            lines.append("  %s: %s" % (where, message))
+        return "\n".join(lines)
+
+
+class RuntimeFile(object):
+    """A parsed runtime JSON file and its table entries, encoded."""
+
+    def __init__(self, path, p4info, bmv2_json, entries):
+        self.path = path
+        self.p4info = p4info            # p4info file the entries were checked against
+        self.bmv2_json = bmv2_json
+        self.entries = entries          # list of TableEntry
+
+
+def _intValue(value):
+    # What p4runtime_lib.convert.encode turns the value into: ints, MAC and IPv4 strings
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str):
+        if MAC.match(value):
+            return int(value.replace(":", ""), 16)
+        try:
+            return int(ipaddress.IPv4Address(value))
+        except ValueError:
+            return None
+    return None
+
+
+def _checkValue(value, width, what):
+    number = _intValue(value)
+    if number is None:
+        return ["%s: %r is not a number, MAC or IPv4 address" % (what, value)]
+    if number < 0 or number.bit_length() > width:
+        return ["%s: %r does not fit in %d bits" % (what, value, width)]
+    return []
+
+
+def _checkMatch(kind, width, value, what):
+    if kind in ("exact", "optional"):
+        return _checkValue(value, width, what)
+    if not isinstance(value, list) or len(value) != 2:
+        return ["%s: a %s match is a [value, %s] pair, not %r"
+                % (what, kind, {"lpm": "prefix_len", "ternary": "mask"}.get(kind, "high"), value)]
+    if kind == "lpm":
+        errors = _checkValue(value[0], width, what)
+        if not isinstance(value[1], int) or not 0 <= value[1] <= width:
+            errors.append("%s: bad prefix length %r" % (what, value[1]))
+        return errors
+    errors = _checkValue(value[0], width, what) + _checkValue(value[1], width, what)
+    if kind == "range" and not errors and _intValue(value[0]) > _intValue(value[1]):
+        errors.append("%s: empty range %r" % (what, value))
+    return errors
+
+
+class RuleValidator(object):
+    """
+    Checks rules in the runtime JSON format against a p4info: the table,
+    its match fields and their kinds and widths, the priority, and the
+    action, which must be one of the table's, with all its parameters.
+
+    What is needed of a table or an action is looked up once and kept.
+    """
+
+    def __init__(self, p4info_helper):
+        self.p4info_helper = p4info_helper
+        self._tables = {}       # name -> (OrderedDict field -> (kind, width), needs priority, action ids)
+        self._actions = {}      # name -> (id, [(param, width)])
+
+    def _table(self, name):
+        if name not in self._tables:
+            table = self.p4info_helper.get("tables", name=name)
+            fields = OrderedDict((field.name, (field.MatchType.Name(field.match_type).lower(),
+                                               field.bitwidth))
+                                 for field in table.match_fields)
+            self._tables[name] = (fields, any(kind in PRIORITY_KINDS for kind, _ in fields.values()),
+                                  set(ref.id for ref in table.action_refs))
+        return self._tables[name]
+
+    def _action(self, name):
+        if name not in self._actions:
+            action = self.p4info_helper.get("actions", name=name)
+            self._actions[name] = (action.preamble.id,
+                                   [(param.name, param.bitwidth) for param in action.params])
+        return self._actions[name]
+
+    def validate(self, rule):
+        """:return: list of problems, empty if the rule can be written"""
+        if not isinstance(rule, dict):
+            return ["an entry is an object, not %r" % (rule,)]
+        table_name = rule.get("table")
+        try:
+            fields, needs_priority, action_ids = self._table(table_name)
+        except AttributeError:
+            return ["unknown table %r" % table_name]
+        errors = []
+        if rule.get("default_action"):
+            if rule.get("match"):
+                errors.append("a default action entry has no match")
+        else:
+            match = rule.get("match") or {}
+            for name, value in match.items():
+                if name not in fields:
+                    errors.append("%s has no match field %r" % (table_name, name))
+                else:
+                    kind, width = fields[name]
+                    errors.extend(_checkMatch(kind, width, value, "%s %s" % (table_name, name)))
+            for name, (kind, _) in fields.items():
+                if kind == "exact" and name not in match:
+                    errors.append("%s needs a value for its exact match field %s"
+                                  % (table_name, name))
+            priority = rule.get("priority")
+            if needs_priority:
+                if not isinstance(priority, int) or isinstance(priority, bool) or priority <= 0:
+                    errors.append("%s has ternary, range or optional fields and needs a "
+                                  "positive priority" % table_name)
+            elif priority:
+                errors.append("%s only has exact and lpm fields, which take no priority"
+                              % table_name)
+        action_name = rule.get("action_name")
+        try:
+            action_id, declared = self._action(action_name)
+        except AttributeError:
+            return errors + ["unknown action %r" % action_name]
+        if action_id not in action_ids:
+            errors.append("%s is not an action of %s" % (action_name, table_name))
+        params = rule.get("action_params") or {}
+        for name, width in declared:
+            if name not in params:
+                errors.append("%s needs its parameter %s" % (action_name, name))
+            else:
+                errors.extend(_checkValue(params[name], width, "%s %s" % (action_name, name)))
+        if len(params) > len(declared):
+            names = set(name for name, _ in declared)
+            errors.extend("%s has no parameter %r" % (action_name, name)
+                          for name in params if name not in names)
+        return errors
+
+
+_validators = {}    # p4info path -> RuleValidator, per worker process
+
+
+def _loadFile(path):
+    """
+    Parses, validates and encodes one runtime file; runs in a worker
+    process, so the entries travel back serialized.
+
+    :return: (p4info, bmv2_json, [serialized TableEntry], [(path, index, message)])
+    """
+    try:
+        with open(path, 'r') as f:
+            runtime = json.load(f)
+    except (IOError, ValueError) as e:
+        return None, None, [], [(path, None, str(e))]
+    p4info, bmv2_json = runtime.get("p4info"), runtime.get("bmv2_json")
+    if p4info is None or bmv2_json is None:
+        return None, None, [], [(path, None, "the p4info and bmv2_json files must be given")]
+    if p4info not in _validators:
+        try:
+            _validators[p4info] = RuleValidator(IndexedP4InfoHelper(p4info))
+        except Exception as e:
+            return p4info, bmv2_json, [], [(path, None, "cannot load %s: %s" % (p4info, e))]
+    validator = _validators[p4info]
+    entries, errors = [], []
+    for index, rule in enumerate(runtime.get("table_entries", ())):
+        problems = validator.validate(rule)
+        errors.extend((path, index, problem) for problem in problems)
+        if not errors:
+            entries.append(buildEntry(validator.p4info_helper, rule).SerializeToString())
+    return p4info, bmv2_json, entries, errors
+
+
+def loadRuntimeFiles(paths, processes=None):
+    """
+    Loads runtime JSON files in parallel, one worker process per file up to
+    the number of CPUs. Each file is checked against the p4info it names
+    (paths relative to the current directory, as for the tutorial's
+    run_exercise) and its entries are encoded into TableEntry messages in
+    the worker, so encoding is parallel too.
+
+    :return: OrderedDict path -> RuntimeFile, in the order given
+    :raises RuntimeValidationError: with the problems of all files, if any
+    """
+    paths = list(paths)
+    processes = processes or min(len(paths), os.cpu_count() or 1)
+    if processes > 1:
+        with Pool(processes) as pool:
+            results = pool.map(_loadFile, paths)
+    else:
+        results = [_loadFile(path) for path in paths]
+    errors = [error for _, _, _, file_errors in results for error in file_errors]
+    if errors:
+        raise RuntimeValidationError(errors)
+    loaded = OrderedDict()
+    for path, (p4info, bmv2_json, entries, _) in zip(paths, results):
+        loaded[path] = RuntimeFile(path, p4info, bmv2_json, [
+            p4runtime_pb2.TableEntry.FromString(entry) for entry in entries])
+    return loaded
+
+
+def applyRuntimeFiles(switch_files, batch_size, timeout=DEFAULT_TIMEOUT):
+    """
+    Brings up the switches with their runtime files: the pipeline named in
+    the file and its entries, reconciled with what the switch holds in
+    batched writes, all switches in parallel whatever their program (see
+    bring_up). The entries of every switch are checked against the table
+    sizes of its program first.
+
+    :param switch_files: list of (switch connection, RuntimeFile)
+    :raises CapacityError: if the entries do not fit, before any write
+    :raises BringUpError: if a switch failed
+    """
+    groups = OrderedDict()      # (p4info, bmv2_json) -> [(sw, RuntimeFile)]
+    for sw, runtime in switch_files:
+        groups.setdefault((runtime.p4info, runtime.bmv2_json), []).append((sw, runtime))
+    # Every program is checked before any switch is written
+    pipelines = {}      # switch name -> (p4info_helper, bmv2_json, install_rules)
+    for (p4info, bmv2_json), members in groups.items():
+        p4info_helper = IndexedP4InfoHelper(p4info)
+        writer = BatchWriter(batch_size=batch_size, autoflush=False)
+        for sw, runtime in members:
+            for entry in runtime.entries:
+                writer.add(sw, entry)
+        sizes = tableSizes(p4info_helper, bmv2_json)
+        checkPending(writer, [sw for sw, _ in members], sizes)
+        install_rules = installer(writer, sizes=sizes)
+        for sw, _ in members:
+            pipelines[sw.name] = (p4info_helper, bmv2_json, install_rules)
+    bring_up([sw for sw, _ in switch_files], None, None, timeout=timeout,
+             pipelines=pipelines)
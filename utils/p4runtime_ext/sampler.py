@@ -0,0 +1,163 @@
+# 交换机端口抽样：在控制器所在的根命名空间直接打开sX-ethY的原始套接字，内核BPF按1/N随机抽样，只解析需要的IPv4字段
+import ctypes
+import fcntl
+import os
+import re
+import select
+import socket
+import struct
+import threading
+import time
+
+ETH_P_ALL = 0x0003
+ETH_P_IP = 0x0800
+SO_ATTACH_FILTER = 26
+PACKET_OUTGOING = 4
+SIOCGSTAMP = 0x8906
+SKF_AD_RAND = 0xfffff000 + 56   # SKF_AD_OFF + SKF_AD_RAND: a random 32-bit value
+SNAPLEN = 64    # Ethernet + IPv4 header + ports, without IP options
+
+INCOMING, OUTGOING, BOTH = "in", "out", "both"
+
+
+def bpfSampleIpv4(sample_every=1, snaplen=SNAPLEN, consistent=False):
+    """
+    Classic BPF keeping one in sample_every IPv4 frames, chosen at random in
+    the kernel. With consistent, the choice is made on the IP identification
+    instead, so that every interface a packet crosses samples it or none do.
+    """
+    if consistent:
+        pick = (0x28, 0, 0, 18)                         # ldh [18], the IP identification
+    else:
+        pick = (0x20, 0, 0, SKF_AD_RAND)                # ld rand
+    insns = [(0x28, 0, 0, 12)]                          # ldh [12]
+    if sample_every > 1:
+        insns += [
+            (0x15, 0, 4, ETH_P_IP),                     # jeq #0x800 else drop
+            pick,
+            (0x94, 0, 0, sample_every),                 # mod #sample_every
+            (0x15, 0, 1, 0),                            # jeq #0 else drop
+        ]
+    else:
+        insns += [(0x15, 0, 1, ETH_P_IP)]
+    insns += [(0x06, 0, 0, snaplen), (0x06, 0, 0, 0)]   # ret #snaplen / ret #0
+    return b"".join(struct.pack("HBBI", *insn) for insn in insns)
+
+
+def kernelTimestamp(sock):
+    # Receive time of the last packet read from the socket, taken by the kernel
+    sec, usec = struct.unpack("@ll", fcntl.ioctl(sock, SIOCGSTAMP, b"\0" * 16))
+    return sec + usec * 1e-6
+
+
+def openSampler(iface, code):
+    # Created with protocol 0 so nothing is queued before the filter is attached
+    s = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, 0)
+    prog = ctypes.create_string_buffer(code)
+    s.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER,
+                 struct.pack("HL", len(code) // 8, ctypes.addressof(prog)))
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    s.bind((iface, ETH_P_ALL))
+    return s
+
+
+class PacketSampler(object):
+    """
+    Samples the IPv4 packets crossing switch interfaces (e.g. s1-eth2, whose
+    port number is the one in topology.json) and calls
+    handler(iface, time, flow, tos, ip_length) for each, flow being
+    (src, dst, proto, sport, dport) with the addresses as 4-byte strings.
+
+    On a switch interface OUTGOING packets are those the switch sends out of
+    that port, INCOMING the ones it receives on it. All interfaces are read
+    by one thread.
+
+    With ident, packets are sampled on their IP identification (see
+    bpfSampleIpv4), timestamped by the kernel, and the handler gets two more
+    arguments, whether the packet was outgoing and its IP identification, to
+    match the samples of one packet across interfaces.
+    """
+
+    def __init__(self, ifaces, handler, sample_every=1, direction=OUTGOING, ident=False):
+        self.ifaces = list(ifaces)
+        self.handler = handler
+        self.sample_every = sample_every
+        self.direction = direction
+        self.ident = ident
+        self.packets = 0
+        self._sockets = {}
+        self._thread = None
+        self._running = False
+
+    def start(self):
+        code = bpfSampleIpv4(self.sample_every, consistent=self.ident)
+        for iface in self.ifaces:
+            self._sockets[openSampler(iface, code)] = iface
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="sampler")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+        for s in self._sockets:
+            s.close()
+        self._sockets = {}
+
+    def _run(self):
+        buf = bytearray(SNAPLEN)
+        unpack_from = struct.unpack_from
+        direction = self.direction
+        ident = self.ident
+        while self._running:
+            ready, _, _ = select.select(list(self._sockets), [], [], 0.5)
+            for s in ready:
+                n, addr = s.recvfrom_into(buf)
+                outgoing = addr[2] == PACKET_OUTGOING
+                if n < 34 or (direction == OUTGOING and not outgoing) or \
+                        (direction == INCOMING and outgoing):
+                    continue
+                ver_ihl, tos, length = unpack_from("!BBH", buf, 14)
+                proto = buf[23]
+                l4 = 14 + ((ver_ihl & 0x0f) << 2)
+                if proto in (6, 17) and n >= l4 + 4:
+                    sport, dport = unpack_from("!HH", buf, l4)
+                else:
+                    sport = dport = 0
+                flow = (bytes(buf[26:30]), bytes(buf[30:34]), proto, sport, dport)
+                self.packets += 1
+                if ident:
+                    self.handler(self._sockets[s], kernelTimestamp(s), flow, tos, length,
+                                 outgoing, unpack_from("!H", buf, 18)[0])
+                else:
+                    self.handler(self._sockets[s], time.time(), flow, tos, length)
+
+
+def switchInterfaces(topo, inter_switch_only=True):
+    """
+    Mininet interface names of the switch ports in a Topology:
+    {'s1-eth2': ('s1', 2), ...}
+    """
+    ifaces = {}
+    for sw, ports in topo.ports.items():
+        for port, (peer, _) in ports.items():
+            if inter_switch_only and peer not in topo.switches:
+                continue
+            ifaces["%s-eth%d" % (sw, port)] = (sw, port)
+    return ifaces
+
+
+def localInterfaces(switch):
+    """
+    The interfaces of a running switch found on this host, for exercises
+    without a topology.json: {'s1-eth1': ('s1', 1), ...}
+    """
+    ifaces = {}
+    for name in os.listdir("/sys/class/net"):
+        m = re.match(r"^%s-eth(\d+)$" % re.escape(switch), name)
+        if m:
+            ifaces[name] = (switch, int(m.group(1)))
+    return ifaces
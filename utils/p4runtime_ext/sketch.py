@@ -0,0 +1,75 @@
+# 流量大象流检测：SpaceSaving概要结构，固定k个计数器跟踪出现最多的流，内存与流数无关
+import heapq
+
+
+class SpaceSaving(object):
+    """
+    Top-k heavy hitters of a weighted stream in O(k) memory (Metwally et al.).
+
+    Every tracked key has a count and an error bound: a new key evicts the
+    key with the smallest count and inherits it, so count - error <= true
+    weight <= count. Any key whose true weight is above total / k is
+    guaranteed to be tracked.
+
+    The minimum is found through a heap with lazy deletion: entries are
+    pushed on every update and stale ones skipped when popped, so offer() is
+    O(log k) amortized; the heap is rebuilt when it grows past 4k entries.
+    """
+
+    def __init__(self, k):
+        if k < 1:
+            raise ValueError("SpaceSaving needs k >= 1, got %r" % k)
+        self.k = k
+        self.total = 0
+        self.counts = {}        # key -> count
+        self.errors = {}        # key -> overestimation bound
+        self._heap = []         # (count, seq, key), possibly stale
+        self._seq = 0
+
+    def __len__(self):
+        return len(self.counts)
+
+    def _push(self, key, count):
+        self._seq += 1
+        heapq.heappush(self._heap, (count, self._seq, key))
+        if len(self._heap) > 4 * self.k:
+            self._heap = [(c, s, k) for c, s, k in self._heap if self.counts.get(k) == c]
+            heapq.heapify(self._heap)
+
+    def offer(self, key, weight=1):
+        self.total += weight
+        counts = self.counts
+        if key in counts:
+            counts[key] += weight
+        elif len(counts) < self.k:
+            counts[key] = weight
+            self.errors[key] = 0
+        else:
+            while True:
+                count, _, victim = heapq.heappop(self._heap)
+                if counts.get(victim) == count:
+                    break
+            del counts[victim]
+            del self.errors[victim]
+            counts[key] = count + weight
+            self.errors[key] = count
+        self._push(key, counts[key])
+
+    def top(self, n=None):
+        """:return: [(key, count, error)] by decreasing count"""
+        items = sorted(self.counts.items(), key=lambda item: -item[1])
+        if n is not None:
+            items = items[:n]
+        return [(key, count, self.errors[key]) for key, count in items]
+
+    def heavy(self, fraction):
+        """Keys whose guaranteed weight (count - error) is at least fraction of the total."""
+        threshold = fraction * self.total
+        return [(key, count, error) for key, count, error in self.top()
+                if count - error >= threshold]
+
+    def clear(self):
+        self.total = 0
+        self.counts.clear()
+        self.errors.clear()
+        self._heap = []
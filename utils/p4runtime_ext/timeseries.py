@@ -0,0 +1,154 @@
+# 计数器时间序列：预分配的环形缓冲区按(交换机, 计数器, 索引)保存历史，旧数据降采样，内存不随运行时间增长
+import numpy as np
+
+DEFAULT_CAPACITY = 1800          # raw samples kept per series (1h at a 2s poll)
+DEFAULT_COARSE_STEP = 60.0       # seconds between downsampled samples
+DEFAULT_COARSE_CAPACITY = 1440   # downsampled samples kept per series (24h at 60s)
+
+FIELDS = ("packets", "bytes")
+
+
+class _Ring(object):
+    """Fixed-size ring of (time, packets, bytes) samples, one row per series."""
+
+    def __init__(self, rows, capacity):
+        self.capacity = capacity
+        self.times = np.zeros((rows, capacity))
+        self.values = dict((field, np.zeros((rows, capacity), np.uint64)) for field in FIELDS)
+        self.head = np.zeros(rows, np.int64)    # next slot to write
+        self.count = np.zeros(rows, np.int64)
+
+    def append(self, rows, t, packets, byte_counts):
+        pos = self.head[rows]
+        self.times[rows, pos] = t
+        self.values["packets"][rows, pos] = packets
+        self.values["bytes"][rows, pos] = byte_counts
+        self.head[rows] = (pos + 1) % self.capacity
+        self.count[rows] = np.minimum(self.count[rows] + 1, self.capacity)
+
+    def read(self, row, field):
+        """:return: (times, values) of one series, oldest first"""
+        n = self.count[row]
+        order = (self.head[row] - n + np.arange(n)) % self.capacity
+        return self.times[row, order], self.values[field][row, order]
+
+
+class TimeSeriesStore(object):
+    """
+    History of cumulative counter values, keyed by (switch, counter, index).
+
+    All memory is allocated up front for max_series series: a raw tier of
+    the most recent samples and a downsampled tier keeping one sample every
+    coarse_step seconds for much longer. Series must be registered with
+    track() and are filled by record(), normally from CounterCollector.poll().
+    """
+
+    def __init__(self, max_series, capacity=DEFAULT_CAPACITY,
+                 coarse_step=DEFAULT_COARSE_STEP, coarse_capacity=DEFAULT_COARSE_CAPACITY):
+        self.max_series = max_series
+        self.coarse_step = coarse_step
+        self._raw = _Ring(max_series, capacity)
+        self._coarse = _Ring(max_series, coarse_capacity)
+        self._last_coarse = np.full(max_series, -np.inf)
+        self._rows = {}         # (switch, counter, index) -> row
+        self._groups = {}       # (switch, counter) -> (indices, rows) arrays
+
+    def track(self, sw_name, counter_name, indices):
+        """Registers the series of the given counter indices on a switch."""
+        indices = [i for i in indices if (sw_name, counter_name, i) not in self._rows]
+        if len(self._rows) + len(indices) > self.max_series:
+            raise ValueError("Cannot track %d more series, store holds %d of %d"
+                             % (len(indices), len(self._rows), self.max_series))
+        for i in indices:
+            self._rows[(sw_name, counter_name, i)] = len(self._rows)
+        tracked = sorted((i, row) for (sw, counter, i), row in self._rows.items()
+                         if (sw, counter) == (sw_name, counter_name))
+        self._groups[(sw_name, counter_name)] = (
+            np.asarray([i for i, _ in tracked], np.int64),
+            np.asarray([row for _, row in tracked], np.int64))
+
+    def record(self, sw_name, counter_name, t, packets, byte_counts):
+        """
+        Stores one snapshot of a counter array; only tracked indices are kept.
+
+        :param t: the snapshot time
+        :param packets: packet counts of the whole counter array
+        :param byte_counts: byte counts of the whole counter array
+        """
+        group = self._groups.get((sw_name, counter_name))
+        if group is None:
+            return
+        indices, rows = group
+        self._raw.append(rows, t, packets[indices], byte_counts[indices])
+        due = t - self._last_coarse[rows] >= self.coarse_step
+        if due.any():
+            self._coarse.append(rows[due], t, packets[indices[due]], byte_counts[indices[due]])
+            self._last_coarse[rows[due]] = t
+
+    def series(self, key, field="packets", since=None):
+        """
+        The samples of one series, oldest first: downsampled ones from before
+        the raw tier, then the raw ones.
+
+        :param key: (switch, counter, index)
+        :param since: only samples at or after this time
+        :return: (times, values) arrays
+        """
+        row = self._rows[key]
+        raw_t, raw_v = self._raw.read(row, field)
+        coarse_t, coarse_v = self._coarse.read(row, field)
+        if len(raw_t):
+            older = coarse_t < raw_t[0]
+            coarse_t, coarse_v = coarse_t[older], coarse_v[older]
+        times = np.concatenate((coarse_t, raw_t))
+        values = np.concatenate((coarse_v, raw_v))
+        if since is not None:
+            keep = times >= since
+            times, values = times[keep], values[keep]
+        return times, values
+
+    def _increments(self, key, field, window):
+        # Per-interval increases over the last window seconds; a value that
+        # went down means the counter was reset, and counts from zero.
+        times, values = self.series(key, field)
+        if len(times) < 2:
+            return times[:0], np.zeros(0)
+        start = times[-1] - window if window is not None else times[0]
+        first = max(np.searchsorted(times, start, side="right") - 1, 0)
+        times, values = times[first:], values[first:].astype(np.int64)
+        increments = np.diff(values)
+        reset = increments < 0
+        increments[reset] = values[1:][reset]
+        return times, increments
+
+    def window_sum(self, key, window=None, field="packets"):
+        """Total increase over the last window seconds (all history if None)."""
+        return int(self._increments(key, field, window)[1].sum())
+
+    def rate(self, key, window=None, field="packets"):
+        """Average rate per second over the last window seconds."""
+        times, increments = self._increments(key, field, window)
+        if not len(increments) or times[-1] <= times[0]:
+            return 0.0
+        return increments.sum() / (times[-1] - times[0])
+
+    def percentile(self, key, q, window=None, field="packets"):
+        """The q-th percentile of the per-interval rates over the last window seconds."""
+        times, increments = self._increments(key, field, window)
+        if not len(increments):
+            return 0.0
+        dt = np.diff(times)
+        rates = np.divide(increments, dt, out=np.zeros(len(dt)), where=dt > 0)
+        return float(np.percentile(rates, q))
+
+
+def printTunnelTrends(store, tunnels, counter_name, windows=(60, 600, 3600)):
+    """Prints the average and p95 packet rate of every tunnel over each window."""
+    print('\n----- Tunnel packet rates (avg/p95 pps) -----')
+    header = "".join("%16s" % ("last %ds" % w) for w in windows)
+    print(" %-18s%s" % ("tunnel", header))
+    for tunnel_id, ingress, egress in tunnels:
+        key = (ingress, counter_name, tunnel_id)
+        cells = "".join("%16s" % ("%.1f/%.1f" % (store.rate(key, w), store.percentile(key, 95, w)))
+                        for w in windows)
+        print(" %-18s%s" % ("%d %s->%s" % (tunnel_id, ingress, egress), cells))
@@ -0,0 +1,146 @@
+# 读取topology.json（与run_exercise.py相同的格式），计算交换机间的最短路径下一跳
+import ipaddress
+import json
+import re
+from collections import OrderedDict, deque
+
+
+def parseNode(node):
+    """
+    Splits a link endpoint as written in topology.json: 's1-p3' -> ('s1', 3),
+    'h1' -> ('h1', None).
+    """
+    m = re.match(r"^(\w+)-p(\d+)$", node)
+    if m:
+        return m.group(1), int(m.group(2))
+    return node, None
+
+
+def switchNumber(name):
+    # s1 -> 1, used for the per-switch MAC and swid conventions of the exercises
+    return int(re.search(r"(\d+)$", name).group(1))
+
+
+class Host(object):
+    def __init__(self, name, ip, mac, switch=None, port=None):
+        self.name = name
+        self.interface = ipaddress.ip_interface(ip)
+        self.mac = mac
+        self.switch = switch    # switch the host is attached to
+        self.port = port        # switch port facing the host
+
+    @property
+    def ip(self):
+        return str(self.interface.ip)
+
+
+class Topology(object):
+    """
+    Hosts, switches and links of an exercise topology, with shortest-path
+    next hops between switches.
+
+    Switch-to-switch next hops are computed with one BFS per destination
+    switch, i.e. O(S * (S + L)) for S switches and L links, and cached.
+    """
+
+    def __init__(self, hosts, switches, links):
+        self.hosts = OrderedDict()
+        self.switches = OrderedDict((name, dict(conf or {})) for name, conf in switches.items())
+        self.switch_index = dict((name, i) for i, name in enumerate(self.switches))
+        self.ports = dict((name, {}) for name in self.switches)  # sw -> port -> (peer, peer_port)
+        for name, conf in hosts.items():
+            self.hosts[name] = Host(name, conf["ip"], conf["mac"])
+        for link in links:
+            (a, a_port), (b, b_port) = parseNode(link[0]), parseNode(link[1])
+            self._connect(a, a_port, b, b_port)
+            self._connect(b, b_port, a, a_port)
+        # sw -> [(port, peer_switch)] for the switch-to-switch links, by port
+        self.adjacency = dict(
+            (sw, sorted((port, peer) for port, (peer, _) in ports.items()
+                        if peer in self.switches))
+            for sw, ports in self.ports.items())
+        self._next_hops = {}
+
+    @classmethod
+    def load(cls, topo_file_path):
+        with open(topo_file_path) as f:
+            topo = json.load(f)
+        return cls(topo.get("hosts", {}), topo.get("switches", {}), topo.get("links", []))
+
+    def _connect(self, node, port, peer, peer_port):
+        if node in self.hosts:
+            host = self.hosts[node]
+            host.switch, host.port = peer, peer_port
+        elif node in self.switches:
+            if port is None:
+                raise ValueError("Link to switch %s has no port" % node)
+            self.ports[node][port] = (peer, peer_port)
+        else:
+            raise ValueError("Link references unknown node %r" % node)
+
+    def switch_mac(self, name):
+        """MAC a switch uses as next hop: its 'mac' in topology.json, else 08:00:00:00:NN:00."""
+        return self.switches[name].get("mac", "08:00:00:00:%02x:00" % switchNumber(name))
+
+    def neighbours(self, sw):
+        """(port, peer_switch) for the switch-to-switch links of sw."""
+        return self.adjacency[sw]
+
+    def port_roles(self, sw):
+        """
+        Roles of the switch's ports, from its "port_roles" in topology.json,
+        e.g. {"internal": [1, 2], "external": [3, 4]}.
+
+        :return: dict port -> role, empty if the switch has none
+        """
+        roles = {}
+        for role, ports in self.switches[sw].get("port_roles", {}).items():
+            for port in ports:
+                if port in roles:
+                    raise ValueError("Port %d of %s is both %s and %s" % (port, sw, roles[port], role))
+                roles[port] = role
+        return roles
+
+    def hosts_on(self, sw):
+        return [host for host in self.hosts.values() if host.switch == sw]
+
+    def next_hops(self, dst_sw):
+        """
+        Equal-cost next hops towards dst_sw from every switch.
+
+        :return: dict sw -> list of (port, peer_switch) on a shortest path to
+                 dst_sw; dst_sw itself and unreachable switches are absent
+        """
+        if dst_sw not in self._next_hops:
+            dist = {dst_sw: 0}
+            queue = deque([dst_sw])
+            while queue:
+                sw = queue.popleft()
+                for _, peer in self.neighbours(sw):
+                    if peer not in dist:
+                        dist[peer] = dist[sw] + 1
+                        queue.append(peer)
+            hops = {}
+            for sw, d in dist.items():
+                if d:
+                    hops[sw] = [(port, peer) for port, peer in self.neighbours(sw)
+                                if dist.get(peer) == d - 1]
+            self._next_hops[dst_sw] = hops
+        return self._next_hops[dst_sw]
+
+    def path(self, src_sw, dst_sw):
+        """
+        One shortest path as a list of (switch, egress_port) hops, ending with
+        (dst_sw, None). Ties are broken on the lowest port.
+        """
+        hops = self.next_hops(dst_sw)
+        path = []
+        sw = src_sw
+        while sw != dst_sw:
+            if sw not in hops:
+                raise ValueError("%s cannot reach %s" % (src_sw, dst_sw))
+            port, peer = hops[sw][0]
+            path.append((sw, port))
+            sw = peer
+        path.append((dst_sw, None))
+        return path
@@ -0,0 +1,357 @@
+# 隧道生命周期管理：从ID池分配隧道ID，按拓扑计算路径，在路径上各交换机写入入口、逐跳转发与出口规则，失败时回滚，拆除时按相反顺序删除
+import heapq
+import ipaddress
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import grpc
+from p4.v1 import p4runtime_pb2
+
+from .batch import BatchWriteError
+from .compiler import exactRule, lpmRule
+from .rules import buildEntry
+
+# advanced_tunnel.p4: dst_id is 16 bits and the tunnel counters have MAX_TUNNEL_ID cells
+MAX_TUNNEL_ID = 1 << 16
+
+
+def _update(table_entry, update_type):
+    update = p4runtime_pb2.Update()
+    update.type = update_type
+    update.entity.table_entry.CopyFrom(table_entry)
+    return update
+
+
+class TunnelError(Exception):
+    """
+    Raised when opening or closing tunnels was rejected by a switch; what
+    had been written already is undone first.
+
+    :param errors: list of BatchWriteError, one per switch that failed
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        super(TunnelError, self).__init__(errors)
+
+    def __str__(self):
+        return "\n".join(["Tunnel update rolled back:"] + [str(e) for e in self.errors])
+
+
+class TunnelIdPool(object):
+    """Tunnel IDs from first to last, handed out lowest first; released IDs are reused."""
+
+    def __init__(self, first=1, last=MAX_TUNNEL_ID - 1):
+        self.first = first
+        self.last = last
+        self._next = first
+        self._free = []     # heap of released IDs below _next
+        self._used = set()
+
+    def allocate(self, tunnel_id=None):
+        """
+        :param tunnel_id: a specific ID to take, or None for the lowest free one
+        :raises ValueError: if the ID is taken or out of range, or the pool is empty
+        """
+        if tunnel_id is not None:
+            if not self.first <= tunnel_id <= self.last or tunnel_id in self._used:
+                raise ValueError("Tunnel ID %d is %s" % (
+                    tunnel_id, "taken" if tunnel_id in self._used else "out of range"))
+            while self._next <= tunnel_id:
+                if self._next != tunnel_id:
+                    heapq.heappush(self._free, self._next)
+                self._next += 1
+            if tunnel_id in self._free:
+                self._free.remove(tunnel_id)
+                heapq.heapify(self._free)
+        elif self._free:
+            tunnel_id = heapq.heappop(self._free)
+        elif self._next <= self.last:
+            tunnel_id = self._next
+            self._next += 1
+        else:
+            raise ValueError("No tunnel ID left in %d..%d" % (self.first, self.last))
+        self._used.add(tunnel_id)
+        return tunnel_id
+
+    def release(self, tunnel_id):
+        self._used.remove(tunnel_id)
+        heapq.heappush(self._free, tunnel_id)
+
+    def __len__(self):
+        return len(self._used)
+
+
+class Tunnel(object):
+    """
+    A tunnel from an ingress switch to a host: traffic to the host's address
+    is encapsulated on the ingress switch and forwarded on the tunnel ID
+    along path, then decapsulated to the host on its switch.
+    """
+
+    def __init__(self, tunnel_id, ingress, dst, path):
+        """
+        :param dst: the destination Host
+        :param path: list of (switch, egress_port) from Topology.path()
+        """
+        self.tunnel_id = tunnel_id
+        self.ingress = ingress
+        self.dst = dst
+        self.path = path
+        self.entries = None     # encoded rules, see TunnelManager._entries()
+
+    @property
+    def egress(self):
+        return self.path[-1][0]
+
+    @property
+    def key(self):
+        return (self.ingress, self.dst.name)
+
+    def __repr__(self):
+        return "Tunnel(%d %s -> %s via %s)" % (self.tunnel_id, self.ingress, self.dst.name,
+                                               ",".join(sw for sw, _ in self.path))
+
+
+class TunnelManager(object):
+    """
+    Tunnels for the ex2 advanced_tunnel pipeline, over the topology.
+
+    A tunnel takes an ID from the pool and a shortest path from its ingress
+    switch to the destination host's switch, and needs three kinds of rules:
+    the ingress rule in ipv4_lpm on the ingress switch, a transit rule in
+    myTunnel_exact on every switch of the path but the last, and the egress
+    rule there.
+
+    Tunnels planned before bring-up are installed with the other rules (see
+    rules()). On running switches, open() and close() write the tunnels of a
+    call as one transaction over all switches: the myTunnel_exact entries go
+    first and the ingress entries last, so no packet enters a tunnel before
+    its path is complete, and teardown is the reverse; each step is one
+    batched write per switch, all switches in parallel. If a switch rejects
+    anything, the updates already applied are undone and TunnelError is
+    raised.
+    """
+
+    def __init__(self, p4info_helper, topo, switches, writer, pool=None,
+                 lpm_table="MyIngress.ipv4_lpm", tunnel_table="MyIngress.myTunnel_exact"):
+        """
+        :param switches: dict switch name -> switch connection
+        :param writer: the BatchWriter updates go through, with autoflush off
+        :param pool: the TunnelIdPool, the full 16-bit range by default
+        """
+        self.p4info_helper = p4info_helper
+        self.topo = topo
+        self.switches = switches
+        self.writer = writer
+        self.pool = pool or TunnelIdPool()
+        self.lpm_table = lpm_table
+        self.tunnel_table = tunnel_table
+        self.tunnels = OrderedDict()    # (ingress, host name) -> Tunnel
+        self._lock = threading.Lock()
+
+    def _plan(self, ingress, dst, tunnel_id=None):
+        host = self.topo.hosts.get(dst)
+        if host is None or host.switch is None:
+            raise ValueError("Unknown or unattached host %r" % dst)
+        if ingress not in self.topo.switches or ingress == host.switch:
+            raise ValueError("%s is %s" % (ingress, "the switch of %s" % dst
+                                           if ingress == host.switch else "not a switch"))
+        if (ingress, dst) in self.tunnels:
+            raise ValueError("%s already has a tunnel to %s" % (ingress, dst))
+        path = self.topo.path(ingress, host.switch)
+        tunnel = Tunnel(self.pool.allocate(tunnel_id), ingress, host, path)
+        self.tunnels[tunnel.key] = tunnel
+        return tunnel
+
+    def _drop(self, tunnel):
+        del self.tunnels[tunnel.key]
+        self.pool.release(tunnel.tunnel_id)
+
+    def plan(self, ingress, dst, tunnel_id=None):
+        """
+        Adds a tunnel without writing anything, for rules() to install at
+        bring-up.
+
+        :param ingress: the ingress switch name
+        :param dst: the destination host name
+        :param tunnel_id: a specific ID, or None for the lowest free one
+        :raises ValueError: if the tunnel exists, the host cannot be reached
+                            or no ID is left
+        """
+        with self._lock:
+            return self._plan(ingress, dst, tunnel_id)
+
+    def mesh(self):
+        """
+        Plans a tunnel from every switch with hosts to every host on another
+        switch, IDs in topology order, so a restart finds the same tunnels.
+
+        :return: the tunnels planned
+        """
+        edges = [sw for sw in self.topo.switches if self.topo.hosts_on(sw)]
+        with self._lock:
+            return [self._plan(ingress, host.name) for ingress in edges
+                    for host in self.topo.hosts.values()
+                    if host.switch is not None and host.switch != ingress
+                    and (ingress, host.name) not in self.tunnels]
+
+    def ingress_rule(self, tunnel):
+        return lpmRule(self.lpm_table, ipaddress.ip_network(tunnel.dst.ip + "/32"),
+                       "MyIngress.myTunnel_ingress", {"dst_id": tunnel.tunnel_id})
+
+    def path_rules(self, tunnel):
+        """:return: list of (switch name, rule), the transit rules and then the egress rule"""
+        rules = [(sw, exactRule(self.tunnel_table, "hdr.myTunnel.dst_id", tunnel.tunnel_id,
+                                "MyIngress.myTunnel_forward", {"port": port}))
+                 for sw, port in tunnel.path[:-1]]
+        rules.append((tunnel.egress, exactRule(self.tunnel_table, "hdr.myTunnel.dst_id",
+                                               tunnel.tunnel_id, "MyIngress.myTunnel_egress",
+                                               {"dstAddr": tunnel.dst.mac,
+                                                "port": tunnel.dst.port})))
+        return rules
+
+    def rules(self):
+        """
+        The rules of all tunnels.
+
+        :return: OrderedDict switch name -> list of rules in the runtime JSON format
+        """
+        rules = OrderedDict((sw, []) for sw in self.topo.switches)
+        for tunnel in self.tunnels.values():
+            for sw, rule in self.path_rules(tunnel):
+                rules[sw].append(rule)
+        for tunnel in self.tunnels.values():
+            rules[tunnel.ingress].append(self.ingress_rule(tunnel))
+        return rules
+
+    def counters(self):
+        """(tunnel_id, ingress, egress) of every tunnel, as CounterCollector.tunnel_loss() takes them."""
+        return [(t.tunnel_id, t.ingress, t.egress) for t in self.tunnels.values()]
+
+    def _entries(self, tunnel):
+        """The tunnel's path entries and ingress entry, encoded once and kept for its teardown."""
+        if tunnel.entries is None:
+            tunnel.entries = ([(sw, buildEntry(self.p4info_helper, rule))
+                               for sw, rule in self.path_rules(tunnel)],
+                              buildEntry(self.p4info_helper, self.ingress_rule(tunnel)))
+        return tunnel.entries
+
+    def _phases(self, tunnels, update_type):
+        path, ingress = OrderedDict(), OrderedDict()
+        for tunnel in tunnels:
+            path_entries, ingress_entry = self._entries(tunnel)
+            for sw, entry in path_entries:
+                path.setdefault(sw, []).append(_update(entry, update_type))
+            ingress.setdefault(tunnel.ingress, []).append(_update(ingress_entry, update_type))
+        if update_type == p4runtime_pb2.Update.DELETE:
+            return [ingress, path]
+        return [path, ingress]
+
+    def _send(self, phase):
+        """
+        Writes one phase, each switch's updates batched and all switches in
+        parallel.
+
+        :param phase: dict switch name -> [Update]
+        :return: (dict switch name -> [Update] applied, [BatchWriteError])
+        """
+        switches = [self.switches[name] for name in phase]
+        for sw in switches:
+            for update in phase[sw.name]:
+                self.writer.add_update(sw, update)
+
+        def flush(sw):
+            try:
+                self.writer.flush(sw)
+            except BatchWriteError as e:
+                return e
+            except grpc.RpcError as e:
+                # No per-update details: nothing of the phase counts as applied on this switch
+                status = p4runtime_pb2.Error()
+                status.canonical_code = e.code().value[0]
+                status.message = e.details() or ""
+                return BatchWriteError(sw.name, [(update, status) for update in phase[sw.name]])
+            return None
+
+        with ThreadPoolExecutor(max_workers=max(len(switches), 1)) as executor:
+            results = list(executor.map(flush, switches))
+        applied, errors = {}, []
+        for sw, error in zip(switches, results):
+            applied[sw.name] = phase[sw.name]
+            if error is not None:
+                errors.append(error)
+                rejected = set(update.SerializeToString() for update, _ in error.failures)
+                applied[sw.name] = [update for update in phase[sw.name]
+                                    if update.SerializeToString() not in rejected]
+        return applied, errors
+
+    def _transact(self, phases):
+        """
+        Writes the phases in order; if one is rejected, undoes every update
+        applied so far, newest first.
+
+        :raises TunnelError: if any update was rejected
+        """
+        done = []
+        for phase in phases:
+            applied, errors = self._send(phase)
+            done.append(applied)
+            if errors:
+                for written in reversed(done):
+                    undo = OrderedDict()
+                    for name, updates in written.items():
+                        for update in reversed(updates):
+                            reverse = p4runtime_pb2.Update()
+                            reverse.CopyFrom(update)
+                            reverse.type = (p4runtime_pb2.Update.DELETE
+                                            if update.type == p4runtime_pb2.Update.INSERT
+                                            else p4runtime_pb2.Update.INSERT)
+                            undo.setdefault(name, []).append(reverse)
+                    _, undo_errors = self._send(undo)
+                    for error in undo_errors:
+                        print("Could not undo all tunnel updates on %s:\n%s"
+                              % (error.switch_name, error))
+                raise TunnelError(errors)
+
+    def open(self, pairs):
+        """
+        Sets up tunnels on running switches in one transaction.
+
+        :param pairs: list of (ingress switch name, destination host name)
+        :return: the tunnels opened
+        :raises ValueError: before anything is written, as for plan()
+        :raises TunnelError: if a switch rejected the tunnels or a write
+                             failed, none of which is left
+        """
+        with self._lock:
+            tunnels = []
+            try:
+                for ingress, dst in pairs:
+                    tunnels.append(self._plan(ingress, dst))
+                phases = self._phases(tunnels, p4runtime_pb2.Update.INSERT)
+                self._transact(phases)
+            except Exception:
+                for tunnel in tunnels:
+                    self._drop(tunnel)
+                raise
+        print("Opened %d tunnel(s), %d rule(s) on %d switch(es)" % (
+            len(tunnels), sum(len(u) for phase in phases for u in phase.values()),
+            len(set(name for phase in phases for name in phase))))
+        return tunnels
+
+    def close(self, tunnels):
+        """
+        Tears tunnels down in one transaction: the ingress entries first, so
+        traffic stops entering them, then their paths. Their IDs go back to
+        the pool.
+
+        :raises TunnelError: if a switch rejected the deletes, all tunnels are kept
+        """
+        with self._lock:
+            tunnels = [self.tunnels[tunnel.key] for tunnel in tunnels]
+            self._transact(self._phases(tunnels, p4runtime_pb2.Update.DELETE))
+            for tunnel in tunnels:
+                self._drop(tunnel)
+        print("Closed %d tunnel(s)" % len(tunnels))
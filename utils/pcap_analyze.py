@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+# 离线分析抓包文件（pcaps/sX-ethY_in/out.pcap）：mmap流式读取，生成器逐级处理，内存占用与文件大小无关；
+# 可按文件分块在多进程上并行，统计每流时延代理指标、ECN CE标记比例、DSCP分布和ECMP各端口负载
+import argparse
+import math
+import mmap
+import os
+import re
+import socket
+import struct
+from collections import OrderedDict
+from multiprocessing import Pool
+
+PCAP_HEADER_LEN = 24
+RECORD_HEADER_LEN = 16
+ETH_LEN = 14
+ETH_P_IP = 0x0800
+DEFAULT_CHUNK_BYTES = 64 * 1024 * 1024
+
+ECN_NAMES = ("Not-ECT", "ECT(1)", "ECT(0)", "CE")
+DSCP_NAMES = {0: "BE", 8: "CS1", 10: "AF11", 12: "AF12", 14: "AF13", 16: "CS2", 18: "AF21",
+              20: "AF22", 22: "AF23", 24: "CS3", 26: "AF31", 28: "AF32", 30: "AF33",
+              32: "CS4", 34: "AF41", 36: "AF42", 38: "AF43", 40: "CS5", 46: "EF",
+              48: "CS6", 56: "CS7"}
+PCAP_NAME = re.compile(r"^(s\d+)-eth(\d+)_(in|out)\.pcap$")
+
+
+def pcapFormat(view, path):
+    """:return: (struct byte order, timestamp fraction scale) of a pcap file"""
+    magic = view[:4].tobytes()
+    if magic in (b"\xd4\xc3\xb2\xa1", b"\x4d\x3c\xb2\xa1"):
+        endian = "<"
+    elif magic in (b"\xa1\xb2\xc3\xd4", b"\xa1\xb2\x3c\x4d"):
+        endian = ">"
+    else:
+        raise ValueError("%s is not a pcap file" % path)
+    scale = 1e-9 if magic in (b"\x4d\x3c\xb2\xa1", b"\xa1\xb2\x3c\x4d") else 1e-6
+    linktype, = struct.unpack_from(endian + "I", view, 20)
+    if linktype != 1:
+        raise ValueError("%s: only Ethernet captures are supported" % path)
+    return endian, scale
+
+
+def splitPcap(path, chunk_bytes=DEFAULT_CHUNK_BYTES):
+    """
+    Splits a pcap file into chunks of about chunk_bytes on record boundaries,
+    reading only the record headers.
+
+    :return: list of (start, end) byte offsets
+    """
+    size = os.path.getsize(path)
+    if size <= PCAP_HEADER_LEN:
+        return []
+    with open(path, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        endian, _ = pcapFormat(memoryview(data), path)
+        record = struct.Struct(endian + "IIII")
+        chunks = []
+        start = offset = PCAP_HEADER_LEN
+        while offset + RECORD_HEADER_LEN <= size:
+            if offset - start >= chunk_bytes:
+                chunks.append((start, offset))
+                start = offset
+            offset += RECORD_HEADER_LEN + record.unpack_from(data, offset)[2]
+        chunks.append((start, min(offset, size)))
+        return chunks
+    finally:
+        data.close()
+
+
+def readFrames(path, start=PCAP_HEADER_LEN, end=None):
+    """
+    Stage 1: yields (timestamp, frame) for the records between the byte
+    offsets start and end. The frame is a memoryview into the mmapped file,
+    valid until the next record is read.
+    """
+    with open(path, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(data)
+    frame = None
+    try:
+        endian, scale = pcapFormat(view, path)
+        record = struct.Struct(endian + "IIII")
+        offset = start
+        end = len(view) if end is None else end
+        while offset + RECORD_HEADER_LEN <= end:
+            sec, frac, caplen, _ = record.unpack_from(view, offset)
+            offset += RECORD_HEADER_LEN
+            frame = view[offset:offset + caplen]
+            yield sec + frac * scale, frame
+            frame.release()
+            offset += caplen
+    finally:
+        if frame is not None:
+            frame.release()
+        view.release()
+        data.close()
+
+
+def parseIpv4(frames):
+    """
+    Stage 2: yields (timestamp, flow, tos, ip length) for the IPv4 frames,
+    flow being (src, dst, proto, sport, dport); ports are 0 for anything
+    but TCP and UDP.
+    """
+    unpack_from = struct.unpack_from
+    for t, frame in frames:
+        if len(frame) < ETH_LEN + 20 or unpack_from("!H", frame, 12)[0] != ETH_P_IP:
+            continue
+        ver_ihl, tos, length = unpack_from("!BBH", frame, ETH_LEN)
+        proto = frame[ETH_LEN + 9]
+        src, dst = unpack_from("!4s4s", frame, ETH_LEN + 12)
+        l4 = ETH_LEN + ((ver_ihl & 0x0f) << 2)
+        if proto in (socket.IPPROTO_TCP, socket.IPPROTO_UDP) and len(frame) >= l4 + 4:
+            sport, dport = unpack_from("!HH", frame, l4)
+        else:
+            sport = dport = 0
+        yield t, (src, dst, proto, sport, dport), tos, length
+
+
+def formatFlow(flow):
+    src, dst, proto, sport, dport = flow
+    return "%s:%d -> %s:%d/%d" % (socket.inet_ntoa(src), sport, socket.inet_ntoa(dst), dport, proto)
+
+
+class LatencyAnalyzer(object):
+    """
+    Per-flow inter-arrival times as a latency proxy: a growing mean or
+    spread at a fixed send rate means packets are queueing. Mean and
+    variance use Welford's method, so each flow keeps a few numbers only.
+    """
+    name = "latency"
+
+    def __init__(self):
+        self.flows = {}     # flow -> [first, last, n, mean, m2, max]
+
+    def add(self, t, flow, tos, length):
+        s = self.flows.get(flow)
+        if s is None:
+            self.flows[flow] = [t, t, 0, 0.0, 0.0, 0.0]
+            return
+        self._sample(s, t - s[1])
+        s[1] = t
+
+    @staticmethod
+    def _sample(s, gap):
+        s[2] += 1
+        delta = gap - s[3]
+        s[3] += delta / s[2]
+        s[4] += delta * (gap - s[3])
+        s[5] = max(s[5], gap)
+
+    def merge(self, other, contiguous=True):
+        # contiguous: other covers the next chunk of the same file, so the gap
+        # between the two chunks is a sample too; otherwise another capture point
+        for flow, o in other.flows.items():
+            s = self.flows.get(flow)
+            if s is None:
+                self.flows[flow] = list(o)
+                continue
+            if contiguous:
+                self._sample(s, o[0] - s[1])
+            n = s[2] + o[2]
+            if not n:
+                continue
+            if o[2]:
+                delta = o[3] - s[3]
+                s[4] += o[4] + delta * delta * s[2] * o[2] / n
+                s[3] += delta * o[2] / n
+            s[2], s[1], s[5] = n, max(s[1], o[1]), max(s[5], o[5])
+
+    def report(self, top):
+        print("\n----- Inter-arrival time per flow (latency proxy) -----")
+        flows = sorted(self.flows.items(), key=lambda item: -item[1][2])[:top]
+        for flow, (first, last, n, mean, m2, gap_max) in flows:
+            std = math.sqrt(m2 / n) if n else 0.0
+            print(" %-44s %8d gaps  mean %8.3f ms  jitter %8.3f ms  max %8.3f ms" % (
+                formatFlow(flow), n, mean * 1e3, std * 1e3, gap_max * 1e3))
+
+
+class EcnAnalyzer(object):
+    """ECN codepoints per flow; CE ratio = CE / (ECT + CE)."""
+    name = "ecn"
+
+    def __init__(self):
+        self.flows = {}     # flow -> [Not-ECT, ECT(1), ECT(0), CE]
+
+    def add(self, t, flow, tos, length):
+        counts = self.flows.get(flow)
+        if counts is None:
+            counts = self.flows[flow] = [0, 0, 0, 0]
+        counts[tos & 3] += 1
+
+    def merge(self, other, contiguous=True):
+        for flow, o in other.flows.items():
+            counts = self.flows.setdefault(flow, [0, 0, 0, 0])
+            for i in range(4):
+                counts[i] += o[i]
+
+    def report(self, top):
+        print("\n----- ECN marks -----")
+        totals = [sum(c[i] for c in self.flows.values()) for i in range(4)]
+        ect = sum(totals[1:])
+        print(" all flows: %s, CE ratio %.2f%%" % (
+            ", ".join("%s %d" % (n, c) for n, c in zip(ECN_NAMES, totals)),
+            100.0 * totals[3] / ect if ect else 0.0))
+        flows = sorted(self.flows.items(), key=lambda item: -item[1][3])[:top]
+        for flow, counts in flows:
+            ect = sum(counts[1:])
+            print(" %-44s %8d pkts  CE %8d  CE ratio %6.2f%%" % (
+                formatFlow(flow), sum(counts), counts[3], 100.0 * counts[3] / ect if ect else 0.0))
+
+
+class DscpAnalyzer(object):
+    """Packets and bytes per DSCP class."""
+    name = "dscp"
+
+    def __init__(self):
+        self.classes = {}   # dscp -> [packets, bytes]
+
+    def add(self, t, flow, tos, length):
+        c = self.classes.get(tos >> 2)
+        if c is None:
+            c = self.classes[tos >> 2] = [0, 0]
+        c[0] += 1
+        c[1] += length
+
+    def merge(self, other, contiguous=True):
+        for dscp, o in other.classes.items():
+            c = self.classes.setdefault(dscp, [0, 0])
+            c[0] += o[0]
+            c[1] += o[1]
+
+    def report(self, top):
+        print("\n----- DSCP classes -----")
+        packets = sum(c[0] for c in self.classes.values()) or 1
+        total_bytes = sum(c[1] for c in self.classes.values()) or 1
+        for dscp, (n, b) in sorted(self.classes.items()):
+            print(" %-5s (%2d) %10d pkts %6.2f%%  %12d bytes %6.2f%%" % (
+                DSCP_NAMES.get(dscp, "?"), dscp, n, 100.0 * n / packets, b, 100.0 * b / total_bytes))
+
+
+ANALYZERS = OrderedDict((cls.name, cls) for cls in (LatencyAnalyzer, EcnAnalyzer, DscpAnalyzer))
+
+
+def analyzeChunk(task):
+    """Runs the analyzers over one chunk; the unit of work of the process pool."""
+    path, start, end, names = task
+    analyzers = [ANALYZERS[name]() for name in names]
+    adds = [a.add for a in analyzers]
+    packets = byte_count = 0
+    flows = set()
+    for t, flow, tos, length in parseIpv4(readFrames(path, start, end)):
+        packets += 1
+        byte_count += length
+        flows.add(flow)
+        for add in adds:
+            add(t, flow, tos, length)
+    return path, analyzers, packets, byte_count, flows
+
+
+def ecmpReport(totals):
+    """
+    Load of each egress port per switch, from the sX-ethY_out.pcap files
+    given, with Jain's fairness index over the ports of each switch.
+    """
+    switches = OrderedDict()
+    for path, (packets, byte_count, flows) in totals.items():
+        m = PCAP_NAME.match(os.path.basename(path))
+        if m and m.group(3) == "out":
+            switches.setdefault(m.group(1), []).append((int(m.group(2)), packets, byte_count, flows))
+    print("\n----- ECMP balance over egress ports (sX-ethY_out.pcap) -----")
+    if not switches:
+        print(" no sX-ethY_out.pcap files given")
+        return
+    for sw, ports in switches.items():
+        ports.sort()
+        load = [b for _, _, b, _ in ports]
+        total = float(sum(load)) or 1.0
+        jain = sum(load) ** 2 / (len(load) * sum(b * b for b in load)) if any(load) else 1.0
+        seen = {}
+        for port, _, _, flows in ports:
+            for flow in flows:
+                seen[flow] = seen.get(flow, 0) + 1
+        split = sum(1 for n in seen.values() if n > 1)
+        print(" %s: Jain fairness %.3f, %d flow(s), %d seen on several ports" % (
+            sw, jain, len(seen), split))
+        for port, packets, byte_count, flows in ports:
+            print("   eth%-3d %10d pkts  %12d bytes  %6.2f%%  %d flow(s)" % (
+                port, packets, byte_count, 100.0 * byte_count / total, len(flows)))
+
+
+def analyze(paths, names, jobs, chunk_bytes=DEFAULT_CHUNK_BYTES):
+    """
+    Splits the files into chunks, analyzes them (in parallel if jobs > 1)
+    and merges the results in file order.
+
+    :return: (merged analyzers, {path: (packets, bytes, flows)})
+    """
+    tasks = [(path, start, end, names)
+             for path in paths for start, end in splitPcap(path, chunk_bytes)]
+    merged = [ANALYZERS[name]() for name in names]
+    totals = OrderedDict((path, [0, 0, set()]) for path in paths)
+    if jobs > 1 and len(tasks) > 1:
+        pool = Pool(jobs)
+        results = pool.imap(analyzeChunk, tasks)
+    else:
+        pool = None
+        results = map(analyzeChunk, tasks)
+    current, per_file = None, None
+    try:
+        for path, analyzers, packets, byte_count, flows in results:
+            # Chunks come back in task order: merge those of one file
+            # back to back, then fold the file into the overall result
+            if path != current:
+                if per_file is not None:
+                    for into, a in zip(merged, per_file):
+                        into.merge(a, contiguous=False)
+                current, per_file = path, [ANALYZERS[name]() for name in names]
+            for into, a in zip(per_file, analyzers):
+                into.merge(a)
+            total = totals[path]
+            total[0] += packets
+            total[1] += byte_count
+            total[2] |= flows
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    if per_file is not None:
+        for into, a in zip(merged, per_file):
+            into.merge(a, contiguous=False)
+    return merged, totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline analysis of the exercise pcaps')
+    parser.add_argument('pcaps', nargs='+', help='pcap files, e.g. pcaps/s1-eth2_out.pcap')
+    parser.add_argument('--report', default='latency,ecn,dscp,ecmp',
+                        help='comma separated reports: latency, ecn, dscp, ecmp')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1,
+                        help='worker processes (default: one per CPU)')
+    parser.add_argument('--chunk-mb', type=int, default=DEFAULT_CHUNK_BYTES // (1024 * 1024),
+                        help='size of the file chunks handed to the workers')
+    parser.add_argument('--top', type=int, default=20, help='flows listed per report')
+    args = parser.parse_args()
+
+    reports = [r.strip() for r in args.report.split(',') if r.strip()]
+    unknown = [r for r in reports if r not in ANALYZERS and r != 'ecmp']
+    if unknown:
+        parser.error("unknown report(s): %s" % ", ".join(unknown))
+    merged, totals = analyze(args.pcaps, [r for r in reports if r in ANALYZERS],
+                             args.jobs, args.chunk_mb * 1024 * 1024)
+    print("%d file(s), %d IPv4 packet(s)" % (len(totals), sum(t[0] for t in totals.values())))
+    for analyzer in merged:
+        analyzer.report(args.top)
+    if 'ecmp' in reports:
+        ecmpReport(totals)
+
+
+if __name__ == '__main__':
+    main()